@@ -0,0 +1,362 @@
+"""
+Regression check and benchmark of :func:`sites.erairaws.info.parse_anime_info`.
+
+The pages in ``fixtures`` are hand-trimmed erai-raws anime pages, each with the frozen output of the parser
+in the ``.json`` file of the same name. They are checked and benchmarked with::
+
+    python -m sites.erairaws.bench
+
+The fixtures only have a few releases and none of the site navigation, so they are benchmarked after their
+release tables are repeated up to the size of a long-running show (see :func:`expand_page`), which is still
+not a real page. Full pages saved from the site (files or directories of them) should be benchmarked with::
+
+    python -m sites.erairaws.bench page1.html saved_pages_dir ...
+
+The XPath parsing is compared with the original PyQuery parser with the dates parsed ahead, and the parsing
+of the release dates is benchmarked separately, against the ``dateparser`` used by the original parser.
+
+After an intended change of the parser output, the frozen outputs are rewritten with
+``python -m sites.erairaws.bench --freeze``. The URL of each page is taken from its ``<link rel="canonical">``.
+"""
+import copy
+import glob
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import List, Optional
+from unittest.mock import patch
+from urllib.parse import urljoin
+
+import dateparser
+import lxml.html
+from ditk import logging
+from hbutils.system import urlsplit
+from pyquery import PyQuery as pq
+
+from . import info
+from .info import parse_anime_info
+from ..utils import parse_timestamp
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def parse_anime_info_pyquery(html: str, page_url: str) -> dict:
+    """
+    The original PyQuery implementation of :func:`parse_anime_info`, only kept as the baseline of :func:`bench`.
+    The dates are parsed with :func:`parse_timestamp` like the new parser, so only the XPath parsing is compared.
+    """
+    page = pq(html)
+
+    psplit = urlsplit(page_url)
+    assert psplit.path_segments[1] == 'anime-list'
+    id_ = psplit.path_segments[2]
+
+    main = page('#main')
+    content = main('.entry-content')
+    title = main('h1.entry-title').text().strip()
+    poster_url = urljoin(page_url, content('.entry-content-poster img').attr('src'))
+    story = content('.entry-content-story').text()
+
+    related = []
+    for related_item in content('.entry-content-related ul li').items():
+        related.append({
+            'title': related_item('a').text().strip(),
+            'url': urljoin(page_url, related_item('a').attr('href')),
+        })
+
+    external_links = {}
+    other_links = {}
+    rss_url = None
+    for btn_group in content('.entry-content-buttons').items():
+        if 'more info:' in btn_group.text().lower():
+            for btn_item in btn_group('.entry-sub-content-buttons').items():
+                external_links[btn_item.text().strip()] = urljoin(page_url, btn_item.attr('href'))
+        elif 'rss link' in btn_group.text().lower():
+            for pitem in btn_group('p').items():
+                if 'rss link' in pitem.text().lower() and 'ALL' in pitem.text():
+                    rss_url = urljoin(page_url, pitem('a').attr('href'))
+        elif 'other:' in btn_group.text().lower():
+            for btn_item in btn_group('a.entry-sub-content-buttons').items():
+                other_links[btn_item.text().strip()] = urljoin(page_url, btn_item.attr('href'))
+
+    if 'MAL' in external_links:
+        segments = urlsplit(external_links['MAL']).path_segments
+        assert segments[1] == 'anime', f'Anime expected but {external_links["MAL"]!r} found.'
+        mal_id = int(segments[2])
+    else:
+        mal_id = None
+
+    r_pane = None
+    for pane in main('.tab-content > .tab-pane').items():
+        if 'all release' in pane('h4.alphabet-title').text().strip().lower():
+            r_pane = pane
+            break
+
+    resources = []
+    if r_pane:
+        for table in r_pane('table.table').items():
+            fst_row = table('tr:nth-child(1)')
+            categories = [
+                c.attr('data-title')
+                for c in fst_row('th a[data-title]').items()
+            ]
+
+            ititle = fst_row('th a.aa_ss_ops_new').text().strip()
+            iurl = urljoin(page_url, fst_row('th a.aa_ss_ops_new').attr('href'))
+
+            if table('tr:nth-child(3) th font.clock_font').text().strip():
+                sec_row = table('tr:nth-child(2)')
+                thr_row = table('tr:nth-child(3)')
+            else:
+                sec_row = None
+                thr_row = table('tr:nth-child(2)')
+
+            if sec_row:
+                sec_links = {
+                    x.text().strip(): urljoin(page_url,
+                                              x('a').attr('href')) if 'magnet' not in x.text().strip().lower() else x(
+                        'a').attr('href')
+                    for x in sec_row('th a.sub_ddl_box').items()
+                }
+                langs = [
+                    x.attr('data-title')
+                    for x in sec_row('th span.tooltip3[data-title]').items()
+                ]
+            else:
+                sec_links = {}
+                langs = []
+
+            publish_at_str = thr_row('th font.clock_font').text()
+            published_at = parse_timestamp(publish_at_str)
+
+            rurls = {}
+            rx_maps = {}
+            for sitem in thr_row('th span').items():
+                if sitem('a').attr('href'):
+                    rurls[sitem('a').text().strip()] = \
+                        urljoin(page_url, sitem('a').attr('href')) if 'magnet' not in sitem(
+                            'a').text().lower() else sitem(
+                            'a').attr('href')
+                else:
+                    rx = sitem('a').text()
+                    rx_maps[rx] = sitem.attr('id')
+
+            if rx_maps:
+                for rx, rx_id in rx_maps.items():
+                    span_text = table(f'tr[class~={json.dumps(rx_id)}] th > span:nth-child(1)').text()
+                    span_segs = span_text.split('|', maxsplit=2)
+                    size_text = None
+                    ext_info = None
+                    for seg in span_segs:
+                        seg = seg.strip()
+                        if 'size' in seg.lower():
+                            size_text = seg.split(':', maxsplit=1)[-1].strip()
+                        elif size_text is not None:
+                            ext_info = seg
+
+                    rurls[rx] = {
+                        'size': size_text,
+                        'ext': ext_info,
+                    }
+                    for ax in table(f'tr[class~={json.dumps(rx_id)}] th > a').items():
+                        rurls[rx][ax.text().strip()] = \
+                            urljoin(page_url, ax.attr('href')) if 'magnet' not in ax.text().lower() else \
+                                ax.attr('href')
+
+            item = {
+                'title': ititle,
+                'page_url': iurl,
+                'categories': categories,
+                'sec_links': sec_links,
+                'langs': langs,
+                'published_at': published_at,
+                'resource_urls': rurls,
+            }
+            resources.append(item)
+
+    return {
+        'id': id_,
+        'page_url': page_url,
+        'mal_id': mal_id,
+        'title': title,
+        'poster_url': poster_url,
+        'story': story,
+        'external_links': external_links,
+        'other_links': other_links,
+        'related': related,
+        'rss_url': rss_url,
+        'resources': resources,
+        'last_published_at': max(x['published_at'] for x in resources) if resources else None,
+        'published_at': min(x['published_at'] for x in resources) if resources else None,
+    }
+
+
+def _get_page_url(html: str) -> str:
+    return lxml.html.fromstring(html).xpath('string(//link[@rel="canonical"]/@href)')
+
+
+def _read_page(file: str):
+    with open(file, 'r', encoding='utf-8') as f:
+        html = f.read()
+    return html, _get_page_url(html)
+
+
+def fixture_files() -> List[str]:
+    """
+    Get the saved pages in ``fixtures``.
+    """
+    return sorted(glob.glob(os.path.join(FIXTURES_DIR, '*.html')))
+
+
+def _expected_file(file: str) -> str:
+    return os.path.splitext(file)[0] + '.json'
+
+
+def check(files: Optional[List[str]] = None):
+    """
+    Check the output of :func:`parse_anime_info` on the saved pages against their frozen outputs.
+
+    :param files: Saved pages, all the fixtures when not given.
+    :raises AssertionError: When any output is not the same as the frozen one.
+    """
+    mismatched = []
+    for file in (files or fixture_files()):
+        actual = parse_anime_info(*_read_page(file))
+        with open(_expected_file(file), 'r', encoding='utf-8') as f:
+            expected = json.load(f)
+        if actual != expected:
+            mismatched.append(file)
+        else:
+            logging.info(f'{file!r} matched, {len(actual["resources"])} resource(s).')
+
+    if mismatched:
+        raise AssertionError(f'Result mismatch on {mismatched!r}.')
+
+
+def freeze(files: Optional[List[str]] = None):
+    """
+    Rewrite the frozen outputs of the saved pages with the current :func:`parse_anime_info`.
+
+    :param files: Saved pages, all the fixtures when not given.
+    """
+    for file in (files or fixture_files()):
+        with open(_expected_file(file), 'w', encoding='utf-8') as f:
+            json.dump(parse_anime_info(*_read_page(file)), f, indent=2, ensure_ascii=False)
+            print('', file=f)
+        logging.info(f'Output of {file!r} frozen.')
+
+
+# number of the releases of the expanded fixtures, about the size of a long-running show
+FULL_PAGE_RELEASES = 150
+
+
+def expand_page(html: str, releases: int = FULL_PAGE_RELEASES) -> str:
+    """
+    Repeat the tables of the "All releases" pane of a saved page until it has the given number of releases.
+
+    :param html: The saved page.
+    :type html: str
+    :param releases: Number of the releases. (default: :data:`FULL_PAGE_RELEASES`)
+    :type releases: int
+    :returns: The expanded page, the same as the saved one when it has no releases.
+    :rtype: str
+    """
+    page = lxml.html.fromstring(html)
+    for pane in page.cssselect('.tab-content > .tab-pane'):
+        if 'all release' in ' '.join(e.text_content() for e in pane.cssselect('h4.alphabet-title')).lower():
+            tables = pane.cssselect('table.table')
+            if tables:
+                for i in range(releases - len(tables)):
+                    tables[-1].addnext(copy.deepcopy(tables[i % len(tables)]))
+            break
+    return lxml.html.tostring(page, encoding='unicode', doctype='<!DOCTYPE html>')
+
+
+def _date_texts(html: str) -> List[str]:
+    return [e.text_content() for e in lxml.html.fromstring(html).cssselect('th font.clock_font')]
+
+
+@contextmanager
+def _dates_parsed_ahead(texts: List[str]):
+    # the dates of the page are looked up, so the parsers only spend the time on the html
+    d_timestamps = {text: parse_timestamp(text) for text in texts}
+
+    def _lookup(text: str) -> float:
+        return d_timestamps[text] if text in d_timestamps else parse_timestamp(text)
+
+    with patch.object(info, 'parse_timestamp', _lookup), \
+            patch.object(sys.modules[__name__], 'parse_timestamp', _lookup):
+        yield
+
+
+def _timeit(fn, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return time.perf_counter() - start
+
+
+def bench(files: List[str], rounds: int = 5, releases: Optional[int] = None):
+    """
+    Benchmark :func:`parse_anime_info` against :func:`parse_anime_info_pyquery` on the saved pages,
+    the XPath parsing and the date parsing are measured separately.
+
+    :param files: Saved pages.
+    :type files: List[str]
+    :param rounds: Rounds of each page. (default: 5)
+    :type rounds: int
+    :param releases: Expand the pages to this number of releases with :func:`expand_page`,
+        the pages are used as they are when not given.
+    :type releases: Optional[int]
+    """
+    t_old, t_new, t_dates, t_dateparser = 0.0, 0.0, 0.0, 0.0
+    total_bytes, total_dates = 0, 0
+    for file in files:
+        html, page_url = _read_page(file)
+        if releases is not None:
+            html = expand_page(html, releases)
+        texts = _date_texts(html)
+        total_bytes += len(html.encode('utf-8'))
+        total_dates += len(texts)
+
+        with _dates_parsed_ahead(texts):
+            expected = parse_anime_info_pyquery(html, page_url)
+            actual = parse_anime_info(html, page_url)
+            if actual != expected:
+                raise AssertionError(f'Result mismatch with pyquery parser on {file!r}.')
+            t_old += _timeit(lambda: parse_anime_info_pyquery(html, page_url), rounds)
+            t_new += _timeit(lambda: parse_anime_info(html, page_url), rounds)
+
+        t_dates += _timeit(lambda: [parse_timestamp(text) for text in texts], rounds)
+        t_dateparser += _timeit(lambda: [dateparser.parse(text) for text in texts], rounds)
+
+    n = len(files) * rounds
+    logging.info(f'{len(files)} page(s), {total_bytes / len(files) / 1024:.1f}KiB and '
+                 f'{total_dates / len(files):.1f} date(s) per page.')
+    logging.info(f'XPath parsing: pyquery {t_old / n * 1000:.2f}ms/page, lxml {t_new / n * 1000:.2f}ms/page, '
+                 f'speedup {t_old / t_new:.2f}x')
+    logging.info(f'Date parsing: dateparser {t_dateparser / n * 1000:.2f}ms/page, '
+                 f'parse_timestamp {t_dates / n * 1000:.2f}ms/page, speedup {t_dateparser / t_dates:.2f}x')
+
+
+def _iter_page_files(paths: List[str]):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, '*.html')))
+        else:
+            yield path
+
+
+if __name__ == '__main__':
+    logging.try_init_root(logging.INFO)
+    if sys.argv[1:] == ['--freeze']:
+        freeze()
+    elif sys.argv[1:]:
+        bench(list(_iter_page_files(sys.argv[1:])))
+    else:
+        check()
+        logging.warning(f'Benchmarking the fixtures expanded to {FULL_PAGE_RELEASES} releases, '
+                        f'not the real pages saved from the site.')
+        bench(fixture_files(), releases=FULL_PAGE_RELEASES)
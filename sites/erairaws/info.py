@@ -1,20 +1,25 @@
-import json
+import email.utils
 import os.path
+from collections import defaultdict
 from pprint import pprint
 from typing import Optional, Union, List
 from urllib.parse import urljoin
 
-import dateparser
+import lxml.html
 import requests
+import xmltodict
 from ditk import logging
 from hbutils.system import urlsplit
+from lxml import etree
 from pyquery import PyQuery as pq
+from pyquery.cssselectpatch import JQueryTranslator
+from pyquery.text import extract_text
 
-from ..utils import get_requests_session, srequest
+from ..utils import get_requests_session, srequest, asrequest, run_async, HTTPCache, parse_timestamp
 
 
-def get_session(no_login: bool = False):
-    session = get_requests_session()
+def get_session(no_login: bool = False, cache: Optional[HTTPCache] = None):
+    session = get_requests_session(cache=cache)
     if not no_login:
         session.headers.update({
             'Cookie': os.environ['ERAI_RAW_COOKIE'],
@@ -39,44 +44,198 @@ def iter_anime_items(session: Optional[requests.Session] = None):
         raise ValueError(f'Invalid list, should be no less than 100 but {count} found.')
 
 
-def get_anime_info(anime_page_url: str, session: Optional[requests.Session] = None,
-                   session_rss: Optional[Union[List[requests.Session], requests.Session]] = None):
-    session = session or get_session(no_login=False)
-    session_rss = session_rss or get_session(no_login=True)
-    resp = srequest(session, 'GET', anime_page_url)
-    page = pq(resp.text)
+async def aget_rss_last_published_at(rss_url: str,
+                                     session: Optional[Union[List[requests.Session], requests.Session]] = None) \
+        -> Optional[float]:
+    session = session or get_session(no_login=True)
+    resp = await asrequest(session, 'GET', rss_url)
+    channel = xmltodict.parse(resp.text)['rss']['channel'] or {}
+    items = channel.get('item') or []
+    if isinstance(items, dict):
+        items = [items]
+
+    timestamps = [
+        email.utils.parsedate_to_datetime(item['pubDate']).timestamp()
+        for item in items if item.get('pubDate')
+    ]
+    return max(timestamps) if timestamps else None
+
+
+def get_rss_last_published_at(rss_url: str, session: Optional[Union[List[requests.Session], requests.Session]] = None) \
+        -> Optional[float]:
+    return run_async(aget_rss_last_published_at(rss_url, session=session))
+
+
+_TRANSLATOR = JQueryTranslator(xhtml=False)
+
+
+def _css(selector: str) -> etree.XPath:
+    # same translation as pyquery, but compiled only once
+    return etree.XPath(_TRANSLATOR.css_to_xpath(selector, 'descendant-or-self::'))
+
+
+_X_MAIN = _css('#main')
+_X_ENTRY_CONTENT = _css('.entry-content')
+_X_ENTRY_TITLE = _css('h1.entry-title')
+_X_POSTER_IMG = _css('.entry-content-poster img')
+_X_STORY = _css('.entry-content-story')
+_X_RELATED_ITEMS = _css('.entry-content-related ul li')
+_X_A = _css('a')
+_X_P = _css('p')
+_X_BUTTON_GROUPS = _css('.entry-content-buttons')
+_X_SUB_BUTTONS = _css('.entry-sub-content-buttons')
+_X_A_SUB_BUTTONS = _css('a.entry-sub-content-buttons')
+_X_TAB_PANES = _css('.tab-content > .tab-pane')
+_X_ALPHABET_TITLE = _css('h4.alphabet-title')
+_X_TABLES = _css('table.table')
+_X_TR = _css('tr')
+_X_TR_1 = _css('tr:nth-child(1)')
+_X_TR_2 = _css('tr:nth-child(2)')
+_X_TR_3 = _css('tr:nth-child(3)')
+_X_CATEGORIES = _css('th a[data-title]')
+_X_ITEM_LINK = _css('th a.aa_ss_ops_new')
+_X_CLOCK = _css('th font.clock_font')
+_X_SUB_DDL = _css('th a.sub_ddl_box')
+_X_LANGS = _css('th span.tooltip3[data-title]')
+_X_TH_SPAN = _css('th span')
+_X_TH_SPAN_FIRST = _css('th > span:nth-child(1)')
+_X_TH_A = _css('th > a')
+
+
+def _select(elements: List[etree.ElementBase], xpath: etree.XPath) -> List[etree.ElementBase]:
+    return [e for element in elements for e in xpath(element)]
+
+
+def _text(elements: List[etree.ElementBase]) -> str:
+    return ' '.join(extract_text(e) for e in elements)
+
+
+def _attr(elements: List[etree.ElementBase], name: str) -> Optional[str]:
+    return elements[0].get(name) if elements else None
+
+
+def _link(base_url: str, link_text: str, href: Optional[str]):
+    return urljoin(base_url, href) if 'magnet' not in link_text.lower() else href
+
 
-    psplit = urlsplit(resp.url)
+def _parse_release_table(table: etree.ElementBase, base_url: str) -> dict:
+    # rows are indexed by their class tokens once, instead of a tr[class~=...] query for each resource
+    rows_by_class = defaultdict(list)
+    for row in _X_TR(table):
+        for cls in (row.get('class') or '').split():
+            rows_by_class[cls].append(row)
+
+    fst_row = _X_TR_1(table)
+    categories = [e.get('data-title') for e in _select(fst_row, _X_CATEGORIES)]
+    item_links = _select(fst_row, _X_ITEM_LINK)
+    ititle = _text(item_links).strip()
+    iurl = urljoin(base_url, _attr(item_links, 'href'))
+
+    if _text(_select(_X_TR_3(table), _X_CLOCK)).strip():
+        sec_row = _X_TR_2(table)
+        thr_row = _X_TR_3(table)
+    else:
+        sec_row = []
+        thr_row = _X_TR_2(table)
+
+    if sec_row:
+        sec_links = {}
+        for x in _select(sec_row, _X_SUB_DDL):
+            x_text = _text([x]).strip()
+            sec_links[x_text] = _link(base_url, x_text, _attr(_X_A(x), 'href'))
+        langs = [e.get('data-title') for e in _select(sec_row, _X_LANGS)]
+    else:
+        sec_links = {}
+        langs = []
+
+    publish_at_str = _text(_select(thr_row, _X_CLOCK))
+    published_at = parse_timestamp(publish_at_str)
+
+    rurls = {}
+    rx_maps = {}
+    for sitem in _select(thr_row, _X_TH_SPAN):
+        links = _X_A(sitem)
+        href = _attr(links, 'href')
+        if href:
+            rurls[_text(links).strip()] = _link(base_url, _text(links), href)
+        else:
+            rx_maps[_text(links)] = sitem.get('id')
+
+    for rx, rx_id in rx_maps.items():
+        rx_rows = rows_by_class[rx_id] if rx_id is not None else []
+        span_text = _text(_select(rx_rows, _X_TH_SPAN_FIRST))
+        span_segs = span_text.split('|', maxsplit=2)
+        size_text = None
+        ext_info = None
+        for seg in span_segs:
+            seg = seg.strip()
+            if 'size' in seg.lower():
+                size_text = seg.split(':', maxsplit=1)[-1].strip()
+            elif size_text is not None:
+                ext_info = seg
+
+        rurls[rx] = {
+            'size': size_text,
+            'ext': ext_info,
+        }
+        for ax in _select(rx_rows, _X_TH_A):
+            rurls[rx][_text([ax]).strip()] = _link(base_url, _text([ax]), ax.get('href'))
+
+    return {
+        'title': ititle,
+        'page_url': iurl,
+        'categories': categories,
+        'sec_links': sec_links,
+        'langs': langs,
+        'published_at': published_at,
+        'resource_urls': rurls,
+    }
+
+
+def parse_anime_info(html: str, page_url: str) -> dict:
+    """
+    Parse the anime page of erai-raws.
+
+    :param html: HTML text of the page.
+    :param page_url: Final URL of the page, used for the anime id and the relative links.
+    :returns: Information of the anime, including its releases in ``resources``.
+    """
+    root = lxml.html.fromstring(html)
+
+    psplit = urlsplit(page_url)
     assert psplit.path_segments[1] == 'anime-list'
     id_ = psplit.path_segments[2]
 
-    main = page('#main')
-    content = main('.entry-content')
-    title = main('h1.entry-title').text().strip()
-    poster_url = urljoin(resp.url, content('.entry-content-poster img').attr('src'))
-    story = content('.entry-content-story').text()
+    main = _X_MAIN(root)
+    content = _select(main, _X_ENTRY_CONTENT)
+    title = _text(_select(main, _X_ENTRY_TITLE)).strip()
+    poster_url = urljoin(page_url, _attr(_select(content, _X_POSTER_IMG), 'src'))
+    story = _text(_select(content, _X_STORY))
 
     related = []
-    for related_item in content('.entry-content-related ul li').items():
+    for related_item in _select(content, _X_RELATED_ITEMS):
+        links = _X_A(related_item)
         related.append({
-            'title': related_item('a').text().strip(),
-            'url': urljoin(resp.url, related_item('a').attr('href')),
+            'title': _text(links).strip(),
+            'url': urljoin(page_url, _attr(links, 'href')),
         })
 
     external_links = {}
     other_links = {}
     rss_url = None
-    for btn_group in content('.entry-content-buttons').items():
-        if 'more info:' in btn_group.text().lower():
-            for btn_item in btn_group('.entry-sub-content-buttons').items():
-                external_links[btn_item.text().strip()] = urljoin(resp.url, btn_item.attr('href'))
-        elif 'rss link' in btn_group.text().lower():
-            for pitem in btn_group('p').items():
-                if 'rss link' in pitem.text().lower() and 'ALL' in pitem.text():
-                    rss_url = urljoin(resp.url, pitem('a').attr('href'))
-        elif 'other:' in btn_group.text().lower():
-            for btn_item in btn_group('a.entry-sub-content-buttons').items():
-                other_links[btn_item.text().strip()] = urljoin(resp.url, btn_item.attr('href'))
+    for btn_group in _select(content, _X_BUTTON_GROUPS):
+        group_text = _text([btn_group]).lower()
+        if 'more info:' in group_text:
+            for btn_item in _X_SUB_BUTTONS(btn_group):
+                external_links[_text([btn_item]).strip()] = urljoin(page_url, btn_item.get('href'))
+        elif 'rss link' in group_text:
+            for pitem in _X_P(btn_group):
+                ptext = _text([pitem])
+                if 'rss link' in ptext.lower() and 'ALL' in ptext:
+                    rss_url = urljoin(page_url, _attr(_X_A(pitem), 'href'))
+        elif 'other:' in group_text:
+            for btn_item in _X_A_SUB_BUTTONS(btn_group):
+                other_links[_text([btn_item]).strip()] = urljoin(page_url, btn_item.get('href'))
 
     if 'MAL' in external_links:
         segments = urlsplit(external_links['MAL']).path_segments
@@ -86,96 +245,19 @@ def get_anime_info(anime_page_url: str, session: Optional[requests.Session] = No
         mal_id = None
 
     r_pane = None
-    for pane in main('.tab-content > .tab-pane').items():
-        if 'all release' in pane('h4.alphabet-title').text().strip().lower():
+    for pane in _select(main, _X_TAB_PANES):
+        if 'all release' in _text(_X_ALPHABET_TITLE(pane)).strip().lower():
             r_pane = pane
             break
 
     resources = []
-    if r_pane:
-        for table in r_pane('table.table').items():
-            fst_row = table('tr:nth-child(1)')
-            categories = [
-                c.attr('data-title')
-                for c in fst_row('th a[data-title]').items()
-            ]
-
-            ititle = fst_row('th a.aa_ss_ops_new').text().strip()
-            iurl = urljoin(resp.url, fst_row('th a.aa_ss_ops_new').attr('href'))
-
-            if table('tr:nth-child(3) th font.clock_font').text().strip():
-                sec_row = table('tr:nth-child(2)')
-                thr_row = table('tr:nth-child(3)')
-            else:
-                sec_row = None
-                thr_row = table('tr:nth-child(2)')
-
-            if sec_row:
-                sec_links = {
-                    x.text().strip(): urljoin(resp.url,
-                                              x('a').attr('href')) if 'magnet' not in x.text().strip().lower() else x(
-                        'a').attr('href')
-                    for x in sec_row('th a.sub_ddl_box').items()
-                }
-                langs = [
-                    x.attr('data-title')
-                    for x in sec_row('th span.tooltip3[data-title]').items()
-                ]
-            else:
-                sec_links = {}
-                langs = []
-
-            publish_at_str = thr_row('th font.clock_font').text()
-            published_at = dateparser.parse(publish_at_str).timestamp()
-
-            rurls = {}
-            rx_maps = {}
-            for sitem in thr_row('th span').items():
-                if sitem('a').attr('href'):
-                    rurls[sitem('a').text().strip()] = \
-                        urljoin(resp.url, sitem('a').attr('href')) if 'magnet' not in sitem(
-                            'a').text().lower() else sitem(
-                            'a').attr('href')
-                else:
-                    rx = sitem('a').text()
-                    rx_maps[rx] = sitem.attr('id')
-
-            if rx_maps:
-                for rx, rx_id in rx_maps.items():
-                    span_text = table(f'tr[class~={json.dumps(rx_id)}] th > span:nth-child(1)').text()
-                    span_segs = span_text.split('|', maxsplit=2)
-                    size_text = None
-                    ext_info = None
-                    for seg in span_segs:
-                        seg = seg.strip()
-                        if 'size' in seg.lower():
-                            size_text = seg.split(':', maxsplit=1)[-1].strip()
-                        elif size_text is not None:
-                            ext_info = seg
-
-                    rurls[rx] = {
-                        'size': size_text,
-                        'ext': ext_info,
-                    }
-                    for ax in table(f'tr[class~={json.dumps(rx_id)}] th > a').items():
-                        rurls[rx][ax.text().strip()] = \
-                            urljoin(resp.url, ax.attr('href')) if 'magnet' not in ax.text().lower() else \
-                                ax.attr('href')
-
-            item = {
-                'title': ititle,
-                'page_url': iurl,
-                'categories': categories,
-                'sec_links': sec_links,
-                'langs': langs,
-                'published_at': published_at,
-                'resource_urls': rurls,
-            }
-            resources.append(item)
+    if r_pane is not None:
+        for table in _X_TABLES(r_pane):
+            resources.append(_parse_release_table(table, page_url))
 
     return {
         'id': id_,
-        'page_url': resp.url,
+        'page_url': page_url,
         'mal_id': mal_id,
         'title': title,
         'poster_url': poster_url,
@@ -190,6 +272,13 @@ def get_anime_info(anime_page_url: str, session: Optional[requests.Session] = No
     }
 
 
+def get_anime_info(anime_page_url: str, session: Optional[requests.Session] = None,
+                   session_rss: Optional[Union[List[requests.Session], requests.Session]] = None):
+    session = session or get_session(no_login=False)
+    resp = srequest(session, 'GET', anime_page_url)
+    return parse_anime_info(resp.text, resp.url)
+
+
 if __name__ == '__main__':
     logging.try_init_root(logging.INFO)
     session = get_session()
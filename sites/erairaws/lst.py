@@ -1,28 +1,60 @@
-import datetime
+import multiprocessing
 import os.path
-from threading import Lock
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import Optional
 from urllib.parse import unquote_plus, quote
 
 import numpy as np
 import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from ditk import logging
 from hbutils.string import plural_word
 from hbutils.system import TemporaryDirectory, urlsplit
 from hfutils.cache import delete_detached_cache
-from hfutils.operate import download_directory_as_directory, get_hf_client, get_hf_fs, upload_directory_as_directory
-from hfutils.utils import number_to_tag
-from huggingface_hub import hf_hub_url
+from hfutils.operate import download_directory_as_directory, get_hf_client, get_hf_fs
+from hfutils.utils import number_to_tag, walk_files
+from tqdm import tqdm
 
-from .info import get_session, iter_anime_items, get_anime_info
-from ..utils import parallel_call, download_file
+from .info import get_session, iter_anime_items, parse_anime_info, aget_rss_last_published_at
+from .schema import animes_to_table, items_to_table, links_to_table, table_to_animes, table_to_items
+from ..utils import async_call, async_map, adownload_file, get_http_cache, asrequest, \
+    AssetManifest, upload_changed_files, hf_file_urls, md_link, md_image, write_markdown_table, date_parse_counts, \
+    add_date_parse_counts, date_parse_stats
 
 
 def _url_safe(url):
     return quote(unquote_plus(url), safe=':/?#[]@!$&\'()*+,;=').replace('(', '%28').replace(')', '%29')
 
 
-def sync(repository: str, proxy_pool: Optional[str] = None):
+def _md_named_link(name: str, urls: pd.Series) -> pd.Series:
+    return md_link(pd.Series(name, index=urls.index), urls).where(urls.notnull(), '')
+
+
+def _parse_page(html: str, page_url: str):
+    # runs in the parsing processes, their date parsing counts are sent back with the results
+    fast_count, fallback_count = date_parse_counts()
+    info = parse_anime_info(html, page_url)
+    new_fast_count, new_fallback_count = date_parse_counts()
+    return info, (new_fast_count - fast_count, new_fallback_count - fallback_count)
+
+
+def _get_shown_resource_urls(resource_urls: dict) -> dict:
+    # the links of the resolutions are shown by their torrents
+    return {
+        name: value if isinstance(value, str) else value.get('torrent')
+        for name, value in resource_urls.items()
+    }
+
+
+def _isoformat(timestamps: pd.Series) -> pd.Series:
+    return pd.to_datetime(timestamps, unit='s').dt.strftime('%Y-%m-%dT%H:%M:%S').fillna('N/A')
+
+
+def sync(repository: str, proxy_pool: Optional[str] = None, use_http_cache: bool = True,
+         incremental: bool = True, fetch_concurrency: int = 128, parse_workers: Optional[int] = None,
+         download_concurrency: int = 128):
     delete_detached_cache()
     hf_client = get_hf_client()
     hf_fs = get_hf_fs()
@@ -37,7 +69,7 @@ def sync(repository: str, proxy_pool: Optional[str] = None):
             os.linesep.join(attr_lines),
         )
 
-    session = get_session(no_login=False)
+    session = get_session(no_login=False, cache=get_http_cache() if use_http_cache else None)
     session_rss = [get_session(no_login=True) for _ in range(100)]
     if proxy_pool:
         logging.info(f'Proxy pool {proxy_pool!r} enabled.')
@@ -51,32 +83,112 @@ def sync(repository: str, proxy_pool: Optional[str] = None):
                 'https': proxy_pool
             })
 
+    d_prev_animes = {}
+    if incremental and hf_client.file_exists(repo_id=repository, repo_type='dataset', filename='animes.parquet'):
+        prev_animes = table_to_animes(pq.read_table(hf_client.hf_hub_download(
+            repo_id=repository,
+            repo_type='dataset',
+            filename='animes.parquet',
+        )))
+        d_prev_resources = defaultdict(list)
+        if prev_animes and 'resources' not in prev_animes[0]:
+            for iitem in table_to_items(pq.read_table(hf_client.hf_hub_download(
+                    repo_id=repository,
+                    repo_type='dataset',
+                    filename='items.parquet',
+            ))):
+                iitem.pop('mal_id')
+                d_prev_resources[iitem.pop('anime_id')].append(iitem)
+
+        for aitem in prev_animes:
+            if 'resources' not in aitem:
+                # files written without the releases inside the anime records
+                aitem['resources'] = d_prev_resources[aitem['id']]
+            d_prev_animes[aitem['id']] = aitem
+        logging.info(f'{plural_word(len(d_prev_animes), "previous anime")} loaded for incremental sync.')
+
     anime_items = list(iter_anime_items(session=session))
-    anime_records = []
-    item_records = []
-    lock = Lock()
 
-    def _fn_x(ax):
+    async def _afn_fetch(ax):
         title, page_url = ax
-        logging.info(f'Processing {title!r}, page: {page_url!r} ...')
-        info = get_anime_info(page_url, session=session, session_rss=session_rss)
+        prev = d_prev_animes.get(urlsplit(page_url).path_segments[2])
+
+        # the rss is fetched before the page, so a release published in between will be detected next time
+        rss_last_published_at = None
+        if prev is not None and prev.get('rss_url'):
+            try:
+                rss_last_published_at = await aget_rss_last_published_at(prev['rss_url'], session=session_rss)
+            except Exception as err:
+                logging.warning(f'Unable to check rss of {page_url!r}, page will be scraped - {err!r}')
+            else:
+                if prev.get('rss_last_published_at') is not None and \
+                        rss_last_published_at == prev['rss_last_published_at']:
+                    logging.info(f'No new release for {title!r}, previous record reused.')
+                    return prev, None, None
+
+        logging.info(f'Fetching {title!r}, page: {page_url!r} ...')
+        resp = await asrequest(session, 'GET', page_url)
+        return prev, rss_last_published_at, (resp.text, resp.url)
+
+    def _make_record(info, prev, rss_last_published_at):
         if not info['mal_id']:
-            logging.warning(f'No MAL ID found for {page_url!r}, skipped.')
-            return
-
-        with lock:
-            _, ext = os.path.splitext(urlsplit(info['poster_url']).filename)
-            anime_records.append({
-                **info,
-                'poster_filename': f'{info["id"]}{ext}',
+            logging.warning(f'No MAL ID found for {info["page_url"]!r}, skipped.')
+            return None
+        if prev is None or info['rss_url'] != prev.get('rss_url'):
+            rss_last_published_at = None
+
+        _, ext = os.path.splitext(urlsplit(info['poster_url']).filename)
+        return {
+            **info,
+            'rss_last_published_at': rss_last_published_at,
+            'poster_filename': f'{info["id"]}{ext}',
+        }
+
+    anime_records = []
+    item_records = []
+
+    def _append_record(record):
+        anime_records.append(record)
+        for item in record['resources']:
+            item_records.append({
+                'mal_id': record['mal_id'],
+                'anime_id': record['id'],
+                **item,
             })
-            for item in info['resources']:
-                item_records.append({
-                    'mal_id': info['mal_id'],
-                    **item,
-                })
 
-    parallel_call(anime_items, _fn_x, desc='Animes')
+    # pages are fetched concurrently in the event loop thread, and parsed by the processes as soon as they arrive,
+    # so the parsing is not serialized behind the GIL with the network io,
+    # the workers are not forked from this process, forking while the other threads hold locks may deadlock
+    reused_count, scraped_count = 0, 0
+    parse_futures = {}
+    mp_context = multiprocessing.get_context(
+        'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+    with ProcessPoolExecutor(max_workers=parse_workers, mp_context=mp_context) as pp:
+        for (title, page_url), (prev, rss_last_published_at, page) in \
+                async_map(anime_items, _afn_fetch, desc='Animes', max_concurrency=fetch_concurrency):
+            if page is None:
+                reused_count += 1
+                _append_record(prev)
+            else:
+                future = pp.submit(_parse_page, *page)
+                parse_futures[future] = (title, prev, rss_last_published_at)
+
+        for future in tqdm(as_completed(parse_futures), total=len(parse_futures), desc='Parse Pages'):
+            title, prev, rss_last_published_at = parse_futures[future]
+            try:
+                info, date_counts = future.result()
+                add_date_parse_counts(*date_counts)
+                record = _make_record(info, prev, rss_last_published_at)
+            except Exception as err:
+                logging.error(f'Error when parsing page of {title!r} - {err!r}', exc_info=err)
+                continue
+            if record is not None:
+                scraped_count += 1
+                _append_record(record)
+
+    logging.info(f'{plural_word(scraped_count, "anime page")} scraped, '
+                 f'{plural_word(reused_count, "unchanged anime")} reused.')
+    logging.info(f'Date parsing: {date_parse_stats()}.')
 
     # for title, page_url in tqdm(anime_items, desc='Animes'):
     #     logging.info(f'Processing {title!r}, page: {page_url!r} ...')
@@ -98,13 +210,20 @@ def sync(repository: str, proxy_pool: Optional[str] = None):
     #         })
 
     with TemporaryDirectory() as upload_dir:
+        # written with the explicit schemas, instead of the structs inferred from the nested python objects
+        animes_table = animes_to_table(anime_records).sort_by([('mal_id', 'descending')])
+        pq.write_table(animes_table, os.path.join(upload_dir, 'animes.parquet'))
         df_animes = pd.DataFrame(anime_records)
         df_animes = df_animes.sort_values(by=['mal_id'], ascending=[False])
-        df_animes.to_parquet(os.path.join(upload_dir, 'animes.parquet'))
 
+        items_table = items_to_table(item_records).sort_by([('mal_id', 'descending'), ('published_at', 'descending')])
+        pq.write_table(items_table, os.path.join(upload_dir, 'items.parquet'))
         df_items = pd.DataFrame(item_records)
         df_items = df_items.sort_values(by=['mal_id', 'published_at'], ascending=[False, False])
-        df_items.to_parquet(os.path.join(upload_dir, 'items.parquet'))
+
+        # one row for each link, for filtering by resolution or size without unpacking the resource_urls
+        links_table = links_to_table(item_records).sort_by([('mal_id', 'descending'), ('published_at', 'descending')])
+        pq.write_table(links_table, os.path.join(upload_dir, 'links.parquet'))
 
         images_dir = os.path.join(upload_dir, 'images')
         os.makedirs(images_dir, exist_ok=True)
@@ -114,20 +233,26 @@ def sync(repository: str, proxy_pool: Optional[str] = None):
             local_directory=images_dir,
             dir_in_repo='images',
         )
+        # only the new posters and the changed files are uploaded, see AssetManifest
+        asset_manifest = AssetManifest(upload_dir)
+        asset_manifest.mark_uploaded([f'images/{file}' for file in walk_files(images_dir)])
 
-        def _fn_download_poster(aitem):
+        async def _afn_download_poster(aitem):
             poster_url = aitem['poster_url']
             dst_filename = os.path.join(images_dir, aitem['poster_filename'])
             if os.path.exists(dst_filename):
                 return
 
-            download_file(
+            await adownload_file(
                 url=poster_url,
                 filename=dst_filename,
                 session=session,
+                resume=False,
+                silent=True,
             )
 
-        parallel_call(df_animes.to_dict('records'), _fn_download_poster, desc='Download Posters')
+        async_call(df_animes.to_dict('records'), _afn_download_poster, desc='Download Posters',
+                   max_concurrency=download_concurrency)
 
         with open(os.path.join(upload_dir, 'README.md'), 'w') as f:
             print('---', file=f)
@@ -151,89 +276,60 @@ def sync(repository: str, proxy_pool: Optional[str] = None):
             print(f'This is the information integration of erai-raws and myanimelist.', file=f)
             print(f'', file=f)
 
-            animes_shown = []
-            ext_names = []
-            for aitem in df_animes.to_dict('records'):
-                ext_names.extend(aitem['external_links'])
-            ext_names = sorted(set(ext_names))
-            for aitem in df_animes[~df_animes['published_at'].isnull()][:500].replace(np.nan, None).to_dict('records'):
-                poster_shown_url = hf_hub_url(
-                    repo_id=repository,
-                    repo_type='dataset',
-                    filename=f'images/{aitem["poster_filename"]}'
-                )
-                animes_shown.append({
-                    'ID': aitem['mal_id'],
-                    'Post': f'[![{aitem["id"]}]({poster_shown_url})]({aitem["external_links"]["MAL"]})',
-                    'Bangumi': f'[{aitem["title"]}]({aitem["page_url"]})',
-                    'RSS': f'[RSS]({aitem["rss_url"]})' if aitem['rss_url'] else '',
-                    **{
-                        extname: f'[{extname}]({aitem["external_links"][extname]})'
-                        if aitem["external_links"].get(extname) else ''
-                        for extname in ext_names
-                    },
-                    'Resources': len(aitem["resources"]),
-                    'Published At': (datetime.datetime.fromtimestamp(aitem['published_at']).isoformat()
-                                     if aitem['published_at'] else 'N/A'),
-                    'Last Published At': (datetime.datetime.fromtimestamp(aitem['last_published_at']).isoformat()
-                                          if aitem['last_published_at'] else 'N/A'),
-                })
-            df_animes_shown = pd.DataFrame(animes_shown)
+            # names of the links are collected from the map columns of the arrow tables
+            ext_names = sorted(pc.unique(animes_table['external_links'].combine_chunks().keys).to_pylist())
+            df_shown = df_animes[~df_animes['published_at'].isnull()][:500].replace(np.nan, None)
+            df_ext_links = pd.DataFrame(df_shown['external_links'].tolist(), index=df_shown.index, columns=ext_names)
+            poster_urls = hf_file_urls('images/' + df_shown['poster_filename'], repo_id=repository)
+            df_animes_shown = pd.DataFrame({
+                'ID': df_shown['mal_id'],
+                'Post': md_link(md_image(df_shown['id'], poster_urls), df_ext_links['MAL']),
+                'Bangumi': md_link(df_shown['title'], df_shown['page_url']),
+                'RSS': _md_named_link('RSS', df_shown['rss_url']),
+                **{extname: _md_named_link(extname, df_ext_links[extname]) for extname in ext_names},
+                'Resources': df_shown['resources'].map(len),
+                'Published At': _isoformat(df_shown['published_at']),
+                'Last Published At': _isoformat(df_shown['last_published_at']),
+            })
 
             print(f'# Animes', file=f)
             print(f'', file=f)
             print(f'{plural_word(len(df_animes), "anime")} in total, '
                   f'{plural_word(len(df_animes_shown), "anime")} shown.', file=f)
             print(f'', file=f)
-            print(df_animes_shown.to_markdown(index=False), file=f)
+            write_markdown_table(f, df_animes_shown)
             print(f'', file=f)
 
-            sec_names = []
-            res_names = []
-            for iitem in df_items.to_dict('records'):
-                sec_names.extend(iitem['sec_links'].keys())
-                res_names.extend(iitem['resource_urls'].keys())
-            sec_names = sorted(set(sec_names))
-            res_names = sorted(set(res_names))
-
-            items_shown = []
-            for iitem in df_items[:50].to_dict('records'):
-                items_shown.append({
-                    'Anime ID': iitem['mal_id'],
-                    'Title': f'[{iitem["title"]}]({iitem["page_url"]})',
-                    'Categories': ", ".join(iitem['categories']),
-                    'Langs': ", ".join(iitem['langs']),
-                    **{
-                        name: (
-                            f'[{name}]({_url_safe(iitem["sec_links"][name])})'
-                            if iitem["sec_links"].get(name) else ''
-                        ) for name in sec_names
-                    },
-                    **{
-                        name: (
-                            f'[{name}]({_url_safe(iitem["resource_urls"][name])})'
-                            if isinstance(iitem["resource_urls"][name], str) else
-                            f'[{name}]({_url_safe(iitem["resource_urls"][name]["torrent"])})'
-                        ) if iitem["resource_urls"].get(name) else ''
-                        for name in res_names
-                    },
-                    'Published At': datetime.datetime.fromtimestamp(iitem['published_at']).isoformat(),
-                })
-            df_items_shown = pd.DataFrame(items_shown)
+            sec_names = sorted(pc.unique(items_table['sec_links'].combine_chunks().keys).to_pylist())
+            res_names = sorted(pc.unique(items_table['resource_urls'].combine_chunks().keys).to_pylist())
+            df_shown = df_items[:50]
+            df_sec_links = pd.DataFrame(df_shown['sec_links'].tolist(), index=df_shown.index, columns=sec_names)
+            df_res_links = pd.DataFrame(df_shown['resource_urls'].map(_get_shown_resource_urls).tolist(),
+                                        index=df_shown.index, columns=res_names)
+            df_items_shown = pd.DataFrame({
+                'Anime ID': df_shown['mal_id'],
+                'Title': md_link(df_shown['title'], df_shown['page_url']),
+                'Categories': df_shown['categories'].str.join(', '),
+                'Langs': df_shown['langs'].str.join(', '),
+                **{name: _md_named_link(name, df_sec_links[name].map(_url_safe, na_action='ignore'))
+                   for name in sec_names},
+                **{name: _md_named_link(name, df_res_links[name].map(_url_safe, na_action='ignore'))
+                   for name in res_names},
+                'Published At': _isoformat(df_shown['published_at']),
+            })
 
             print(f'# Resources', file=f)
             print(f'', file=f)
             print(f'{plural_word(len(df_items), "resource")} in total, '
                   f'{plural_word(len(df_items_shown), "resource")} shown.', file=f)
             print(f'', file=f)
-            print(df_items_shown.to_markdown(index=False), file=f)
+            write_markdown_table(f, df_items_shown)
             print(f'', file=f)
 
-        upload_directory_as_directory(
+        upload_changed_files(
+            asset_manifest,
             repo_id=repository,
             repo_type='dataset',
-            local_directory=upload_dir,
-            path_in_repo='.',
             message=f'Syncing {plural_word(len(df_animes), "anime")} into index',
         )
 
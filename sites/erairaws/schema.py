@@ -0,0 +1,256 @@
+import datetime
+import re
+from typing import List, Optional, Dict, Any
+
+import pyarrow as pa
+
+from ..utils import to_plain
+
+_STR_MAP = pa.map_(pa.string(), pa.string())
+_TIMESTAMP = pa.timestamp('ms', tz='UTC')
+_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+# the plain url links of a resolution only have ``url``, the others have the size, extra info and links
+_RESOURCE_URL = pa.struct([
+    ('url', pa.string()),
+    ('size', pa.string()),
+    ('ext', pa.string()),
+    ('links', _STR_MAP),
+])
+
+# the releases of the animes, also the rows of the items table without ``mal_id`` and ``anime_id``
+_RESOURCE_FIELDS = [
+    ('title', pa.string()),
+    ('page_url', pa.string()),
+    ('categories', pa.list_(_CATEGORY)),
+    ('langs', pa.list_(_CATEGORY)),
+    ('sec_links', _STR_MAP),
+    ('resource_urls', pa.map_(pa.string(), _RESOURCE_URL)),
+    ('published_at', _TIMESTAMP),
+]
+
+ANIMES_SCHEMA = pa.schema([
+    ('id', pa.string()),
+    ('page_url', pa.string()),
+    ('mal_id', pa.int64()),
+    ('title', pa.string()),
+    ('poster_url', pa.string()),
+    ('poster_filename', pa.string()),
+    ('story', pa.string()),
+    ('external_links', _STR_MAP),
+    ('other_links', _STR_MAP),
+    ('related', pa.list_(pa.struct([('title', pa.string()), ('url', pa.string())]))),
+    ('rss_url', pa.string()),
+    ('resources', pa.list_(pa.struct(_RESOURCE_FIELDS))),
+    ('resource_count', pa.int32()),
+    ('published_at', _TIMESTAMP),
+    ('last_published_at', _TIMESTAMP),
+    ('rss_last_published_at', _TIMESTAMP),
+])
+
+ITEMS_SCHEMA = pa.schema([
+    ('mal_id', pa.int64()),
+    ('anime_id', pa.string()),
+    *_RESOURCE_FIELDS,
+])
+
+LINKS_SCHEMA = pa.schema([
+    ('mal_id', pa.int64()),
+    ('anime_id', pa.string()),
+    ('item_title', pa.string()),
+    ('item_page_url', pa.string()),
+    ('published_at', _TIMESTAMP),
+    ('resolution', _CATEGORY),
+    ('kind', _CATEGORY),
+    ('url', pa.string()),
+    ('size_text', pa.string()),
+    ('size', pa.int64()),
+    ('ext', _CATEGORY),
+])
+
+# the commas are thousands separators, so the ambiguous decimal commas (e.g. ``1,4 GiB``) are not matched
+_SIZE_PATTERN = re.compile(r'\s*(?P<value>\d{1,3}(?:,\d{3})+(?:\.\d+)?|\d+(?:\.\d+)?)\s*(?P<unit>[KMGT]?)i?B\s*',
+                           re.IGNORECASE)
+_SIZE_UNITS = {'': 0, 'K': 1, 'M': 2, 'G': 3, 'T': 4}
+
+
+def parse_size(size_text: Optional[str]) -> Optional[int]:
+    """
+    Parse the size texts of erai-raws (e.g. ``1.4 GiB``, ``350MB`` or ``1,400 MB``) into bytes, the units are binary.
+
+    :param size_text: Size text.
+    :type size_text: Optional[str]
+    :returns: Size in bytes, ``None`` when unknown.
+    :rtype: Optional[int]
+    """
+    matching = _SIZE_PATTERN.fullmatch(size_text or '')
+    if not matching:
+        return None
+    value = float(matching.group('value').replace(',', ''))
+    return int(round(value * 1024 ** _SIZE_UNITS[matching.group('unit').upper()]))
+
+
+def _to_datetime(ts: Optional[float]) -> Optional[datetime.datetime]:
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc) if ts is not None else None
+
+
+def _from_datetime(dt: Optional[datetime.datetime]) -> Optional[float]:
+    return dt.timestamp() if dt is not None else None
+
+
+def _to_dict(value) -> Dict[str, Any]:
+    # maps are read back as key-value pairs, and the structs of the legacy files as dicts with all fields
+    if not value:
+        return {}
+    elif isinstance(value, dict):
+        return {key: v for key, v in value.items() if v is not None}
+    else:
+        return dict(value)
+
+
+def _pack_resource_url(value) -> dict:
+    if isinstance(value, str):
+        return {'url': value}
+    value = dict(value)
+    return {'size': value.pop('size', None), 'ext': value.pop('ext', None), 'links': value}
+
+
+def _unpack_resource_url(value: dict):
+    if value.get('url') is not None:
+        return value['url']
+    return {'size': value['size'], 'ext': value['ext'], **_to_dict(value['links'])}
+
+
+def _pack_item(record: dict) -> dict:
+    return {
+        **record,
+        'resource_urls': {name: _pack_resource_url(value) for name, value in record['resource_urls'].items()},
+        'published_at': _to_datetime(record['published_at']),
+    }
+
+
+def _unpack_item(record: dict) -> dict:
+    record['categories'] = record['categories'] or []
+    record['langs'] = record['langs'] or []
+    record['sec_links'] = _to_dict(record['sec_links'])
+    record['resource_urls'] = {
+        name: _unpack_resource_url(value)
+        for name, value in _to_dict(record['resource_urls']).items()
+    }
+    record['published_at'] = _from_datetime(record['published_at'])
+    return record
+
+
+def animes_to_table(records: List[dict]) -> pa.Table:
+    """
+    Build the typed table of the anime records, with their releases in ``resources``,
+    see :func:`items_to_table` for the flat table of them.
+
+    :param records: Anime records.
+    :type records: List[dict]
+    :returns: Table in :data:`ANIMES_SCHEMA`.
+    :rtype: pa.Table
+    """
+    return pa.Table.from_pylist([
+        {
+            **record,
+            'resources': [_pack_item(item) for item in record['resources']],
+            'resource_count': len(record['resources']),
+            'published_at': _to_datetime(record['published_at']),
+            'last_published_at': _to_datetime(record['last_published_at']),
+            'rss_last_published_at': _to_datetime(record.get('rss_last_published_at')),
+        } for record in records
+    ], schema=ANIMES_SCHEMA)
+
+
+def items_to_table(records: List[dict]) -> pa.Table:
+    """
+    Build the typed table of the release records.
+
+    :param records: Release records, with ``mal_id`` and ``anime_id``.
+    :type records: List[dict]
+    :returns: Table in :data:`ITEMS_SCHEMA`.
+    :rtype: pa.Table
+    """
+    return pa.Table.from_pylist([_pack_item(record) for record in records], schema=ITEMS_SCHEMA)
+
+
+def table_to_animes(table: pa.Table) -> List[dict]:
+    """
+    Read the anime records back from the table.
+    The legacy files with inferred schemas are also supported, and the records of the files
+    without ``resources`` have no releases, see :func:`table_to_items` for them.
+
+    :param table: Table of :func:`animes_to_table`.
+    :type table: pa.Table
+    :returns: Anime records.
+    :rtype: List[dict]
+    """
+    retval = []
+    for record in table.to_pylist():
+        for key in ['external_links', 'other_links']:
+            record[key] = _to_dict(record[key])
+        record['related'] = record['related'] or []
+        for key in ['published_at', 'last_published_at', 'rss_last_published_at']:
+            if isinstance(record.get(key), datetime.datetime):
+                record[key] = _from_datetime(record[key])
+        if 'resource_count' not in record:
+            # legacy files with inferred schemas
+            record['resources'] = to_plain(record.get('resources') or [], drop_none=True)
+        elif 'resources' in record:
+            record['resources'] = [_unpack_item(item) for item in record['resources'] or []]
+        record.pop('resource_count', None)
+        retval.append(record)
+    return retval
+
+
+def table_to_items(table: pa.Table) -> List[dict]:
+    """
+    Read the release records back from the table.
+
+    :param table: Table of :func:`items_to_table`.
+    :type table: pa.Table
+    :returns: Release records.
+    :rtype: List[dict]
+    """
+    return [_unpack_item(record) for record in table.to_pylist()]
+
+
+def _iter_links(record: dict):
+    for name, value in record['resource_urls'].items():
+        if isinstance(value, str):
+            yield None, name, value, None, None
+        else:
+            value = dict(value)
+            size_text, ext = value.pop('size', None), value.pop('ext', None)
+            for kind, url in value.items():
+                yield name, kind, url, size_text, ext
+
+
+def links_to_table(records: List[dict]) -> pa.Table:
+    """
+    Build the normalized link table of the release records, one row for each link of each resolution.
+    The plain links of the releases have no ``resolution``.
+
+    :param records: Release records, with ``mal_id`` and ``anime_id``.
+    :type records: List[dict]
+    :returns: Table in :data:`LINKS_SCHEMA`.
+    :rtype: pa.Table
+    """
+    return pa.Table.from_pylist([
+        {
+            'mal_id': record['mal_id'],
+            'anime_id': record['anime_id'],
+            'item_title': record['title'],
+            'item_page_url': record['page_url'],
+            'published_at': _to_datetime(record['published_at']),
+            'resolution': resolution,
+            'kind': kind,
+            'url': url,
+            'size_text': size_text,
+            'size': parse_size(size_text),
+            'ext': ext,
+        }
+        for record in records
+        for resolution, kind, url, size_text, ext in _iter_links(record)
+    ], schema=LINKS_SCHEMA)
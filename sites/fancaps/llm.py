@@ -2,14 +2,15 @@ import io
 import json
 import re
 from collections import defaultdict
-from pprint import pprint, pformat
-from typing import Optional, List
+from pprint import pprint
+from typing import Optional, List, Tuple, Sequence
 
 import requests
 from ditk import logging
 from hbutils.string import plural_word
 
-from ..utils import get_openai_client, get_items_from_myanimelist, get_requests_session
+from ..utils import get_items_from_myanimelist, get_requests_session, parallel_vote, batch_vote, ask_llm, \
+    format_candidates, prematch
 
 _DEFAULT_MODEL = 'openai/gpt-4o'
 
@@ -60,10 +61,23 @@ DO NOT OUTPUT ANYTHING ELSE EXCEPT THESE, MAKE SURE THE OUTPUT CAN BE PROCESSED
 NO MATTER YOU FIND THE MATCH OR NOT, PLEASE DESCRIBE YOU REASONS AND WHY YOU GIVE THIS ANSWER. 
 """
 
+_BATCH_SYSTEM_TEXT = _SYSTEM_TEXT + """
+SEVERAL ANIMES MAY BE PROVIDED IN ONE MESSAGE, EACH ONE STARTS WITH A LINE LIKE "### Anime #1", 
+AND HAS ITS OWN SEARCH RESULT. IN THIS CASE, ANSWER EVERY ANIME SEPARATELY IN THE SAME ORDER, 
+START EACH ANSWER WITH ITS OWN LINE ("### Anime #1", "### Anime #2", ...), FOLLOWED BY THE FORMAT ABOVE.
+"""
+
 _NOT_SET = object()
 
 
-def _parse_output(output: str):
+def _parse_output(output: str, batch_size: Optional[int] = None):
+    if batch_size is not None:
+        segments = re.split(r'^\s*#+\s*Anime\s*#(\d+)\s*$', output.strip(), flags=re.MULTILINE)
+        d_sections = {int(segments[i]): segments[i + 1] for i in range(1, len(segments), 2)}
+        assert sorted(d_sections) == list(range(1, batch_size + 1)), \
+            f'Answers of anime #1 - #{batch_size} expected, but {sorted(d_sections)!r} found'
+        return [_parse_output(d_sections[i]) for i in range(1, batch_size + 1)]
+
     mal_id, title, year, reason = _NOT_SET, _NOT_SET, _NOT_SET, _NOT_SET
     for line in output.strip().splitlines(keepends=False):
         line = line.strip()
@@ -98,16 +112,10 @@ def _parse_output(output: str):
     }
 
 
-def _ask_chatgpt(bg_item, search_result: Optional[List[dict]] = None,
-                 model_name: str = _DEFAULT_MODEL, max_tries: int = 5):
-    client = get_openai_client()
+def _make_message(bg_item, search_result: List[dict], candidate_fields: Optional[Sequence[str]] = None) -> str:
     title = bg_item['title']
     episode_titles = [x['title'] for x in bg_item['episodes']]
 
-    if search_result is None:
-        search_result = get_items_from_myanimelist(title)
-    d_items = {item['mal_id']: item for item in search_result}
-
     with io.StringIO() as sf:
         print(f'Anime Title: {title!r}', file=sf)
         print(f'', file=sf)
@@ -119,40 +127,47 @@ def _ask_chatgpt(bg_item, search_result: Optional[List[dict]] = None,
             print(f'', file=sf)
 
         print(f'Search Result:', file=sf)
-        print(pformat(search_result), file=sf)
+        print(format_candidates(search_result, fields=candidate_fields), file=sf)
         print(f'', file=sf)
 
-        message = sf.getvalue()
+        return sf.getvalue()
+
+
+def _to_result(pinfo: dict, search_result: List[dict]) -> dict:
+    d_items = {item['mal_id']: item for item in search_result}
+    if pinfo['mal_id'] and pinfo['mal_id'] in d_items:
+        return {
+            **pinfo,
+            'year': d_items[pinfo['mal_id']]['year'] or pinfo['year'],
+            'mal': d_items[pinfo['mal_id']],
+        }
+    else:
+        return {
+            'mal_id': None,
+            'title': None,
+            'reason': pinfo['reason'],
+            'year': pinfo['year'],
+            'mal': None,
+        }
+
+
+def _ask_chatgpt(bg_item, search_result: Optional[List[dict]] = None,
+                 model_name: str = _DEFAULT_MODEL, max_tries: int = 5, sample_index: int = 0,
+                 use_cache: bool = True, candidate_fields: Optional[Sequence[str]] = None):
+    title = bg_item['title']
+    if search_result is None:
+        search_result = get_items_from_myanimelist(title)
+    message = _make_message(bg_item, search_result, candidate_fields=candidate_fields)
 
     tries = 0
     while tries < max_tries:
         logging.info(f'Asking LLM model {model_name!r} about {title!r} ...')
         try:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {'role': 'system', 'content': _SYSTEM_TEXT},
-                    {"role": "user", "content": message},
-                ],
-            )
-            resp_text = response.choices[0].message.content.strip()
+            # retried answers are asked again, the cached one may be the unparsable one
+            resp_text = ask_llm(_SYSTEM_TEXT, message, model_name=model_name, sample_index=sample_index,
+                                use_cache=use_cache, refresh=tries > 0)
             logging.info(f'Response from LLM:\n{resp_text}')
-
-            pinfo = _parse_output(resp_text)
-            if pinfo['mal_id'] and pinfo['mal_id'] in d_items:
-                return {
-                    **pinfo,
-                    'year': d_items[pinfo['mal_id']]['year'] or pinfo['year'],
-                    'mal': d_items[pinfo['mal_id']],
-                }
-            else:
-                return {
-                    'mal_id': None,
-                    'title': None,
-                    'reason': pinfo['reason'],
-                    'year': pinfo['year'],
-                    'mal': None,
-                }
+            return _to_result(_parse_output(resp_text), search_result)
         except Exception as err:
             tries += 1
             logging.error(f'({tries}/{max_tries}) Error when parsing output - {err!r}')
@@ -161,18 +176,37 @@ def _ask_chatgpt(bg_item, search_result: Optional[List[dict]] = None,
     raise RuntimeError(f'Unable to get result for {title!r}')
 
 
-def get_full_info_for_fancaps(bg_item, model_name: str = _DEFAULT_MODEL, val_times: int = 5, min_val: int = 4,
-                              session: Optional[requests.Session] = None):
-    session = session or get_requests_session()
-    search_result = get_items_from_myanimelist(bg_item['title'], session=session)
+def _ask_chatgpt_batch(items: List[Tuple[dict, List[dict]]], model_name: str = _DEFAULT_MODEL,
+                       max_tries: int = 5, sample_index: int = 0, use_cache: bool = True,
+                       candidate_fields: Optional[Sequence[str]] = None) -> List[dict]:
+    with io.StringIO() as sf:
+        for i, (bg_item, search_result) in enumerate(items, start=1):
+            print(f'### Anime #{i}', file=sf)
+            print(f'', file=sf)
+            print(_make_message(bg_item, search_result, candidate_fields=candidate_fields), file=sf)
+        message = sf.getvalue()
+
+    tries = 0
+    while tries < max_tries:
+        logging.info(f'Asking LLM model {model_name!r} about {plural_word(len(items), "anime")} ...')
+        try:
+            resp_text = ask_llm(_BATCH_SYSTEM_TEXT, message, model_name=model_name, sample_index=sample_index,
+                                use_cache=use_cache, refresh=tries > 0)
+            logging.info(f'Response from LLM:\n{resp_text}')
+            pinfos = _parse_output(resp_text, batch_size=len(items))
+            return [_to_result(pinfo, search_result) for pinfo, (_, search_result) in zip(pinfos, items)]
+        except Exception as err:
+            tries += 1
+            logging.error(f'({tries}/{max_tries}) Error when parsing output - {err!r}')
+            continue
+
+    raise RuntimeError(f'Unable to get result for {[bg_item["title"] for bg_item, _ in items]!r}')
 
-    vals = []
+
+def _tally(vals: List[dict], min_val: int, bg_item) -> dict:
     mal_ids = defaultdict(lambda: 0)
     d_mal_vals = {}
-    for i in range(val_times):
-        logging.info(f'Val {i + 1} / {val_times} for {bg_item["title"]!r} ...')
-        val = _ask_chatgpt(bg_item, search_result=search_result, model_name=model_name)
-        vals.append(val)
+    for val in vals:
         mal_ids[val['mal_id']] += 1
         if val['mal_id'] not in d_mal_vals:
             d_mal_vals[val['mal_id']] = val
@@ -198,7 +232,7 @@ def get_full_info_for_fancaps(bg_item, model_name: str = _DEFAULT_MODEL, val_tim
         }
     else:
         reason = f'Cannot determine which anime it is due to the complex result ' \
-                 f'in {plural_word(val_times, "time")}: {dict(mal_ids)!r}'
+                 f'in {plural_word(len(vals), "time")}: {dict(mal_ids)!r}'
         logging.warning(f'Match failed.\nReason: {reason}')
         return {
             'mal_id': None,
@@ -210,6 +244,76 @@ def get_full_info_for_fancaps(bg_item, model_name: str = _DEFAULT_MODEL, val_tim
         }
 
 
+def _prematch(bg_item, search_result: List[dict]) -> Optional[dict]:
+    # episodes may be missing on fancaps, so the count is only an upper bound check
+    retval = prematch(bg_item['title'], search_result, episodes=len(bg_item['episodes']) or None)
+    if retval is not None:
+        logging.info(f'Locally matched {bg_item["title"]!r} to #{retval["mal_id"]!r}, LLM skipped.')
+    return retval
+
+
+def get_full_info_for_fancaps(bg_item, model_name: str = _DEFAULT_MODEL, val_times: int = 5, min_val: int = 4,
+                              session: Optional[requests.Session] = None, max_workers: Optional[int] = None,
+                              candidate_fields: Optional[Sequence[str]] = None, use_prematch: bool = True):
+    session = session or get_requests_session()
+    search_result = get_items_from_myanimelist(bg_item['title'], session=session)
+    if use_prematch:
+        pinfo = _prematch(bg_item, search_result)
+        if pinfo is not None:
+            return {**pinfo, 'fancaps': bg_item}
+
+    def _fn_val(i):
+        logging.info(f'Val {i + 1} / {val_times} for {bg_item["title"]!r} ...')
+        return _ask_chatgpt(bg_item, search_result=search_result, model_name=model_name, sample_index=i,
+                            candidate_fields=candidate_fields)
+
+    vals = parallel_vote(_fn_val, val_times=val_times, min_val=min_val, max_workers=max_workers)
+    return _tally(vals, min_val, bg_item)
+
+
+def get_full_info_for_fancaps_batch(bg_items: List[dict], model_name: str = _DEFAULT_MODEL, val_times: int = 5,
+                                    min_val: int = 4, session: Optional[requests.Session] = None,
+                                    max_workers: Optional[int] = None,
+                                    candidate_fields: Optional[Sequence[str]] = None,
+                                    use_prematch: bool = True) -> List[dict]:
+    """
+    Match several fancaps animes with one LLM request per validation round.
+
+    Each anime keeps its own search result in the request, and the answers are voted separately,
+    so the results are the same as :func:`get_full_info_for_fancaps` of each anime.
+
+    :param bg_items: Fancaps animes to match.
+    :param model_name: Name of the LLM model.
+    :param val_times: Maximum number of validation rounds. (default: 5)
+    :param min_val: Number of agreeing answers required. (default: 4)
+    :param session: Requests session to use.
+    :param max_workers: Number of rounds running at the same time, ``min_val`` when not given.
+    :param candidate_fields: Fields of the search results shown to the LLM, see :func:`project_candidate`.
+    :param use_prematch: Match the obvious cases locally with :func:`prematch`, without asking the LLM.
+        (default: True)
+    :returns: Matching results in the order of ``bg_items``.
+    """
+    session = session or get_requests_session()
+    results, items, indices = [None] * len(bg_items), [], []
+    for i, bg_item in enumerate(bg_items):
+        search_result = get_items_from_myanimelist(bg_item['title'], session=session)
+        pinfo = _prematch(bg_item, search_result) if use_prematch else None
+        if pinfo is not None:
+            results[i] = {**pinfo, 'fancaps': bg_item}
+        else:
+            items.append((bg_item, search_result))
+            indices.append(i)
+
+    def _fn_val(i):
+        logging.info(f'Val {i + 1} / {val_times} for {plural_word(len(items), "anime")} ...')
+        return _ask_chatgpt_batch(items, model_name=model_name, sample_index=i, candidate_fields=candidate_fields)
+
+    if items:
+        item_vals = batch_vote(_fn_val, len(items), val_times=val_times, min_val=min_val, max_workers=max_workers)
+        for i, vals in zip(indices, item_vals):
+            results[i] = _tally(vals, min_val, bg_items[i])
+    return results
+
 if __name__ == '__main__':
     logging.try_init_root(level=logging.INFO)
     from .data import _get_mappings
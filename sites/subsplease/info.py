@@ -1,4 +1,9 @@
+import hashlib
 import io
+import json
+import os
+import time
+from functools import lru_cache
 from typing import Optional
 from urllib.parse import urljoin
 
@@ -7,13 +12,79 @@ from ditk import logging
 from hbutils.system import urlsplit
 from pyquery import PyQuery as pq
 
-from ..utils import get_requests_session
+from ..utils import get_requests_session, concurrency_limit, KVCache, get_cache_dir, parse_timestamp
 
+SHOW_API_TTL = 12 * 60 * 60.0
+FINISHED_SHOW_API_TTL = 7 * 24 * 60 * 60.0
+FINISHED_SHOW_AGE = 30 * 24 * 60 * 60.0
 
-def get_info_from_subsplease(page_url: str, session: Optional[requests.Session] = None):
+
+@lru_cache()
+def get_subsplease_show_cache() -> KVCache:
+    return KVCache(os.path.join(get_cache_dir('subsplease'), 'subsplease.sqlite'), table='shows')
+
+
+def _get_release_digest(content: str, batch: dict, episode: dict) -> str:
+    return hashlib.sha256(json.dumps([content, sorted(batch), sorted(episode)]).encode()).hexdigest()
+
+
+def _get_show_releases(sid: str, session: requests.Session, cache: Optional[KVCache] = None) -> dict:
+    # shows without release for a long time are most likely finished, so their payloads are kept longer
+    entry = cache.get(sid) if cache is not None else None
+    if entry is not None:
+        is_finished = entry['last_release_at'] is not None and \
+                      entry['last_release_at'] + FINISHED_SHOW_AGE < entry['fetched_at']
+        if entry['fetched_at'] + (FINISHED_SHOW_API_TTL if is_finished else SHOW_API_TTL) >= time.time():
+            logging.info(f'Using cached release list of sid {sid!r}.')
+            return entry
+
+    logging.info(f'Getting release list of sid {sid!r} ...')
+    with concurrency_limit('site'):
+        r = session.get('https://subsplease.org/api/', params={
+            'f': 'show', 'tz': 'Asia/Tokyo', 'sid': sid,
+        })
+    r.raise_for_status()
+
+    batch = r.json().get('batch') or {}
+    episode = r.json().get('episode') or {}
+    timestamps = []
+    for item in [*batch.values(), *episode.values()]:
+        try:
+            timestamps.append(parse_timestamp(item['release_date']))
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    entry = {
+        'batch': batch,
+        'episode': episode,
+        'fetched_at': time.time(),
+        'last_release_at': max(timestamps) if timestamps else None,
+        'digest': None,
+        'prompt': None,
+    }
+    if cache is not None:
+        cache.set(sid, entry)
+    return entry
+
+
+def get_info_from_subsplease(page_url: str, session: Optional[requests.Session] = None, use_cache: bool = True):
+    """
+    Get the information of a subsplease show, with the prompt for the matching.
+
+    The release lists of the show API are cached by ``sid``. ``digest`` in the result is the hash of the
+    page content and the release keys, so unchanged shows can be detected, and the cached prompt is
+    reused when the digest is not changed.
+
+    :param page_url: URL of the show page.
+    :param session: Requests session to use.
+    :param use_cache: Use the cache of show API. (default: True)
+    :returns: Information of the show.
+    """
     session = session or get_requests_session()
+    cache = get_subsplease_show_cache() if use_cache else None
     logging.info(f'Accessing page {page_url!r} ...')
-    resp = session.get(page_url)
+    with concurrency_limit('site'):
+        resp = session.get(page_url)
     resp.raise_for_status()
 
     assert urlsplit(page_url).path_segments[1] == 'shows'
@@ -25,19 +96,23 @@ def get_info_from_subsplease(page_url: str, session: Optional[requests.Session]
     cover_image_url = urljoin(resp.url, page('#site-sidebar img.img-center').attr('src')) \
         if page('#site-sidebar img.img-center').attr('src') else None
 
-    with io.StringIO() as sf:
-        print(page('div.entry-content').text().strip(), file=sf)
-        print(f'', file=sf)
+    content = page('div.entry-content').text().strip()
+    sid_value = page('#show-release-table').attr('sid')
+    if sid_value:
+        entry = _get_show_releases(sid_value, session=session, cache=cache)
+        batch, episode = entry['batch'], entry['episode']
+    else:
+        entry = None
+        batch, episode = {}, {}
 
-        sid_value = page('#show-release-table').attr('sid')
-        if sid_value:
-            logging.info(f'Getting release list of sid {sid_value!r} ...')
-            r = session.get('https://subsplease.org/api/', params={
-                'f': 'show', 'tz': 'Asia/Tokyo', 'sid': sid_value,
-            })
-            r.raise_for_status()
+    digest = _get_release_digest(content, batch, episode)
+    if entry is not None and entry['digest'] == digest:
+        prompt = entry['prompt']
+    else:
+        with io.StringIO() as sf:
+            print(content, file=sf)
+            print(f'', file=sf)
 
-            batch = r.json().get('batch') or {}
             if batch:
                 print('Batch', file=sf)
                 print(f'', file=sf)
@@ -45,7 +120,6 @@ def get_info_from_subsplease(page_url: str, session: Optional[requests.Session]
                     print(f'#{item["episode"]} - {key!r} - {item["release_date"]}', file=sf)
                 print(f'', file=sf)
 
-            episode = r.json().get('episode') or {}
             if episode:
                 print('Episodes', file=sf)
                 print(f'', file=sf)
@@ -53,7 +127,10 @@ def get_info_from_subsplease(page_url: str, session: Optional[requests.Session]
                     print(f'#{item["episode"]} - {key!r} - {item["release_date"]}', file=sf)
                 print(f'', file=sf)
 
-        prompt = sf.getvalue()
+            prompt = sf.getvalue()
+
+        if entry is not None and cache is not None:
+            cache.set(sid_value, {**entry, 'digest': digest, 'prompt': prompt})
 
     return {
         'page_id': page_id,
@@ -64,4 +141,5 @@ def get_info_from_subsplease(page_url: str, session: Optional[requests.Session]
         'synopsis': synopsis,
         'batch': list(batch.values()),
         'episode': list(episode.values()),
+        'digest': digest,
     }
@@ -2,15 +2,15 @@ import io
 import json
 import re
 from collections import defaultdict
-from pprint import pformat
-from typing import Optional, List
+from typing import Optional, List, Tuple, Sequence
 
 import requests
 from ditk import logging
 from hbutils.string import plural_word
 
 from .info import get_info_from_subsplease
-from ..utils import get_requests_session, get_openai_client, get_items_from_myanimelist
+from ..utils import get_requests_session, get_items_from_myanimelist, parallel_vote, batch_vote, ask_llm, \
+    format_candidates, prematch, parse_datetime
 
 _DEFAULT_MODEL = 'openai/gpt-4o'
 
@@ -63,10 +63,23 @@ DO NOT OUTPUT ANYTHING ELSE EXCEPT THESE, MAKE SURE THE OUTPUT CAN BE PROCESSED
 NO MATTER YOU FIND THE MATCH OR NOT, PLEASE DESCRIBE YOU REASONS AND WHY YOU GIVE THIS ANSWER. 
 """
 
+_BATCH_SYSTEM_TEXT = _SYSTEM_TEXT + """
+SEVERAL ANIMES MAY BE PROVIDED IN ONE MESSAGE, EACH ONE STARTS WITH A LINE LIKE "### Anime #1", 
+AND HAS ITS OWN SEARCH RESULT. IN THIS CASE, ANSWER EVERY ANIME SEPARATELY IN THE SAME ORDER, 
+START EACH ANSWER WITH ITS OWN LINE ("### Anime #1", "### Anime #2", ...), FOLLOWED BY THE FORMAT ABOVE.
+"""
+
 _NOT_SET = object()
 
 
-def _parse_output(output: str):
+def _parse_output(output: str, batch_size: Optional[int] = None):
+    if batch_size is not None:
+        segments = re.split(r'^\s*#+\s*Anime\s*#(\d+)\s*$', output.strip(), flags=re.MULTILINE)
+        d_sections = {int(segments[i]): segments[i + 1] for i in range(1, len(segments), 2)}
+        assert sorted(d_sections) == list(range(1, batch_size + 1)), \
+            f'Answers of anime #1 - #{batch_size} expected, but {sorted(d_sections)!r} found'
+        return [_parse_output(d_sections[i]) for i in range(1, batch_size + 1)]
+
     mal_id, title, year, reason = _NOT_SET, _NOT_SET, _NOT_SET, _NOT_SET
     for line in output.strip().splitlines(keepends=False):
         line = line.strip()
@@ -101,14 +114,8 @@ def _parse_output(output: str):
     }
 
 
-def _ask_chatgpt(title: str, synopsis: Optional[str] = None, search_result: Optional[List[dict]] = None,
-                 model_name: str = _DEFAULT_MODEL, max_tries: int = 5):
-    client = get_openai_client()
-
-    if search_result is None:
-        search_result = get_items_from_myanimelist(title)
-    d_items = {item['mal_id']: item for item in search_result}
-
+def _make_message(title: str, synopsis: Optional[str], search_result: List[dict],
+                  candidate_fields: Optional[Sequence[str]] = None) -> str:
     with io.StringIO() as sf:
         print(f'Anime Title: {title!r}', file=sf)
         print(f'', file=sf)
@@ -118,40 +125,46 @@ def _ask_chatgpt(title: str, synopsis: Optional[str] = None, search_result: Opti
             print(f'', file=sf)
 
         print(f'Search Result:', file=sf)
-        print(pformat(search_result), file=sf)
+        print(format_candidates(search_result, fields=candidate_fields), file=sf)
         print(f'', file=sf)
 
-        message = sf.getvalue()
+        return sf.getvalue()
+
+
+def _to_result(pinfo: dict, search_result: List[dict]) -> dict:
+    d_items = {item['mal_id']: item for item in search_result}
+    if pinfo['mal_id'] and pinfo['mal_id'] in d_items:
+        return {
+            **pinfo,
+            'year': d_items[pinfo['mal_id']]['year'] or pinfo['year'],
+            'mal': d_items[pinfo['mal_id']],
+        }
+    else:
+        return {
+            'mal_id': None,
+            'title': None,
+            'reason': pinfo['reason'],
+            'year': pinfo['year'],
+            'mal': None,
+        }
+
+
+def _ask_chatgpt(title: str, synopsis: Optional[str] = None, search_result: Optional[List[dict]] = None,
+                 model_name: str = _DEFAULT_MODEL, max_tries: int = 5, sample_index: int = 0,
+                 use_cache: bool = True, candidate_fields: Optional[Sequence[str]] = None):
+    if search_result is None:
+        search_result = get_items_from_myanimelist(title)
+    message = _make_message(title, synopsis, search_result, candidate_fields=candidate_fields)
 
     tries = 0
     while tries < max_tries:
         logging.info(f'Asking LLM model {model_name!r} about {title!r} ...')
         try:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {'role': 'system', 'content': _SYSTEM_TEXT},
-                    {"role": "user", "content": message},
-                ],
-            )
-            resp_text = response.choices[0].message.content.strip()
+            # retried answers are asked again, the cached one may be the unparsable one
+            resp_text = ask_llm(_SYSTEM_TEXT, message, model_name=model_name, sample_index=sample_index,
+                                use_cache=use_cache, refresh=tries > 0)
             logging.info(f'Response from LLM:\n{resp_text}')
-
-            pinfo = _parse_output(resp_text)
-            if pinfo['mal_id'] and pinfo['mal_id'] in d_items:
-                return {
-                    **pinfo,
-                    'year': d_items[pinfo['mal_id']]['year'] or pinfo['year'],
-                    'mal': d_items[pinfo['mal_id']],
-                }
-            else:
-                return {
-                    'mal_id': None,
-                    'title': None,
-                    'reason': pinfo['reason'],
-                    'year': pinfo['year'],
-                    'mal': None,
-                }
+            return _to_result(_parse_output(resp_text), search_result)
         except Exception as err:
             tries += 1
             logging.error(f'({tries}/{max_tries}) Error when parsing output - {err!r}')
@@ -160,24 +173,37 @@ def _ask_chatgpt(title: str, synopsis: Optional[str] = None, search_result: Opti
     raise RuntimeError(f'Unable to get result for {title!r}')
 
 
-def get_full_info_for_subsplease(url, model_name: str = _DEFAULT_MODEL, val_times: int = 5, min_val: int = 4,
-                                 session: Optional[requests.Session] = None):
-    session = session or get_requests_session()
-    info = get_info_from_subsplease(url, session=session)
-    search_result = get_items_from_myanimelist(info['title'], session=session)
-    subsplease_info = {
-        'url': url,
-        **{key: value for key, value in info.items() if key != 'prompt'},
-    }
+def _ask_chatgpt_batch(items: List[Tuple[str, Optional[str], List[dict]]], model_name: str = _DEFAULT_MODEL,
+                       max_tries: int = 5, sample_index: int = 0, use_cache: bool = True,
+                       candidate_fields: Optional[Sequence[str]] = None) -> List[dict]:
+    with io.StringIO() as sf:
+        for i, (title, synopsis, search_result) in enumerate(items, start=1):
+            print(f'### Anime #{i}', file=sf)
+            print(f'', file=sf)
+            print(_make_message(title, synopsis, search_result, candidate_fields=candidate_fields), file=sf)
+        message = sf.getvalue()
 
-    vals = []
+    tries = 0
+    while tries < max_tries:
+        logging.info(f'Asking LLM model {model_name!r} about {plural_word(len(items), "anime")} ...')
+        try:
+            resp_text = ask_llm(_BATCH_SYSTEM_TEXT, message, model_name=model_name, sample_index=sample_index,
+                                use_cache=use_cache, refresh=tries > 0)
+            logging.info(f'Response from LLM:\n{resp_text}')
+            pinfos = _parse_output(resp_text, batch_size=len(items))
+            return [_to_result(pinfo, search_result) for pinfo, (_, _, search_result) in zip(pinfos, items)]
+        except Exception as err:
+            tries += 1
+            logging.error(f'({tries}/{max_tries}) Error when parsing output - {err!r}')
+            continue
+
+    raise RuntimeError(f'Unable to get result for {[title for title, _, _ in items]!r}')
+
+
+def _tally(vals: List[dict], min_val: int, subsplease_info: dict) -> dict:
     mal_ids = defaultdict(lambda: 0)
     d_mal_vals = {}
-    for i in range(val_times):
-        logging.info(f'Val {i + 1} / {val_times} for {info["title"]!r} ...')
-        val = _ask_chatgpt(info['title'], synopsis=info['prompt'],
-                           search_result=search_result, model_name=model_name)
-        vals.append(val)
+    for val in vals:
         mal_ids[val['mal_id']] += 1
         if val['mal_id'] not in d_mal_vals:
             d_mal_vals[val['mal_id']] = val
@@ -203,7 +229,7 @@ def get_full_info_for_subsplease(url, model_name: str = _DEFAULT_MODEL, val_time
         }
     else:
         reason = f'Cannot determine which anime it is due to the complex result ' \
-                 f'in {plural_word(val_times, "time")}: {dict(mal_ids)!r}'
+                 f'in {plural_word(len(vals), "time")}: {dict(mal_ids)!r}'
         logging.warning(f'Match failed.\nReason: {reason}')
         return {
             'mal_id': None,
@@ -213,3 +239,92 @@ def get_full_info_for_subsplease(url, model_name: str = _DEFAULT_MODEL, val_time
             'year': list(d_mal_vals.values())[0]['year'],
             'subsplease': subsplease_info,
         }
+
+
+def _get_subsplease_info(url: str, info: dict) -> dict:
+    return {
+        'url': url,
+        **{key: value for key, value in info.items() if key != 'prompt'},
+    }
+
+
+def _prematch(info: dict, search_result: List[dict]) -> Optional[dict]:
+    years = []
+    for item in [*info['batch'], *info['episode']]:
+        try:
+            years.append(parse_datetime(item['release_date']).year)
+        except (KeyError, TypeError, ValueError):
+            pass
+    episodes = len({item['episode'] for item in info['episode']})
+    retval = prematch(info['title'], search_result, year=min(years) if years else None, episodes=episodes or None)
+    if retval is not None:
+        logging.info(f'Locally matched {info["title"]!r} to #{retval["mal_id"]!r}, LLM skipped.')
+    return retval
+
+
+def get_full_info_for_subsplease(url, model_name: str = _DEFAULT_MODEL, val_times: int = 5, min_val: int = 4,
+                                 session: Optional[requests.Session] = None, max_workers: Optional[int] = None,
+                                 info: Optional[dict] = None, candidate_fields: Optional[Sequence[str]] = None,
+                                 use_prematch: bool = True):
+    session = session or get_requests_session()
+    info = info or get_info_from_subsplease(url, session=session)
+    search_result = get_items_from_myanimelist(info['title'], session=session)
+    if use_prematch:
+        pinfo = _prematch(info, search_result)
+        if pinfo is not None:
+            return {**pinfo, 'subsplease': _get_subsplease_info(url, info)}
+
+    def _fn_val(i):
+        logging.info(f'Val {i + 1} / {val_times} for {info["title"]!r} ...')
+        return _ask_chatgpt(info['title'], synopsis=info['prompt'],
+                            search_result=search_result, model_name=model_name, sample_index=i,
+                            candidate_fields=candidate_fields)
+
+    vals = parallel_vote(_fn_val, val_times=val_times, min_val=min_val, max_workers=max_workers)
+    return _tally(vals, min_val, _get_subsplease_info(url, info))
+
+
+def get_full_info_for_subsplease_batch(urls: List[str], model_name: str = _DEFAULT_MODEL, val_times: int = 5,
+                                       min_val: int = 4, session: Optional[requests.Session] = None,
+                                       max_workers: Optional[int] = None, infos: Optional[List[dict]] = None,
+                                       candidate_fields: Optional[Sequence[str]] = None,
+                                       use_prematch: bool = True) -> List[dict]:
+    """
+    Match several subsplease shows with one LLM request per validation round.
+
+    Each show keeps its own search result in the request, and the answers are voted separately,
+    so the results are the same as :func:`get_full_info_for_subsplease` of each show.
+
+    :param urls: URLs of the show pages.
+    :param model_name: Name of the LLM model.
+    :param val_times: Maximum number of validation rounds. (default: 5)
+    :param min_val: Number of agreeing answers required. (default: 4)
+    :param session: Requests session to use.
+    :param max_workers: Number of rounds running at the same time, ``min_val`` when not given.
+    :param infos: Information of the shows, fetched from the pages when not given.
+    :param candidate_fields: Fields of the search results shown to the LLM, see :func:`project_candidate`.
+    :param use_prematch: Match the obvious cases locally with :func:`prematch`, without asking the LLM.
+        (default: True)
+    :returns: Matching results in the order of ``urls``.
+    """
+    session = session or get_requests_session()
+    infos = infos or [get_info_from_subsplease(url, session=session) for url in urls]
+    results, items, indices = [None] * len(infos), [], []
+    for i, (url, info) in enumerate(zip(urls, infos)):
+        search_result = get_items_from_myanimelist(info['title'], session=session)
+        pinfo = _prematch(info, search_result) if use_prematch else None
+        if pinfo is not None:
+            results[i] = {**pinfo, 'subsplease': _get_subsplease_info(url, info)}
+        else:
+            items.append((info['title'], info['prompt'], search_result))
+            indices.append(i)
+
+    def _fn_val(i):
+        logging.info(f'Val {i + 1} / {val_times} for {plural_word(len(items), "anime")} ...')
+        return _ask_chatgpt_batch(items, model_name=model_name, sample_index=i, candidate_fields=candidate_fields)
+
+    if items:
+        item_vals = batch_vote(_fn_val, len(items), val_times=val_times, min_val=min_val, max_workers=max_workers)
+        for i, vals in zip(indices, item_vals):
+            results[i] = _tally(vals, min_val, _get_subsplease_info(urls[i], infos[i]))
+    return results
@@ -1,23 +1,19 @@
-import math
-import os
-import re
-import time
-from typing import Optional
+from typing import Optional, TextIO
 
 import numpy as np
 import pandas as pd
+import requests
 from ditk import logging
 from hbutils.string import plural_word
-from hbutils.system import urlsplit, TemporaryDirectory
+from hbutils.system import urlsplit
 from hfutils.cache import delete_detached_cache
-from hfutils.operate import get_hf_client, get_hf_fs, upload_directory_as_directory, download_directory_as_directory
-from hfutils.utils import number_to_tag, hf_normpath
-from huggingface_hub import hf_hub_url
-from pyrate_limiter import Rate, Limiter, Duration
 
-from .llm import get_full_info_for_subsplease
+from .info import get_info_from_subsplease, get_subsplease_show_cache
+from .llm import get_full_info_for_subsplease, get_full_info_for_subsplease_batch
 from .lst import list_all_items_from_subsplease
-from ..utils import get_requests_session, parallel_call, download_file
+from ..utils import get_requests_session, parallel_map, get_http_cache, set_concurrency_limit, get_llm_cache, \
+    get_mal_search_cache, get_mal_anime_cache, load_mal_index, md_link, md_image, write_markdown_table, \
+    DatasetPublisher, CoverSpec, MATCH_SCHEMA, mal_columns, migrate_match_table
 
 
 def _get_url_from_small_dict(dict_: dict):
@@ -40,44 +36,100 @@ def _get_image_url(image_dict: dict):
         return None
 
 
-def _name_safe(name_text):
-    return re.sub(r'[\W_]+', ' ', name_text).strip(' ')
+def _write_readme_intro(publisher: DatasetPublisher, f: TextIO, df_animes: pd.DataFrame):
+    print(f'This is the matching result of subsplease and myanimelist, '
+          f'based on the LLM model.', file=f)
+    print(f'', file=f)
+
+
+def _write_readme_matched(publisher: DatasetPublisher, f: TextIO, df_animes: pd.DataFrame):
+    df_success = df_animes[~df_animes['mal_id'].isnull()].replace(np.nan, None)
+    df_success = df_success.sort_values(by=['year', 'mal_id'], ascending=[False, False])
+    if len(df_success):
+        print('## Resource', file=f)
+        print(f'', file=f)
+        print(f'{plural_word(len(df_success), "matched anime")} in total.', file=f)
+        print(f'', file=f)
+
+        df_shown = df_success[:500]
+        subs_cover = md_link(md_image(df_shown['page_id'], publisher.cover_urls('subs', df_shown['page_id'])),
+                             df_shown['subsplease_url'])
+        mal_cover = md_link(md_image(df_shown['mal_id'].astype(int), publisher.cover_urls('mal', df_shown['mal_id'])),
+                            df_shown['mal_url'])
+        mal_title = df_shown['mal_title'].where(df_shown['mal_title'].astype(bool), 'N/A')
+        write_markdown_table(f, pd.DataFrame({
+            'Subs Cover': subs_cover,
+            'Subs Title': md_link(df_shown['subsplease_title'], df_shown['subsplease_url']),
+            'MAL ID': df_shown['mal_id'].astype(int),
+            'MAL Cover': mal_cover,
+            'MAL Title': md_link(mal_title, df_shown['mal_url']),
+            'Year': df_shown['year'].astype('Int64'),
+        }))
+        print(f'', file=f)
+
+
+def _write_readme_failed(publisher: DatasetPublisher, f: TextIO, df_animes: pd.DataFrame):
+    df_failed = df_animes[df_animes['mal_id'].isnull()].replace(np.nan, None)
+    if len(df_failed):
+        print('## Resources (Failed to Match)', file=f)
+        print(f'', file=f)
+        print(f'{plural_word(len(df_failed), "unmatched anime")} in total.', file=f)
+        print(f'', file=f)
+
+        df_shown = df_failed[:500]
+        subs_cover = md_link(md_image(df_shown['page_id'], publisher.cover_urls('subs', df_shown['page_id'])),
+                             df_shown['subsplease_url'])
+        write_markdown_table(f, pd.DataFrame({
+            'Subs Cover': subs_cover,
+            'Subs Title': md_link(df_shown['subsplease_title'], df_shown['subsplease_url']),
+            'Year': df_shown['year'].astype('Int64'),
+            'Reason': df_shown['reason'],
+        }))
+        print(f'', file=f)
+
+
+def create_publisher(repository: str, session: requests.Session, deploy_span: float = 5 * 60.0,
+                     upload_time_span: float = 30.0, sync_mode: bool = True,
+                     background: bool = False) -> DatasetPublisher:
+    """
+    Create the publisher of the subsplease matching dataset, also used by :mod:`sites.subsplease.rp`.
+    """
+    return DatasetPublisher(
+        repository=repository,
+        key='page_id',
+        sort_by=[('year', 'descending'), ('page_id', 'ascending')],
+        schema=MATCH_SCHEMA,
+        migrate=migrate_match_table,
+        covers=[
+            CoverSpec('subs', key_column='page_id', url_column='subsplease_cover_image_url',
+                      desc='Downloading Subsplease Cover Images'),
+            CoverSpec('mal', key_column='mal_id', url_column='mal_cover_image_url', key_type=int,
+                      desc='Downloading MAL Cover Images'),
+        ],
+        readme_sections=[_write_readme_intro, _write_readme_matched, _write_readme_failed],
+        source_datasets=['subsplease', 'myanimelist'],
+        session=session,
+        deploy_span=deploy_span,
+        upload_time_span=upload_time_span,
+        sync_mode=sync_mode,
+        background=background,
+    )
 
 
 def sync(repository: str, upload_time_span: float = 30.0, deploy_span: float = 5 * 60.0,
-         proxy_pool: Optional[str] = None, sync_mode: bool = True):
+         proxy_pool: Optional[str] = None, sync_mode: bool = True, use_http_cache: bool = True,
+         max_workers: int = 8, jikan_concurrency: int = 2, site_concurrency: int = 4, llm_concurrency: int = 16,
+         llm_batch_size: int = 1, use_prematch: bool = True, mal_index_file: Optional[str] = None,
+         background_deploy: bool = True):
     delete_detached_cache()
-    hf_client = get_hf_client()
-    hf_fs = get_hf_fs()
-
-    rate = Rate(1, int(math.ceil(Duration.SECOND * upload_time_span)))
-    limiter = Limiter(rate, max_delay=1 << 32)
 
-    if not hf_client.repo_exists(repo_id=repository, repo_type='dataset'):
-        hf_client.create_repo(repo_id=repository, repo_type='dataset', private=True)
-        attr_lines = hf_fs.read_text(f'datasets/{repository}/.gitattributes').splitlines(keepends=False)
-        attr_lines.append('*.json filter=lfs diff=lfs merge=lfs -text')
-        attr_lines.append('*.csv filter=lfs diff=lfs merge=lfs -text')
-        hf_fs.write_text(
-            f'datasets/{repository}/.gitattributes',
-            os.linesep.join(attr_lines),
-        )
+    set_concurrency_limit('jikan', jikan_concurrency)
+    set_concurrency_limit('site', site_concurrency)
+    set_concurrency_limit('llm', llm_concurrency)
+    if mal_index_file:
+        load_mal_index(mal_index_file)
 
-    if hf_client.file_exists(
-            repo_id=repository,
-            repo_type='dataset',
-            filename='table.parquet',
-    ):
-        df = pd.read_parquet(hf_client.hf_hub_download(
-            repo_id=repository,
-            repo_type='dataset',
-            filename='table.parquet',
-        )).replace(np.nan, None)
-        d_animes = {item['page_id']: item for item in df.to_dict('records')}
-    else:
-        d_animes = {}
-
-    session = get_requests_session()
+    session = get_requests_session(cache=get_http_cache() if use_http_cache else None)
     if proxy_pool:
         logging.info(f'Proxy pool {proxy_pool!r} enabled.')
         session.proxies.update({
@@ -85,220 +137,12 @@ def sync(repository: str, upload_time_span: float = 30.0, deploy_span: float = 5
             'https': proxy_pool
         })
 
-    with TemporaryDirectory() as upload_dir:
-        mal_covers_dir = os.path.join(upload_dir, 'assets', 'mal')
-        os.makedirs(mal_covers_dir, exist_ok=True)
-        subs_covers_dir = os.path.join(upload_dir, 'assets', 'subs')
-        os.makedirs(subs_covers_dir, exist_ok=True)
-
-        if sync_mode:
-            logging.info('Downloading current mal images ...')
-            download_directory_as_directory(
-                repo_id=repository,
-                repo_type='dataset',
-                dir_in_repo=hf_normpath(os.path.relpath(mal_covers_dir, upload_dir)),
-                local_directory=mal_covers_dir,
-            )
-
-            logging.info('Downloading current subsplease images ...')
-            download_directory_as_directory(
-                repo_id=repository,
-                repo_type='dataset',
-                dir_in_repo=hf_normpath(os.path.relpath(subs_covers_dir, upload_dir)),
-                local_directory=subs_covers_dir,
-            )
-
-        _last_update, has_update = None, False
-        _total_count = len(d_animes)
-
-        def _deploy(force=False):
-            nonlocal _last_update, has_update, _total_count
-
-            if not has_update:
-                return
-            if not force and _last_update is not None and _last_update + deploy_span > time.time():
-                return
-
-            table_parquet_file = os.path.join(upload_dir, 'table.parquet')
-            os.makedirs(os.path.dirname(table_parquet_file), exist_ok=True)
-            df_animes = pd.DataFrame(list(d_animes.values())).replace(np.nan, None)
-            df_animes['y'] = df_animes['year'].map(lambda x: x or 0)
-            df_animes = df_animes.sort_values(by=['year', 'page_id'], ascending=[False, True])
-            del df_animes['y']
-            df_animes.to_parquet(table_parquet_file, engine='pyarrow', index=False)
-
-            d_subs_images = {}
-
-            def _fn_download_subs_cover(item):
-                _, ext = os.path.splitext(urlsplit(item['subsplease_cover_image_url']).filename)
-                dst_filename = os.path.join(subs_covers_dir, f'{item["page_id"]}{ext}')
-
-                try:
-                    if not os.path.exists(dst_filename):
-                        download_file(
-                            item['subsplease_cover_image_url'],
-                            filename=dst_filename,
-                            session=session,
-                        )
-                except:
-                    if os.path.exists(dst_filename):
-                        os.remove(dst_filename)
-                    raise
-                else:
-                    d_subs_images[item['page_id']] = hf_normpath(os.path.relpath(dst_filename, upload_dir))
-
-            parallel_call(
-                df_animes[~df_animes['subsplease_cover_image_url'].isnull()].to_dict('records'),
-                _fn_download_subs_cover,
-                desc='Downloading Subsplease Cover Images'
-            )
-
-            d_mal_images = {}
-
-            def _fn_download_mal_cover(item):
-                _, ext = os.path.splitext(urlsplit(item['mal_cover_image_url']).filename)
-                dst_filename = os.path.join(mal_covers_dir, f'{int(item["mal_id"])}{ext}')
-
-                try:
-                    if not os.path.exists(dst_filename):
-                        download_file(
-                            item['mal_cover_image_url'],
-                            filename=dst_filename,
-                            session=session,
-                        )
-                except:
-                    if os.path.exists(dst_filename):
-                        os.remove(dst_filename)
-                    raise
-                else:
-                    d_mal_images[item['mal_id']] = hf_normpath(os.path.relpath(dst_filename, upload_dir))
-
-            parallel_call(
-                df_animes[~df_animes['mal_cover_image_url'].isnull()].to_dict('records'),
-                _fn_download_mal_cover,
-                desc='Downloading MAL Cover Images'
-            )
-
-            with open(os.path.join(upload_dir, 'README.md'), 'w') as f:
-                print('---', file=f)
-                print('license: other', file=f)
-                print('language:', file=f)
-                print('- en', file=f)
-                print('- ja', file=f)
-                print('tags:', file=f)
-                print('- art', file=f)
-                print('- anime', file=f)
-                print('size_categories:', file=f)
-                print(f'- {number_to_tag(len(df_animes))}', file=f)
-                print('annotations_creators:', file=f)
-                print('- no-annotation', file=f)
-                print('source_datasets:', file=f)
-                print('- subsplease', file=f)
-                print('- myanimelist', file=f)
-                print('---', file=f)
-                print('', file=f)
-
-                print(f'This is the matching result of subsplease and myanimelist, '
-                      f'based on the LLM model.', file=f)
-                print(f'', file=f)
-
-                df_success = df_animes[~df_animes['mal_id'].isnull()].replace(np.nan, None)
-                df_success = df_success.sort_values(by=['year', 'mal_id'], ascending=[False, False])
-                if len(df_success):
-                    print('## Resource', file=f)
-                    print(f'', file=f)
-                    print(f'{plural_word(len(df_success), "matched anime")} in total.', file=f)
-                    print(f'', file=f)
-
-                    lst_success = []
-                    for item in df_success[:500].to_dict('records'):
-                        if d_subs_images.get(item['page_id']):
-                            subs_image_url = hf_hub_url(
-                                repo_id=repository,
-                                repo_type='dataset',
-                                filename=d_subs_images[item['page_id']],
-                            )
-                        else:
-                            subs_image_url = None
-                        if d_mal_images.get(item['mal_id']):
-                            mal_image_url = hf_hub_url(
-                                repo_id=repository,
-                                repo_type='dataset',
-                                filename=d_mal_images[item['mal_id']],
-                            )
-                        else:
-                            mal_image_url = None
-
-                        subs_cover = f'![{item["page_id"]}]({subs_image_url})' if subs_image_url else 'N/A'
-                        subs_title = item['subsplease_title']
-                        if item['subsplease_url']:
-                            subs_cover = f'[{subs_cover}]({item["subsplease_url"]})'
-                            subs_title = f'[{subs_title}]({item["subsplease_url"]})'
-                        mal_cover = f'![{item["mal_id"]}]({mal_image_url})' if mal_image_url else 'N/A'
-                        mal_title = item['mal_title'] if item['mal_title'] else 'N/A'
-                        if item.get('mal_url'):
-                            mal_cover = f'[{mal_cover}]({item["mal_url"]})'
-                            mal_title = f'[{mal_title}]({item["mal_url"]})'
-                        lst_success.append({
-                            'Subs Cover': subs_cover,
-                            'Subs Title': subs_title,
-                            'MAL ID': item['mal_id'],
-                            'MAL Cover': mal_cover,
-                            'MAL Title': mal_title,
-                            'Year': int(item['year']) if item['year'] else 'N/A',
-                            # 'Reason': item['reason'],
-                        })
-
-                    df_lst_success = pd.DataFrame(lst_success)
-                    print(df_lst_success.to_markdown(index=False), file=f)
-                    print(f'', file=f)
-
-                df_failed = df_animes[df_animes['mal_id'].isnull()].replace(np.nan, None)
-                if len(df_failed):
-                    print('## Resources (Failed to Match)', file=f)
-                    print(f'', file=f)
-                    print(f'{plural_word(len(df_failed), "unmatched anime")} in total.', file=f)
-                    print(f'', file=f)
-
-                    lst_failed = []
-                    for item in df_failed[:500].to_dict('records'):
-                        if d_subs_images.get(item['page_id']):
-                            subs_image_url = hf_hub_url(
-                                repo_id=repository,
-                                repo_type='dataset',
-                                filename=d_subs_images[item['page_id']],
-                            )
-                        else:
-                            subs_image_url = None
-
-                        subs_cover = f'![{item["page_id"]}]({subs_image_url})' if subs_image_url else 'N/A'
-                        subs_title = item['subsplease_title']
-                        if item['subsplease_url']:
-                            subs_cover = f'[{subs_cover}]({item["subsplease_url"]})'
-                            subs_title = f'[{subs_title}]({item["subsplease_url"]})'
-                        lst_failed.append({
-                            'Subs Cover': subs_cover,
-                            'Subs Title': subs_title,
-                            'Year': int(item['year']) if item['year'] else 'N/A',
-                            'Reason': item['reason'],
-                        })
-
-                    df_lst_failed = pd.DataFrame(lst_failed)
-                    print(df_lst_failed.to_markdown(index=False), file=f)
-                    print(f'', file=f)
-
-            limiter.try_acquire('hf upload limit')
-            upload_directory_as_directory(
-                repo_id=repository,
-                repo_type='dataset',
-                local_directory=upload_dir,
-                path_in_repo='.',
-                message=f'Adding {plural_word(len(df_animes) - _total_count, "new record")} into index',
-            )
-            has_update = False
-            _last_update = time.time()
-            _total_count = len(df_animes)
-
+    publisher = create_publisher(repository, session=session, deploy_span=deploy_span,
+                                 upload_time_span=upload_time_span, sync_mode=sync_mode,
+                                 background=background_deploy)
+    d_animes = {item['page_id']: item for item in publisher.records()}
+    with publisher:
+        pending_items = []
         for sitem in list_all_items_from_subsplease(session=session):
             assert urlsplit(sitem['url']).path_segments[1] == 'shows'
             page_id = urlsplit(sitem['url']).path_segments[2]
@@ -309,26 +153,57 @@ def sync(repository: str, upload_time_span: float = 30.0, deploy_span: float = 5
             elif not sync_mode and page_id in d_animes:
                 logging.warning(f'Anime {sitem!r} already asked, but not matched, skipped due to non-sync mode.')
                 continue
-
-            try:
-                full_info = get_full_info_for_subsplease(sitem['url'], session=session)
-            except:
-                logging.exception(f'Error on {sitem!r}')
-                continue
-            row = {
-                'page_id': page_id,
-                'mal_id': full_info['mal_id'],
-                'reason': full_info['reason'],
-                'year': full_info['year'],
-                **{f'subsplease_{key}': value for key, value in (full_info.get('subsplease') or {}).items()},
-                **{f'mal_{key}': value for key, value in (full_info.get('mal') or {}).items()},
-                'mal_cover_image_url': _get_image_url(full_info['mal']['images']) if full_info['mal'] else None,
-            }
-            d_animes[page_id] = row
-            has_update = True
-            _deploy()
-
-        _deploy(force=True)
+            pending_items.append((page_id, sitem, (d_animes.get(page_id) or {}).get('subsplease_digest')))
+
+        def _fn_match(batch):
+            infos, batch_results = [], []
+            for _, sitem, prev_digest in batch:
+                info = get_info_from_subsplease(sitem['url'], session=session)
+                if prev_digest and info['digest'] == prev_digest:
+                    logging.info(f'Page and releases of {sitem!r} not changed since last asking, skipped.')
+                    batch_results.append(None)
+                else:
+                    infos.append((sitem['url'], info))
+                    batch_results.append(len(infos) - 1)
+
+            if len(infos) > 1:
+                full_infos = get_full_info_for_subsplease_batch(
+                    [url for url, _ in infos], session=session, infos=[info for _, info in infos],
+                    use_prematch=use_prematch)
+            else:
+                full_infos = [get_full_info_for_subsplease(url, session=session, info=info, use_prematch=use_prematch)
+                              for url, info in infos]
+            return [full_infos[index] if index is not None else None for index in batch_results]
+
+        # matching runs in the workers, while rows are only handled in this thread
+        batches = [pending_items[i:i + llm_batch_size] for i in range(0, len(pending_items), llm_batch_size)]
+        unchanged_count = 0
+        for batch, full_infos in parallel_map(batches, _fn_match, desc='Animes', max_workers=max_workers):
+            for (page_id, sitem, _), full_info in zip(batch, full_infos):
+                if full_info is None:
+                    unchanged_count += 1
+                    continue
+
+                row = {
+                    'page_id': page_id,
+                    'mal_id': full_info['mal_id'],
+                    'reason': full_info['reason'],
+                    'year': full_info['year'],
+                    **{f'subsplease_{key}': value for key, value in (full_info.get('subsplease') or {}).items()},
+                    **mal_columns(full_info.get('mal')),
+                    'mal_cover_image_url': _get_image_url(full_info['mal']['images']) if full_info['mal'] else None,
+                }
+                d_animes[page_id] = row
+                publisher.upsert(row)
+                # published in the background, matching goes on during the uploads
+                publisher.request_publish()
+
+        publisher.publish(force=True)
+
+    logging.info(f'{plural_word(unchanged_count, "unchanged anime")} skipped.')
+    logging.info(f'Show cache usage: {get_subsplease_show_cache().stats()}.')
+    logging.info(f'MAL cache usage: {get_mal_search_cache().stats()}, {get_mal_anime_cache().stats()}.')
+    logging.info(f'LLM cache usage: {get_llm_cache().stats()}.')
 
 
 if __name__ == '__main__':
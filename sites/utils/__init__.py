@@ -1,5 +1,19 @@
-from .download import download_file
-from .llm import get_openai_client
-from .mal import get_items_from_myanimelist
-from .parallel import parallel_call
-from .session import get_requests_session, srequest
+from .assets import AssetManifest, upload_changed_files
+from .asession import get_event_loop, run_async, get_async_session, asrequest, astream, srequest
+from .cache import get_cache_dir, HTTPCache, get_http_cache, KVCache
+from .concurrency import set_concurrency_limit, concurrency_limit
+from .dates import parse_datetime, parse_timestamp, date_parse_stats, date_parse_counts, add_date_parse_counts
+from .download import download_file, adownload_file
+from .llm import get_openai_client, parallel_vote, batch_vote, ask_llm, get_llm_cache
+from .mal import get_items_from_myanimelist, get_anime_full_from_myanimelist, jikan_call, get_jikan_limiter, \
+    get_mal_search_cache, get_mal_anime_cache
+from .malindex import MALIndex, load_mal_index, get_mal_index
+from .matchtable import MATCH_SCHEMA, mal_columns, migrate_match_table
+from .parallel import parallel_call, parallel_map, ParallelResults, ParallelError, async_map, async_call, AsyncResults
+from .prematch import normalize_title, prematch
+from .prompt import DEFAULT_CANDIDATE_FIELDS, project_candidate, format_candidates, estimate_tokens
+from .publish import CoverSpec, DatasetPublisher
+from .readme import hf_file_url_prefix, hf_file_urls, md_link, md_image, write_markdown_table
+from .records import to_plain
+from .session import get_requests_session
+from .tables import TableStore
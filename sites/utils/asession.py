@@ -0,0 +1,345 @@
+import asyncio
+import atexit
+import logging
+import random
+import ssl
+import threading
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Union, List, AsyncIterator, Awaitable, TypeVar
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers, DEFAULT_ACCEPT_ENCODING
+
+from .cache import HTTPCache
+from .session import DEFAULT_TIMEOUT, DEFAULT_USER_AGENT, RETRY_STATUS_CODES, CachedHTTPAdapter, \
+    TimeoutHTTPAdapter, get_retry_after
+
+_T = TypeVar('_T')
+
+_LOOP_LOCK = threading.Lock()
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """
+    Get the process-wide event loop of the async http layer, which runs in a daemon thread.
+
+    The blocking :func:`srequest` and :func:`sites.utils.download.download_file` run their coroutines in it,
+    so the requests from all the threads share one connection pool and are handled on one core.
+    """
+    global _loop
+    with _LOOP_LOCK:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='async-http', daemon=True).start()
+            atexit.register(_close_loop_sessions)
+        return _loop
+
+
+def run_async(coro: Awaitable[_T]) -> _T:
+    """
+    Run the coroutine in the event loop of :func:`get_event_loop`, and wait for its result.
+
+    :param coro: The coroutine to run.
+    :returns: The result of the coroutine.
+    :raises RuntimeError: When called inside the event loop, which would be blocked forever.
+    """
+    loop = get_event_loop()
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is loop:
+        raise RuntimeError('Blocking call inside the async http loop, await the coroutine instead.')
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def _client_timeout(timeout) -> aiohttp.ClientTimeout:
+    # the timeouts of requests are for connecting and each reading, not the whole request
+    connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+
+def get_async_session(timeout: int = DEFAULT_TIMEOUT, verify: bool = True,
+                      headers: Optional[Dict[str, str]] = None, limit: int = 256, limit_per_host: int = 0) \
+        -> aiohttp.ClientSession:
+    """
+    Returns an aiohttp ClientSession object configured like :func:`get_requests_session`.
+
+    The session must be created (and closed) inside a running event loop, e.g.
+    ``async with get_async_session() as session: ...``.
+
+    :param timeout: The default timeout value of connecting and reading in seconds. (default: 30)
+    :type timeout: int
+    :param verify: Whether to verify the SSL certificates. (default: True)
+    :type verify: bool
+    :param headers: Additional headers to be added to the session. (default: None)
+    :type headers: Optional[Dict[str, str]]
+    :param limit: The maximum number of simultaneous connections. (default: 256)
+    :type limit: int
+    :param limit_per_host: The maximum number of simultaneous connections to one host, 0 means no limit. (default: 0)
+    :type limit_per_host: int
+    :returns: The aiohttp ClientSession object.
+    :rtype: aiohttp.ClientSession
+    """
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host, ssl=bool(verify))
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=_client_timeout(timeout),
+        headers={
+            "User-Agent": DEFAULT_USER_AGENT,
+            **dict(headers or {}),
+        },
+    )
+
+
+# connection pools of the requests sent with requests sessions, one for each event loop,
+# the headers, cookies and proxies are taken from the requests sessions on each request
+_POOL_SESSIONS: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+
+def _get_pool_session() -> aiohttp.ClientSession:
+    loop = asyncio.get_running_loop()
+    session = _POOL_SESSIONS.get(loop)
+    if session is None or session.closed:
+        # the cookies are kept by the requests sessions, not shared between them
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=256, limit_per_host=0),
+            cookie_jar=aiohttp.DummyCookieJar(),
+        )
+        _POOL_SESSIONS[loop] = session
+    return session
+
+
+def _close_loop_sessions():
+    session = _POOL_SESSIONS.pop(_loop, None)
+    if session is not None and not session.closed and _loop.is_running():
+        asyncio.run_coroutine_threadsafe(session.close(), _loop).result(timeout=DEFAULT_TIMEOUT)
+
+
+def _ssl_option(verify):
+    if verify is False:
+        return False
+    elif isinstance(verify, str):
+        return ssl.create_default_context(cafile=verify)
+    else:
+        return True
+
+
+class _Request:
+    # the request to send with aiohttp, and the options taken from the requests session
+    def __init__(self, session: Union[requests.Session, aiohttp.ClientSession], method: str, url: str, kwargs: dict):
+        kwargs = dict(kwargs)
+        kwargs.pop('stream', None)
+        self.cache: Optional[HTTPCache] = None
+        if isinstance(session, requests.Session):
+            verify = kwargs.pop('verify', session.verify)
+            proxies = {**session.proxies, **dict(kwargs.pop('proxies', None) or {})}
+            timeout = kwargs.pop('timeout', None)
+            allow_redirects = kwargs.pop('allow_redirects', True)
+            # the headers, cookies, params and body are merged and encoded by requests
+            self.prepared = session.prepare_request(requests.Request(method, url, **kwargs))
+            adapter = session.get_adapter(self.prepared.url)
+            if isinstance(adapter, CachedHTTPAdapter) and method.upper() == 'GET':
+                self.cache = adapter.cache
+            if timeout is None:
+                timeout = adapter.timeout if isinstance(adapter, TimeoutHTTPAdapter) else DEFAULT_TIMEOUT
+
+            headers = CaseInsensitiveDict(self.prepared.headers)
+            if headers.get('Accept-Encoding') == DEFAULT_ACCEPT_ENCODING:
+                # the default of requests may have the encodings aiohttp can not decode, e.g. zstd
+                headers['Accept-Encoding'] = 'gzip, deflate'
+
+            self.session = _get_pool_session()
+            self.requests_session = session
+            self.kwargs = {
+                'headers': dict(headers),
+                'data': self.prepared.body,
+                'allow_redirects': allow_redirects,
+                'proxy': proxies.get(urlsplit(self.prepared.url).scheme) or proxies.get('all'),
+                'ssl': _ssl_option(verify),
+                'timeout': _client_timeout(timeout),
+            }
+        else:
+            self.prepared = requests.Request(method, url).prepare()
+            self.session = session
+            self.requests_session = None
+            if isinstance(kwargs.get('timeout'), (int, float, tuple)):
+                kwargs['timeout'] = _client_timeout(kwargs['timeout'])
+            self.kwargs = kwargs
+
+        self.cached = self.cache.get(method, self.prepared.url) if self.cache is not None else None
+        if self.cached is not None:
+            # revalidated with conditional requests, see CachedHTTPAdapter
+            headers = CaseInsensitiveDict(self.cached[0]['headers'])
+            request_headers = CaseInsensitiveDict(self.kwargs['headers'])
+            if headers.get('ETag'):
+                request_headers.setdefault('If-None-Match', headers['ETag'])
+            if headers.get('Last-Modified'):
+                request_headers.setdefault('If-Modified-Since', headers['Last-Modified'])
+            self.kwargs['headers'] = dict(request_headers)
+
+    def save_cookies(self, resp: aiohttp.ClientResponse):
+        if self.requests_session is not None:
+            for name, morsel in resp.cookies.items():
+                self.requests_session.cookies.set(name, morsel.value, domain=morsel['domain'] or resp.url.host,
+                                                  path=morsel['path'] or '/')
+
+
+async def _send(session, method, url, *, max_retries: int, sleep_time: float, backoff_factor: float,
+                read_body: bool, kwargs: dict):
+    if isinstance(session, (list, tuple)):
+        session = random.choice(session)
+    request = _Request(session, method, url, kwargs)
+
+    resp = None
+    for i in range(max_retries):
+        if resp is not None:
+            resp.release()
+        try:
+            resp = await request.session.request(method, request.prepared.url, **request.kwargs)
+            if read_body:
+                await resp.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            logging.error(f'Request error - {err!r}')
+            resp = None
+            await asyncio.sleep(sleep_time)
+            continue
+
+        request.save_cookies(resp)
+        if resp.status in RETRY_STATUS_CODES and i + 1 < max_retries:
+            delay = get_retry_after(resp.headers)
+            if delay is None:
+                delay = backoff_factor * (2 ** i)
+            logging.warning(f'Status {resp.status} for {url!r}, retry after {delay:.1f}s ...')
+            await asyncio.sleep(delay)
+            continue
+        break
+
+    assert resp is not None, f'Request failed for {max_retries} time(s).'
+    return request, resp
+
+
+def _to_requests_response(request: _Request, resp: aiohttp.ClientResponse, body: bytes) -> requests.Response:
+    response = requests.Response()
+    response.status_code = resp.status
+    response.reason = resp.reason
+    response.headers = CaseInsensitiveDict(resp.headers)
+    response.encoding = get_encoding_from_headers(response.headers)
+    response._content = body
+    response._content_consumed = True
+    response.url = str(resp.url)
+    response.request = request.prepared
+    return response
+
+
+async def asrequest(session: Union[requests.Session, aiohttp.ClientSession, List], method, url, *,
+                    max_retries: int = 5, sleep_time: float = 5.0, backoff_factor: float = 1.0,
+                    raise_for_status: bool = True, **kwargs) -> requests.Response:
+    """
+    Send a request asynchronously, the coroutine equivalent of :func:`srequest`.
+
+    Connection errors are retried after ``sleep_time`` seconds, and the status codes retried by
+    :func:`get_requests_session` are retried with exponential backoff (or the ``Retry-After`` header
+    when the server provides one).
+
+    The requests sessions of :func:`get_requests_session` can be used, their headers, cookies, proxies,
+    ``verify``, timeout and :class:`HTTPCache` are applied to the requests, which share one aiohttp
+    connection pool of the running event loop. The keyword arguments are the ones of ``requests``
+    for them, and the ones of ``aiohttp`` for the aiohttp sessions.
+
+    The body is read before returning, and the response is returned as a ``requests.Response``,
+    so it can be used in the same way as the response of :func:`srequest`.
+
+    :param session: The requests Session or aiohttp ClientSession object (or a list of them) to use.
+    :type session: Union[requests.Session, aiohttp.ClientSession, List]
+    :param method: The HTTP method for the request.
+    :type method: str
+    :param url: The URL for the request.
+    :type url: str
+    :param max_retries: The maximum number of retries. (default: 5)
+    :type max_retries: int
+    :param sleep_time: The sleep time between retries on connection errors in seconds. (default: 5.0)
+    :type sleep_time: float
+    :param backoff_factor: The backoff factor for retried status codes. (default: 1.0)
+    :type backoff_factor: float
+    :param raise_for_status: Whether to raise an exception for non-successful response status codes. (default: True)
+    :type raise_for_status: bool
+    :param kwargs: Additional keyword arguments for the request.
+    :type kwargs: dict
+    :returns: The response from the request, with its body already read.
+    :rtype: requests.Response
+    """
+    request, resp = await _send(session, method, url, max_retries=max_retries, sleep_time=sleep_time,
+                                backoff_factor=backoff_factor, read_body=True, kwargs=kwargs)
+    response = _to_requests_response(request, resp, await resp.read())
+    resp.release()
+
+    if resp.status == 304 and request.cached is not None:
+        logging.debug(f'Not modified, using cached response of {response.url!r}.')
+        response = request.cache.build_response(*request.cached, request.prepared)
+    elif request.cache is not None and resp.status == 200 and \
+            ('ETag' in response.headers or 'Last-Modified' in response.headers):
+        request.cache.set('GET', request.prepared.url, response)
+
+    if raise_for_status:
+        response.raise_for_status()
+    return response
+
+
+@asynccontextmanager
+async def astream(session: Union[requests.Session, aiohttp.ClientSession, List], method, url, *,
+                  max_retries: int = 5, sleep_time: float = 5.0, backoff_factor: float = 1.0,
+                  raise_for_status: bool = True, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+    """
+    Send a request like :func:`asrequest`, but the body is not read, for streaming the large contents.
+    The response is released when exited, and the HTTP cache is not used.
+
+    Example::
+
+        >>> async with astream(session, 'GET', url) as resp:
+        ...     async for chunk in resp.content.iter_chunked(1 << 20):
+        ...         f.write(chunk)
+
+    :returns: The aiohttp response, its body not read yet.
+    """
+    request, resp = await _send(session, method, url, max_retries=max_retries, sleep_time=sleep_time,
+                                backoff_factor=backoff_factor, read_body=False, kwargs=kwargs)
+    try:
+        if raise_for_status:
+            resp.raise_for_status()
+        yield resp
+    finally:
+        resp.release()
+
+
+def srequest(session: Union[requests.Session, List[requests.Session]], method, url, *, max_retries: int = 5,
+             sleep_time: float = 5.0, raise_for_status: bool = True, **kwargs) -> requests.Response:
+    """
+    Send a request using the provided session object with retry and timeout settings.
+
+    It is the blocking wrapper of :func:`asrequest`, the request is sent in the event loop of
+    :func:`get_event_loop`. The body is always read, even when ``stream`` is given.
+
+    :param session: The requests Session object (or a list of them) to use for the request.
+    :type session: requests.Session
+    :param method: The HTTP method for the request.
+    :type method: str
+    :param url: The URL for the request.
+    :type url: str
+    :param max_retries: The maximum number of retries. (default: 5)
+    :type max_retries: int
+    :param sleep_time: The sleep time between retries in seconds. (default: 5.0)
+    :type sleep_time: float
+    :param raise_for_status: Whether to raise an exception for non-successful response status codes. (default: True)
+    :type raise_for_status: bool
+    :param kwargs: Additional keyword arguments for the request.
+    :type kwargs: dict
+    :returns: The response from the request.
+    :rtype: requests.Response
+    """
+    return run_async(asrequest(session, method, url, max_retries=max_retries, sleep_time=sleep_time,
+                               raise_for_status=raise_for_status, **kwargs))
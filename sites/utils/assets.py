@@ -0,0 +1,180 @@
+import datetime
+import hashlib
+import os
+from threading import Lock
+from typing import Optional, List, Dict, Tuple
+
+from ditk import logging
+from hbutils.string import plural_word
+from hfutils.operate import get_hf_client
+from hfutils.utils import walk_files, hf_normpath
+from huggingface_hub import CommitOperationAdd, CommitOperationDelete
+
+
+def _sha256(filename: str) -> str:
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class AssetManifest:
+    """
+    Manifest of the files of a local directory which are already in the repository.
+
+    Each file is recorded as its size, mtime and sha256, a file is only hashed again when its size or
+    mtime changed, so the unchanged cover images are neither hashed nor uploaded again on each deployment.
+
+    :param local_directory: The local directory mirroring the repository.
+    :type local_directory: str
+    """
+
+    def __init__(self, local_directory: str):
+        self.local_directory = local_directory
+        self._entries: Dict[str, Tuple[int, int, str]] = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _scan(self, files: Optional[List[str]] = None) -> Dict[str, Tuple[int, int, str]]:
+        retval = {}
+        for file in (files if files is not None else walk_files(self.local_directory)):
+            st = os.stat(os.path.join(self.local_directory, file))
+            entry = self._entries.get(hf_normpath(file))
+            if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                sha = entry[2]
+            else:
+                sha = _sha256(os.path.join(self.local_directory, file))
+            retval[hf_normpath(file)] = (st.st_size, st.st_mtime_ns, sha)
+        return retval
+
+    def mark_uploaded(self, files: Optional[List[str]] = None):
+        """
+        Mark the files as already in the repository.
+
+        :param files: Relative paths of the files, all the files in the directory when not given.
+        :type files: Optional[List[str]]
+        """
+        entries = self._scan(files)
+        with self._lock:
+            self._entries.update(entries)
+
+    def mark_in_repository(self, files: List[str]):
+        """
+        Mark the files as in the repository without local copies, they are deleted from the repository
+        by :func:`upload_changed_files` unless they are written locally before.
+
+        :param files: Relative paths of the files.
+        :type files: List[str]
+        """
+        with self._lock:
+            for file in files:
+                self._entries.setdefault(hf_normpath(file), (-1, -1, ''))
+
+    def removed_files(self) -> List[str]:
+        """
+        Get the files which are in the repository, but removed from the local directory.
+
+        :returns: Relative paths of the removed files.
+        :rtype: List[str]
+        """
+        with self._lock:
+            files = list(self._entries)
+        return sorted(file for file in files if not os.path.exists(os.path.join(self.local_directory, file)))
+
+    def mark_removed(self, files: List[str]):
+        """
+        Mark the files as removed from the repository.
+
+        :param files: Relative paths of the files.
+        :type files: List[str]
+        """
+        with self._lock:
+            for file in files:
+                self._entries.pop(hf_normpath(file), None)
+
+    def changed_files(self) -> List[str]:
+        """
+        Get the files which are new or changed since they were marked as uploaded.
+
+        :returns: Relative paths of the changed files.
+        :rtype: List[str]
+        """
+        retval = []
+        for file in walk_files(self.local_directory):
+            path = os.path.join(self.local_directory, file)
+            file = hf_normpath(file)
+            entry = self._entries.get(file)
+            if entry is None:
+                retval.append(file)
+                continue
+
+            st = os.stat(path)
+            if entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+                continue
+            if entry[0] == st.st_size and entry[2] == _sha256(path):
+                with self._lock:
+                    # only touched, no need to hash it again next time
+                    self._entries[file] = (st.st_size, st.st_mtime_ns, entry[2])
+            else:
+                retval.append(file)
+        return sorted(retval)
+
+
+def upload_changed_files(manifest: AssetManifest, repo_id: str, repo_type: str = 'dataset',
+                         path_in_repo: str = '.', message: Optional[str] = None,
+                         revision: str = 'main') -> List[str]:
+    """
+    Upload the new or changed files of the manifest directory in one commit, and mark them as uploaded.
+    The files removed from the directory since they were uploaded are deleted from the repository in the same commit.
+
+    This is the incremental version of :func:`hfutils.operate.upload_directory_as_directory`.
+
+    :param manifest: Manifest of the local directory.
+    :type manifest: AssetManifest
+    :param repo_id: Repository to upload to.
+    :type repo_id: str
+    :param repo_type: Type of the repository. (default: ``dataset``)
+    :type repo_type: str
+    :param path_in_repo: Directory in the repository. (default: ``.``)
+    :type path_in_repo: str
+    :param message: Commit message, suffixed with the current time.
+    :type message: Optional[str]
+    :param revision: Revision to commit to. (default: ``main``)
+    :type revision: str
+    :returns: Relative paths of the uploaded files.
+    :rtype: List[str]
+    """
+    files = manifest.changed_files()
+    removed_files = manifest.removed_files()
+    if not files and not removed_files:
+        logging.info(f'No changed files in {manifest.local_directory!r}, upload skipped.')
+        return files
+
+    logging.info(f'Uploading {plural_word(len(files), "changed file")} and deleting '
+                 f'{plural_word(len(removed_files), "removed file")}, '
+                 f'{plural_word(len(manifest), "file")} already in repository ...')
+    current_time = datetime.datetime.now().astimezone().strftime('%Y-%m-%d %H:%M:%S %Z')
+    get_hf_client().create_commit(
+        repo_id=repo_id,
+        repo_type=repo_type,
+        revision=revision,
+        operations=[
+            *(
+                CommitOperationAdd(
+                    path_in_repo=hf_normpath(os.path.join(path_in_repo, file)),
+                    path_or_fileobj=os.path.join(manifest.local_directory, file),
+                ) for file in files
+            ),
+            *(
+                CommitOperationDelete(path_in_repo=hf_normpath(os.path.join(path_in_repo, file)))
+                for file in removed_files
+            ),
+        ],
+        commit_message=f'{message or "Upload changed files"}, on {current_time}',
+    )
+    manifest.mark_uploaded(files)
+    manifest.mark_removed(removed_files)
+    return files
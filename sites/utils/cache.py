@@ -0,0 +1,206 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, Tuple, Any
+
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+def get_cache_dir(*segments: str) -> str:
+    """
+    Get the local cache directory of this project, ``ANIME_SITES_CACHE_DIR`` is used when set,
+    otherwise ``~/.cache/anime_sites``.
+
+    :param segments: Sub-directory segments inside the cache directory.
+    :type segments: str
+    :returns: The created cache directory.
+    :rtype: str
+    """
+    root = os.environ.get('ANIME_SITES_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'anime_sites')
+    directory = os.path.join(root, *segments)
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+# these headers describe the transferred body, but the cached body is stored decoded
+_DROPPED_HEADERS = {'content-encoding', 'content-length', 'transfer-encoding', 'connection'}
+
+
+class HTTPCache:
+    """
+    Persistent on-disk cache of HTTP response bodies, with LRU eviction by total size.
+
+    Each entry is stored as a ``.body`` file and a ``.json`` metadata file (url, status, headers),
+    the modification time of the metadata file is used as the last access time.
+
+    :param directory: Directory to store the cache entries.
+    :type directory: str
+    :param max_size: Maximum total size of the cached bodies in bytes. (default: 1 GiB)
+    :type max_size: int
+    """
+
+    def __init__(self, directory: str, max_size: int = 1 << 30):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> body size, least recently used first
+        self._total_size = 0
+        self._load()
+
+    def _load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        items = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                key = name[:-len('.json')]
+                meta_file, body_file = self._paths(key)
+                if os.path.exists(body_file):
+                    items.append((os.path.getmtime(meta_file), key, os.path.getsize(body_file)))
+        for _, key, size in sorted(items):
+            self._entries[key] = size
+            self._total_size += size
+
+    @classmethod
+    def make_key(cls, method: str, url: str) -> str:
+        return hashlib.sha256(f'{method.upper()} {url}'.encode()).hexdigest()
+
+    def _paths(self, key: str) -> Tuple[str, str]:
+        return os.path.join(self.directory, f'{key}.json'), os.path.join(self.directory, f'{key}.body')
+
+    def get(self, method: str, url: str) -> Optional[Tuple[dict, bytes]]:
+        key = self.make_key(method, url)
+        with self._lock:
+            if key not in self._entries:
+                return None
+            meta_file, body_file = self._paths(key)
+            try:
+                with open(meta_file, 'r') as f:
+                    meta = json.load(f)
+                with open(body_file, 'rb') as f:
+                    body = f.read()
+            except (OSError, ValueError) as err:
+                logging.warning(f'Broken cache entry for {url!r}, dropped - {err!r}')
+                self._remove(key)
+                return None
+
+            os.utime(meta_file)
+            self._entries.move_to_end(key)
+            return meta, body
+
+    def set(self, method: str, url: str, response: requests.Response):
+        key = self.make_key(method, url)
+        body = response.content
+        meta = {
+            'url': url,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {k: v for k, v in response.headers.items() if k.lower() not in _DROPPED_HEADERS},
+        }
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            meta_file, body_file = self._paths(key)
+            with open(f'{body_file}.tmp', 'wb') as f:
+                f.write(body)
+            os.replace(f'{body_file}.tmp', body_file)
+            with open(f'{meta_file}.tmp', 'w') as f:
+                json.dump(meta, f)
+            os.replace(f'{meta_file}.tmp', meta_file)
+
+            self._entries[key] = len(body)
+            self._total_size += len(body)
+            while self._total_size > self.max_size and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        self._total_size -= self._entries.pop(key, 0)
+        for file in self._paths(key):
+            if os.path.exists(file):
+                os.remove(file)
+
+    def build_response(self, meta: dict, body: bytes, request: requests.PreparedRequest) -> requests.Response:
+        response = requests.Response()
+        response.status_code = meta['status']
+        response.reason = meta.get('reason')
+        response.headers = CaseInsensitiveDict(meta['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = body
+        response.url = request.url
+        response.request = request
+        response.from_cache = True
+        return response
+
+
+@lru_cache()
+def get_http_cache() -> HTTPCache:
+    return HTTPCache(get_cache_dir('http'))
+
+
+class KVCache:
+    """
+    Persistent key-value cache of JSON-serializable values, stored in a table of a SQLite file.
+
+    Several caches can share one file by using different tables. Hits and misses are counted,
+    so the saving of a run can be reported.
+
+    :param path: Path of the SQLite file.
+    :type path: str
+    :param table: Name of the table. (default: ``kv``)
+    :type table: str
+    :param ttl: Default time to live of the records in seconds, ``None`` means never expire. (default: None)
+    :type ttl: Optional[float]
+    """
+
+    def __init__(self, path: str, table: str = 'kv', ttl: Optional[float] = None):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.hits, self.misses = 0, 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(f'CREATE TABLE IF NOT EXISTS "{table}" '
+                               f'(key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)')
+
+    def get(self, key: str, ttl: Optional[float] = None, default: Any = None) -> Any:
+        ttl = ttl if ttl is not None else self.ttl
+        with self._lock:
+            row = self._conn.execute(f'SELECT value, updated_at FROM "{self.table}" WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None or (ttl is not None and row[1] + ttl < time.time()):
+                self.misses += 1
+                return default
+            else:
+                self.hits += 1
+                return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        with self._lock, self._conn:
+            self._conn.execute(f'INSERT OR REPLACE INTO "{self.table}" (key, value, updated_at) VALUES (?, ?, ?)',
+                               (key, json.dumps(value), time.time()))
+
+    def delete(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute(f'DELETE FROM "{self.table}" WHERE key = ?', (key,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(f'SELECT COUNT(*) FROM "{self.table}"').fetchone()[0]
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        return f'{self.table}: {self.hits} hit(s), {self.misses} miss(es), hit ratio {ratio:.1%}'
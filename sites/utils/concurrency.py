@@ -0,0 +1,49 @@
+from contextlib import contextmanager
+from threading import Lock, BoundedSemaphore
+
+_DEFAULT_LIMITS = {
+    'jikan': 2,
+    'site': 4,
+    'llm': 16,
+}
+_SEMAPHORES = {}
+_LOCK = Lock()
+
+
+def set_concurrency_limit(name: str, limit: int):
+    """
+    Set the maximum number of concurrent calls of the named resource (e.g. ``jikan``, ``site``, ``llm``).
+
+    Calls already holding the previous limit are not affected.
+
+    :param name: Name of the resource.
+    :type name: str
+    :param limit: Maximum number of concurrent calls.
+    :type limit: int
+    """
+    with _LOCK:
+        _SEMAPHORES[name] = BoundedSemaphore(limit)
+
+
+def _get_semaphore(name: str) -> BoundedSemaphore:
+    with _LOCK:
+        if name not in _SEMAPHORES:
+            _SEMAPHORES[name] = BoundedSemaphore(_DEFAULT_LIMITS.get(name, 1))
+        return _SEMAPHORES[name]
+
+
+@contextmanager
+def concurrency_limit(name: str):
+    """
+    Hold one slot of the named resource while running the block.
+
+    Example::
+
+        >>> with concurrency_limit('llm'):
+        ...     response = client.chat.completions.create(...)
+
+    :param name: Name of the resource.
+    :type name: str
+    """
+    with _get_semaphore(name):
+        yield
@@ -0,0 +1,126 @@
+import datetime
+import email.utils
+import logging
+import re
+from functools import lru_cache
+from threading import Lock
+from typing import Optional, Tuple
+
+import dateparser
+
+# known formats of erai-raws and subsplease, tried in order before dateparser
+_FORMATS = [
+    '%m/%d/%y',
+    '%m/%d/%Y',
+    '%m/%d/%y %H:%M',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%y %I:%M %p',
+    '%m/%d/%Y %I:%M %p',
+    '%Y-%m-%d',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d %H:%M:%S',
+    '%b %d, %Y',
+    '%B %d, %Y',
+    '%b %d, %Y %H:%M',
+    '%B %d, %Y %H:%M',
+    '%d %b %Y',
+    '%d %B %Y',
+]
+_RFC2822_PATTERN = re.compile(r'^(?:[A-Za-z]{3}, )?\d{1,2} [A-Za-z]{3} \d{4} \d{2}:\d{2}(?::\d{2})? ')
+
+_STATS_LOCK = Lock()
+_fast_count, _fallback_count = 0, 0
+
+
+@lru_cache(maxsize=1 << 16)
+def _parse_fast(text: str) -> Optional[datetime.datetime]:
+    if _RFC2822_PATTERN.match(text):
+        try:
+            return email.utils.parsedate_to_datetime(text)
+        except (TypeError, ValueError):
+            pass
+
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        pass
+
+    for fmt in _FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            pass
+
+    return None
+
+
+def parse_datetime(text: str) -> datetime.datetime:
+    """
+    Parse the release time strings of the sites.
+
+    The known formats are parsed with :func:`datetime.datetime.strptime`, and :mod:`dateparser` is only
+    used for the unknown ones. Results of the known formats are memoized, so repeated strings are parsed
+    only once (the fallback is not memoized, for relative dates like ``2 hours ago``).
+
+    :param text: Text to parse.
+    :type text: str
+    :returns: The parsed datetime, naive when no timezone is given in the text (like :mod:`dateparser`).
+    :rtype: datetime.datetime
+    :raises ValueError: When the text can not be parsed.
+    """
+    global _fast_count, _fallback_count
+    text = ' '.join(text.split())
+    dt = _parse_fast(text)
+    if dt is not None:
+        with _STATS_LOCK:
+            _fast_count += 1
+        return dt
+
+    logging.warning(f'Unknown date format {text!r}, parsing with dateparser.')
+    with _STATS_LOCK:
+        _fallback_count += 1
+    dt = dateparser.parse(text)
+    if dt is None:
+        raise ValueError(f'Unable to parse date {text!r}.')
+    return dt
+
+
+def parse_timestamp(text: str) -> float:
+    """
+    Parse the release time strings into timestamps, see :func:`parse_datetime`.
+
+    :param text: Text to parse.
+    :type text: str
+    :returns: Timestamp in seconds.
+    :rtype: float
+    """
+    return parse_datetime(text).timestamp()
+
+
+def date_parse_counts() -> Tuple[int, int]:
+    """
+    Get the numbers of strings parsed by the known formats and by the dateparser fallback in the current process.
+    """
+    with _STATS_LOCK:
+        return _fast_count, _fallback_count
+
+
+def add_date_parse_counts(fast_count: int, fallback_count: int):
+    """
+    Add the counts of the strings parsed in other processes (see :func:`date_parse_counts`), so they are
+    reported by :func:`date_parse_stats` of this process.
+    """
+    global _fast_count, _fallback_count
+    with _STATS_LOCK:
+        _fast_count += fast_count
+        _fallback_count += fallback_count
+
+
+def date_parse_stats() -> str:
+    """
+    Report how many strings were parsed by the known formats and by the dateparser fallback in the current process.
+    """
+    with _STATS_LOCK:
+        total = _fast_count + _fallback_count
+        ratio = _fallback_count / total if total else 0.0
+        return f'dates: {_fast_count} known format(s), {_fallback_count} fallback(s), fallback ratio {ratio:.1%}'
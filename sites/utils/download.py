@@ -1,11 +1,14 @@
+import hashlib
 import os
-from contextlib import contextmanager
+from contextlib import contextmanager, AsyncExitStack
+from typing import Optional
 
 import pyrfc6266
 import requests
 from tqdm.auto import tqdm
 
-from .session import srequest, get_requests_session
+from .asession import astream, run_async
+from .session import get_requests_session
 
 
 class _FakeClass:
@@ -14,41 +17,141 @@ class _FakeClass:
 
 
 @contextmanager
-def _with_tqdm(expected_size, desc, silent: bool = False):
+def _with_tqdm(expected_size, desc, silent: bool = False, initial: int = 0):
     if not silent:
-        with tqdm(total=expected_size, unit='B', unit_scale=True, unit_divisor=1024, desc=desc) as pbar:
+        with tqdm(total=expected_size, initial=initial, unit='B', unit_scale=True, unit_divisor=1024,
+                  desc=desc) as pbar:
             yield pbar
     else:
         yield _FakeClass()
 
 
-def download_file(url, filename=None, output_directory=None,
-                  expected_size: int = None, desc=None, session=None, silent: bool = False,
-                  **kwargs):
+_MIN_CHUNK_SIZE = 64 << 10
+_MAX_CHUNK_SIZE = 4 << 20
+_DEFAULT_CHUNK_SIZE = 1 << 20
+
+
+def _get_chunk_size(expected_size: Optional[int]) -> int:
+    if expected_size is None:
+        return _DEFAULT_CHUNK_SIZE
+    else:
+        return min(max(expected_size // 16, _MIN_CHUNK_SIZE), _MAX_CHUNK_SIZE)
+
+
+async def adownload_file(url, filename=None, output_directory=None,
+                         expected_size: int = None, desc=None, session=None, silent: bool = False,
+                         expected_hash: Optional[str] = None, hash_algorithm: str = 'sha256', resume: bool = True,
+                         chunk_size: Optional[int] = None, **kwargs):
+    """
+    Download a file asynchronously, the content is streamed with :func:`astream`.
+
+    The content is written to ``<filename>.part`` and renamed to ``filename`` only when it is complete
+    and verified, so the destination never holds a half-written file. When ``resume`` is enabled and a
+    partial file is left by an interrupted download, the rest is requested with an HTTP ``Range``
+    header (the download restarts from the full response when the server does not support ranges).
+
+    :param url: URL to download.
+    :param filename: Destination file, taken from ``Content-Disposition`` when not given.
+    :param output_directory: Directory of the destination file.
+    :param expected_size: Expected size in bytes, ``Content-Length`` is used when not given.
+    :param desc: Description of the progress bar.
+    :param session: Requests session to use, its headers, cookies and proxies are applied, see :func:`asrequest`.
+    :param silent: Hide the progress bar. (default: False)
+    :param expected_hash: Expected hex digest of the content, not checked when not given.
+    :param hash_algorithm: Algorithm of ``expected_hash``, any name supported by :mod:`hashlib`. (default: sha256)
+    :param resume: Resume from the partial file left by a previous try, the partial file is removed
+        on failure when disabled. (default: True)
+    :param chunk_size: Chunk size in bytes, chosen from the expected size when not given.
+    :param kwargs: Additional keyword arguments for the request.
+    :returns: The downloaded filename.
+    """
     session = session or get_requests_session()
-    response = srequest(session, 'GET', url, stream=True, allow_redirects=True, **kwargs)
-    expected_size = expected_size or response.headers.get('Content-Length', None)
-    if filename is None:
-        filename = pyrfc6266.parse_filename(response.headers.get('Content-Disposition'))
-    if output_directory is not None:
+    if filename is not None and output_directory is not None:
         filename = os.path.join(output_directory, filename)
-    expected_size = int(expected_size) if expected_size is not None else expected_size
+    headers = dict(kwargs.pop('headers', None) or {})
 
-    desc = desc or os.path.basename(filename)
-    directory = os.path.dirname(filename)
-    if directory:
-        os.makedirs(directory, exist_ok=True)
+    resumed_size = 0
+    if resume and filename is not None and os.path.exists(f'{filename}.part'):
+        resumed_size = os.path.getsize(f'{filename}.part')
 
-    with open(filename, 'wb') as f:
-        with _with_tqdm(expected_size, desc, silent) as pbar:
-            for chunk in response.iter_content(chunk_size=1024):
-                f.write(chunk)
-                pbar.update(len(chunk))
+    async with AsyncExitStack() as stack:
+        if resumed_size:
+            response = await stack.enter_async_context(astream(
+                session, 'GET', url, allow_redirects=True, raise_for_status=False,
+                headers={**headers, 'Range': f'bytes={resumed_size}-'}, **kwargs))
+            content_range = response.headers.get('Content-Range') or ''
+            if response.status == 200:
+                # range ignored, the full content is in this response, the partial file is truncated
+                resumed_size = 0
+            elif response.status != 206 or not content_range.startswith(f'bytes {resumed_size}-'):
+                # 416 or other errors, restart with a plain request
+                response.release()
+                resumed_size = 0
+                response = await stack.enter_async_context(astream(
+                    session, 'GET', url, allow_redirects=True, headers=headers, **kwargs))
+        else:
+            response = await stack.enter_async_context(astream(
+                session, 'GET', url, allow_redirects=True, headers=headers, **kwargs))
 
-    actual_size = os.path.getsize(filename)
+        if expected_size is None and response.headers.get('Content-Length') is not None:
+            expected_size = resumed_size + int(response.headers['Content-Length'])
+        expected_size = int(expected_size) if expected_size is not None else expected_size
+        if filename is None:
+            filename = pyrfc6266.parse_filename(response.headers.get('Content-Disposition'))
+            if output_directory is not None:
+                filename = os.path.join(output_directory, filename)
+        part_filename = f'{filename}.part'
+
+        desc = desc or os.path.basename(filename)
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        hasher = hashlib.new(hash_algorithm) if expected_hash else None
+        if hasher is not None and resumed_size:
+            with open(part_filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(_MAX_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+
+        try:
+            with open(part_filename, 'ab' if resumed_size else 'wb') as f:
+                with _with_tqdm(expected_size, desc, silent, initial=resumed_size) as pbar:
+                    async for chunk in response.content.iter_chunked(chunk_size or _get_chunk_size(expected_size)):
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+                        pbar.update(len(chunk))
+        except BaseException:
+            if not resume and os.path.exists(part_filename):
+                os.remove(part_filename)
+            raise
+
+    actual_size = os.path.getsize(part_filename)
     if expected_size is not None and actual_size != expected_size:
-        os.remove(filename)
+        if not resume or actual_size > expected_size:
+            os.remove(part_filename)
         raise requests.exceptions.HTTPError(f"Downloaded file is not of expected size, "
                                             f"{expected_size} expected but {actual_size} found.")
+    if hasher is not None and hasher.hexdigest().lower() != expected_hash.lower():
+        os.remove(part_filename)
+        raise requests.exceptions.HTTPError(f"Downloaded file is not of expected {hash_algorithm} hash, "
+                                            f"{expected_hash!r} expected but {hasher.hexdigest()!r} found.")
 
+    os.replace(part_filename, filename)
     return filename
+
+
+def download_file(url, filename=None, output_directory=None,
+                  expected_size: int = None, desc=None, session=None, silent: bool = False,
+                  expected_hash: Optional[str] = None, hash_algorithm: str = 'sha256', resume: bool = True,
+                  chunk_size: Optional[int] = None, **kwargs):
+    """
+    Download a file, the blocking wrapper of :func:`adownload_file`, which runs in the event loop of
+    :func:`get_event_loop`. See :func:`adownload_file` for the arguments.
+
+    :returns: The downloaded filename.
+    """
+    return run_async(adownload_file(
+        url, filename=filename, output_directory=output_directory, expected_size=expected_size, desc=desc,
+        session=session, silent=silent, expected_hash=expected_hash, hash_algorithm=hash_algorithm,
+        resume=resume, chunk_size=chunk_size, **kwargs))
@@ -1,8 +1,18 @@
+import hashlib
+import json
+import logging
 import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from functools import lru_cache
+from typing import Callable, Optional, List, Any
 
 from openai import OpenAI
 
+from .cache import KVCache, get_cache_dir
+from .concurrency import concurrency_limit
+from .prompt import estimate_tokens
+
 
 @lru_cache()
 def get_openai_client():
@@ -10,3 +20,128 @@ def get_openai_client():
         base_url=os.environ['LLM_SITE'],
         api_key=os.environ['LLM_API_KEY']
     )
+
+
+def _get_llm_cache_ttl() -> Optional[float]:
+    # the answers never expire unless ANIME_SITES_LLM_CACHE_TTL is set, in seconds
+    ttl = os.environ.get('ANIME_SITES_LLM_CACHE_TTL')
+    return float(ttl) if ttl else None
+
+
+@lru_cache()
+def get_llm_cache() -> KVCache:
+    return KVCache(os.path.join(get_cache_dir('llm'), 'llm.sqlite'), table='responses', ttl=_get_llm_cache_ttl())
+
+
+def ask_llm(system_text: str, message: str, model_name: str, sample_index: int = 0,
+            use_cache: bool = True, refresh: bool = False) -> str:
+    """
+    Ask the LLM model, replaying the stored answer when the same question was asked before.
+
+    Answers are stored by the hash of (model, system text, user message, sample index), so the
+    several samples of one question used for voting are kept apart.
+
+    :param system_text: The system prompt.
+    :param message: The user message.
+    :param model_name: Name of the model.
+    :param sample_index: Index of the sample for the same question. (default: 0)
+    :param use_cache: Use the response cache. (default: True)
+    :param refresh: Ignore the stored answer and overwrite it, e.g. when it can not be parsed. (default: False)
+    :returns: The stripped response text.
+    """
+    cache = get_llm_cache() if use_cache else None
+    key = hashlib.sha256(json.dumps([model_name, system_text, message, sample_index]).encode()).hexdigest()
+    if cache is not None and not refresh:
+        resp_text = cache.get(key)
+        if resp_text is not None:
+            logging.info(f'Using cached LLM response {key[:12]!r}.')
+            return resp_text
+
+    logging.info(f'Asking LLM model {model_name!r} with about '
+                 f'{estimate_tokens(system_text) + estimate_tokens(message)} prompt tokens ...')
+    client = get_openai_client()
+    with concurrency_limit('llm'):
+        response = client.chat.completions.create(
+            model=model_name,
+            messages=[
+                {'role': 'system', 'content': system_text},
+                {"role": "user", "content": message},
+            ],
+        )
+    resp_text = response.choices[0].message.content.strip()
+    if cache is not None:
+        cache.set(key, resp_text)
+    return resp_text
+
+
+def _is_determined(counts: dict, remaining: int, min_val: int) -> bool:
+    best = max((count for k, count in counts.items() if k is not None), default=0)
+    return best >= min_val or best + remaining < min_val
+
+
+def parallel_vote(fn: Callable[[int], dict], val_times: int = 5, min_val: int = 4,
+                  max_workers: Optional[int] = None, key: Callable[[dict], Any] = lambda x: x['mal_id']) -> List[dict]:
+    """
+    Run up to ``val_times`` votes concurrently, stopping early once the result is determined.
+
+    Voting stops as soon as one non-``None`` key gets ``min_val`` votes, or when no key can reach
+    ``min_val`` anymore with the remaining votes. Votes which are not started yet are cancelled,
+    so with ``max_workers`` defaulting to ``min_val`` a clear-cut case only costs ``min_val`` calls.
+
+    :param fn: Function to get one vote, the index of the vote is passed to it.
+    :param val_times: Maximum number of votes. (default: 5)
+    :param min_val: Number of agreeing votes required. (default: 4)
+    :param max_workers: Number of votes running at the same time, ``min_val`` when not given.
+    :param key: Function to get the voted key from a vote, ``None`` means no match. (default: ``mal_id``)
+    :returns: The finished votes, in the order of completion.
+    """
+    return batch_vote(lambda index: [fn(index)], 1, val_times=val_times, min_val=min_val,
+                      max_workers=max_workers, key=key)[0]
+
+
+def batch_vote(fn: Callable[[int], List[dict]], size: int, val_times: int = 5, min_val: int = 4,
+               max_workers: Optional[int] = None, key: Callable[[dict], Any] = lambda x: x['mal_id']) \
+        -> List[List[dict]]:
+    """
+    Batched version of :func:`parallel_vote`, each call of ``fn`` returns one vote for every item of a batch.
+
+    Voting stops once every item of the batch is determined in the way of :func:`parallel_vote`.
+
+    :param fn: Function to get one round of votes, the index of the round is passed to it.
+    :param size: Number of items in the batch, ``fn`` should return the votes in the order of the items.
+    :param val_times: Maximum number of rounds. (default: 5)
+    :param min_val: Number of agreeing votes required. (default: 4)
+    :param max_workers: Number of rounds running at the same time, ``min_val`` when not given.
+    :param key: Function to get the voted key from a vote, ``None`` means no match. (default: ``mal_id``)
+    :returns: The finished votes of each item.
+    """
+    max_workers = max_workers or min(min_val, val_times)
+    tp = ThreadPoolExecutor(max_workers=max_workers)
+    votes = [[] for _ in range(size)]
+    counts = [defaultdict(lambda: 0) for _ in range(size)]
+    pending, submitted, finished = set(), 0, 0
+    try:
+        while True:
+            while submitted < val_times and len(pending) < max_workers:
+                pending.add(tp.submit(fn, submitted))
+                submitted += 1
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                round_votes = future.result()
+                assert len(round_votes) == size, f'{size} votes expected, but {len(round_votes)} found.'
+                for i, vote in enumerate(round_votes):
+                    votes[i].append(vote)
+                    counts[i][key(vote)] += 1
+                finished += 1
+
+            if all(_is_determined(item_counts, val_times - finished, min_val) for item_counts in counts):
+                break
+    finally:
+        for future in pending:
+            future.cancel()
+        tp.shutdown(wait=False)
+
+    return votes
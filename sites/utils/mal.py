@@ -1,30 +1,153 @@
 import logging
+import os
 import time
 import warnings
-from typing import Optional
+from functools import lru_cache
+from threading import Lock
+from typing import Optional, Callable
 
 import requests
 from pyanimeinfo.myanimelist import JikanV4Client
+from pyrate_limiter import Rate, Limiter, Duration
 from requests import HTTPError
 
-from .session import get_requests_session
+from .cache import KVCache, get_cache_dir
+from .concurrency import concurrency_limit
+from .malindex import MALIndex, get_mal_index
+from .prematch import normalize_title
+from .session import get_requests_session, get_retry_after
 
 
-def get_items_from_myanimelist(title: str, session: Optional[requests.Session] = None):
-    logging.info('Search information from myanimelist ...')
-    session = session or get_requests_session()
-    jikan_client = JikanV4Client(session=session)
+@lru_cache()
+def get_jikan_limiter() -> Limiter:
+    # the public quotas of jikan api, https://docs.api.jikan.moe/#section/Information/Rate-Limiting
+    return Limiter([Rate(3, Duration.SECOND), Rate(60, Duration.MINUTE)], max_delay=1 << 32)
+
+
+_JIKAN_PAUSE_LOCK = Lock()
+_jikan_paused_until = 0.0
+
+
+def _pause_jikan(seconds: float):
+    global _jikan_paused_until
+    with _JIKAN_PAUSE_LOCK:
+        _jikan_paused_until = max(_jikan_paused_until, time.time() + seconds)
+
+
+def _wait_for_jikan():
     while True:
-        try:
-            jikan_items = jikan_client.search_anime(query=title)
-        except HTTPError as err:
-            if err.response.status_code == 429:
-                warnings.warn(f'429 error detected: {err!r}, wait for some seconds ...')
-                time.sleep(5.0)
-            else:
-                raise
-        else:
+        with _JIKAN_PAUSE_LOCK:
+            delay = _jikan_paused_until - time.time()
+        if delay <= 0:
             break
+        time.sleep(delay)
+
+
+def jikan_call(fn: Callable, *args, max_tries: int = 10, sleep_time: float = 5.0, **kwargs):
+    """
+    Call a :class:`JikanV4Client` method through the process-wide jikan rate limiter.
+
+    All the calls share the per-second and per-minute quotas of jikan. When a 429 error is still
+    raised, every jikan call of this process is paused for the time given by ``Retry-After``
+    (``sleep_time`` when not provided) before retrying.
+
+    :param fn: The method to call, e.g. ``jikan_client.search_anime``.
+    :param args: Positional arguments of the method.
+    :param max_tries: Maximum number of tries on 429 errors. (default: 10)
+    :param sleep_time: Pause time in seconds when no ``Retry-After`` is provided. (default: 5.0)
+    :param kwargs: Keyword arguments of the method.
+    :returns: The return value of the method.
+    """
+    tries = 0
+    while True:
+        _wait_for_jikan()
+        with concurrency_limit('jikan'):
+            get_jikan_limiter().try_acquire('jikan')
+            try:
+                return fn(*args, **kwargs)
+            except HTTPError as err:
+                tries += 1
+                if err.response is None or err.response.status_code != 429 or tries >= max_tries:
+                    raise
+                delay = get_retry_after(err.response.headers)
+                delay = delay if delay is not None else sleep_time
+                warnings.warn(f'429 error detected: {err!r}, pause jikan calls for {delay:.1f}s ...')
+                _pause_jikan(delay)
+
+
+MAL_SEARCH_TTL = 3 * 24 * 60 * 60.0
+MAL_ANIME_TTL = 7 * 24 * 60 * 60.0
+
+
+@lru_cache()
+def get_mal_search_cache() -> KVCache:
+    return KVCache(os.path.join(get_cache_dir('mal'), 'mal.sqlite'), table='search', ttl=MAL_SEARCH_TTL)
+
+
+@lru_cache()
+def get_mal_anime_cache() -> KVCache:
+    return KVCache(os.path.join(get_cache_dir('mal'), 'mal.sqlite'), table='anime', ttl=MAL_ANIME_TTL)
+
+
+def get_anime_full_from_myanimelist(mal_id: int, session: Optional[requests.Session] = None,
+                                    use_cache: bool = True) -> dict:
+    cache = get_mal_anime_cache() if use_cache else None
+    mal_info = cache.get(str(mal_id)) if cache is not None else None
+    if mal_info is None:
+        logging.info(f'Getting full information of mal #{mal_id!r} ...')
+        session = session or get_requests_session()
+        jikan_client = JikanV4Client(session=session)
+        mal_info = jikan_call(jikan_client.get_anime_full, mal_id)
+        if cache is not None:
+            cache.set(str(mal_id), mal_info)
+
+    return mal_info
+
+
+# records of these status change over time, so the ones from the local index are refreshed with jikan
+MAL_STALE_STATUSES = {'Currently Airing', 'Not yet aired'}
+# the local index is only trusted when its best name is this similar, jikan is searched for the weak ones
+MAL_INDEX_MIN_TOP_SCORE = 0.6
+# only the most similar stale records are refreshed, the others are not likely to be chosen
+MAL_INDEX_MAX_REFRESH = 3
+
+
+def _search_from_index(index: MALIndex, title: str, session: Optional[requests.Session] = None):
+    scored_items = index.search_with_scores(title)
+    if not scored_items:
+        return None
+    if scored_items[0][1] < MAL_INDEX_MIN_TOP_SCORE:
+        logging.info(f'Best local MAL index score {scored_items[0][1]:.3f} of {title!r} is too low, '
+                     f'searching with jikan.')
+        return None
+
+    logging.info(f'Using {len(scored_items)} record(s) of local MAL index for {title!r}, '
+                 f'best score {scored_items[0][1]:.3f}.')
+    retval = []
+    for i, (item, _) in enumerate(scored_items):
+        if i < MAL_INDEX_MAX_REFRESH and item.get('status') in MAL_STALE_STATUSES:
+            item = get_anime_full_from_myanimelist(item['mal_id'], session=session)
+        retval.append(item)
+    return retval
+
+
+def get_items_from_myanimelist(title: str, session: Optional[requests.Session] = None, use_cache: bool = True,
+                               use_index: bool = True):
+    logging.info('Search information from myanimelist ...')
+    cache = get_mal_search_cache() if use_cache else None
+    query = normalize_title(title)
+    index = get_mal_index() if use_index else None
+    jikan_items = _search_from_index(index, title, session=session) if index is not None else None
+    if jikan_items is None and cache is not None:
+        jikan_items = cache.get(query)
+        if jikan_items is not None:
+            logging.info(f'Using cached search result of {query!r}.')
+    if jikan_items is None:
+        session = session or get_requests_session()
+        jikan_client = JikanV4Client(session=session)
+        jikan_items = jikan_call(jikan_client.search_anime, query=title)
+        if cache is not None:
+            cache.set(query, jikan_items)
 
     type_map = {'tv': 0, 'movie': 1, 'ova': 2, 'ona': 2}
     retval, exist_mal_ids = [], set()
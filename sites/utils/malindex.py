@@ -0,0 +1,148 @@
+import logging
+import time
+from collections import defaultdict
+from threading import Lock
+from typing import List, Optional, Iterable, Tuple
+
+import numpy as np
+import pandas as pd
+
+from .prematch import normalize_title
+from .records import to_plain
+
+
+def _get_ngrams(name: str, n: int = 3) -> List[str]:
+    padded = f' {name} '
+    return list({padded[i:i + n] for i in range(max(len(padded) - n + 1, 1))})
+
+
+def _iter_names(item: dict) -> Iterable[str]:
+    yield item.get('title')
+    yield item.get('title_english')
+    yield item.get('title_japanese')
+    for x in item.get('titles') or []:
+        yield x.get('title')
+    yield from item.get('title_synonyms') or []
+
+
+class MALIndex:
+    """
+    Local candidate index of myanimelist records, used instead of the jikan search.
+
+    All the titles and synonyms of the records are normalized and indexed by their character 3-grams,
+    a query returns the records with the most similar names (by the dice coefficient of the 3-grams),
+    in the same shape as ``JikanV4Client.search_anime``.
+
+    :param records: Anime records in the format of jikan.
+    :type records: List[dict]
+    """
+
+    def __init__(self, records: List[dict]):
+        self.records = list(records)
+        name_records, name_sizes, postings = [], [], defaultdict(list)
+        for ri, item in enumerate(self.records):
+            names = {normalize_title(name) for name in _iter_names(item) if name} - {''}
+            for name in names:
+                ni = len(name_records)
+                grams = _get_ngrams(name)
+                name_records.append(ri)
+                name_sizes.append(len(grams))
+                for gram in grams:
+                    postings[gram].append(ni)
+
+        self._name_records = np.array(name_records, dtype=np.int64)
+        self._name_sizes = np.array(name_sizes, dtype=np.float64)
+        self._postings = {gram: np.array(nis, dtype=np.int64) for gram, nis in postings.items()}
+
+    @classmethod
+    def from_parquet(cls, parquet_file: str) -> 'MALIndex':
+        """
+        Load the index from a parquet dump of anime records, one jikan record per row.
+
+        :param parquet_file: Path of the parquet file.
+        :type parquet_file: str
+        :returns: The loaded index.
+        :rtype: MALIndex
+        """
+        df = pd.read_parquet(parquet_file)
+        records = [
+            {key: to_plain(value) for key, value in item.items()}
+            for item in df.to_dict('records')
+        ]
+        logging.info(f'{len(records)} anime record(s) loaded from {parquet_file!r}.')
+        return cls(records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def search_with_scores(self, title: str, limit: int = 25, min_score: float = 0.35) \
+            -> List[Tuple[dict, float]]:
+        """
+        Search the records by the title, with the scores of them.
+
+        :param title: Title to search.
+        :type title: str
+        :param limit: Maximum number of records. (default: 25, the page size of jikan)
+        :type limit: int
+        :param min_score: Minimum dice coefficient of the names. (default: 0.35)
+        :type min_score: float
+        :returns: Matched records and the dice coefficient of their most similar names, the most similar first.
+        :rtype: List[Tuple[dict, float]]
+        """
+        name = normalize_title(title)
+        if not name:
+            return []
+        grams = _get_ngrams(name)
+        gram_postings = [self._postings[gram] for gram in grams if gram in self._postings]
+        if not gram_postings:
+            return []
+
+        overlaps = np.bincount(np.concatenate(gram_postings), minlength=len(self._name_sizes))
+        scores = 2.0 * overlaps / (len(grams) + self._name_sizes)
+        nis = np.nonzero(scores >= min_score)[0]
+
+        d_scores = {}
+        for ni in nis[np.argsort(-scores[nis], kind='stable')].tolist():
+            ri = int(self._name_records[ni])
+            if ri not in d_scores:
+                d_scores[ri] = float(scores[ni])
+                if len(d_scores) >= limit:
+                    break
+        return [(self.records[ri], score) for ri, score in d_scores.items()]
+
+    def search(self, title: str, limit: int = 25, min_score: float = 0.35) -> List[dict]:
+        """
+        Search the records by the title, see :meth:`search_with_scores`.
+
+        :returns: Matched records, the most similar first.
+        :rtype: List[dict]
+        """
+        return [item for item, _ in self.search_with_scores(title, limit=limit, min_score=min_score)]
+
+
+_INDEX_LOCK = Lock()
+_mal_index: Optional[MALIndex] = None
+
+
+def load_mal_index(parquet_file: Optional[str]) -> Optional[MALIndex]:
+    """
+    Load the process-wide index used by :func:`get_items_from_myanimelist`, ``None`` to unload it.
+
+    :param parquet_file: Path of the parquet dump, see :meth:`MALIndex.from_parquet`.
+    :type parquet_file: Optional[str]
+    :returns: The loaded index.
+    :rtype: Optional[MALIndex]
+    """
+    global _mal_index
+    start = time.time()
+    index = MALIndex.from_parquet(parquet_file) if parquet_file else None
+    with _INDEX_LOCK:
+        _mal_index = index
+    if index is not None:
+        logging.info(f'MAL index of {len(index)} record(s) built in {time.time() - start:.2f}s.')
+    return index
+
+
+def get_mal_index() -> Optional[MALIndex]:
+    with _INDEX_LOCK:
+        return _mal_index
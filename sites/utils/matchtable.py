@@ -0,0 +1,98 @@
+import json
+from typing import Optional
+
+import pyarrow as pa
+
+# scalar fields of the jikan records, stored as the mal_* columns of the matching tables
+_MAL_SCALAR_FIELDS = [
+    ('url', pa.string()),
+    ('approved', pa.bool_()),
+    ('title', pa.string()),
+    ('title_english', pa.string()),
+    ('title_japanese', pa.string()),
+    ('type', pa.string()),
+    ('source', pa.string()),
+    ('episodes', pa.int64()),
+    ('status', pa.string()),
+    ('airing', pa.bool_()),
+    ('duration', pa.string()),
+    ('rating', pa.string()),
+    ('score', pa.float64()),
+    ('scored_by', pa.int64()),
+    ('rank', pa.int64()),
+    ('popularity', pa.int64()),
+    ('members', pa.int64()),
+    ('favorites', pa.int64()),
+    ('synopsis', pa.string()),
+    ('background', pa.string()),
+    ('season', pa.string()),
+    ('year', pa.int64()),
+]
+
+MATCH_SCHEMA = pa.schema([
+    ('mal_id', pa.int64()),
+    ('reason', pa.string()),
+    ('year', pa.int64()),
+    *((f'mal_{name}', type_) for name, type_ in _MAL_SCALAR_FIELDS),
+    ('mal_aired_from', pa.string()),
+    ('mal_aired_to', pa.string()),
+    ('mal_json', pa.string()),
+    ('mal_cover_image_url', pa.string()),
+])
+"""
+Schema of the known columns of the matching tables, the columns of the sites (e.g. ``subsplease_*``) are inferred.
+
+The scalar fields of the jikan record are stored as ``mal_*`` columns, and the full record is stored
+as JSON text in ``mal_json``, so the nested fields (e.g. ``images``, ``titles`` and ``genres``)
+do not change the schema of the table.
+"""
+
+
+def mal_columns(mal: Optional[dict]) -> dict:
+    """
+    Get the ``mal_*`` columns of a matching row.
+
+    :param mal: The jikan record, ``None`` when not matched.
+    :type mal: Optional[dict]
+    :returns: The columns of :data:`MATCH_SCHEMA` from the record, except ``mal_id`` and ``mal_cover_image_url``.
+    :rtype: dict
+    """
+    mal = mal or {}
+    aired = mal.get('aired') or {}
+    return {
+        **{f'mal_{name}': mal.get(name) for name, _ in _MAL_SCALAR_FIELDS},
+        'mal_aired_from': aired.get('from'),
+        'mal_aired_to': aired.get('to'),
+        'mal_json': json.dumps(mal, ensure_ascii=False, sort_keys=True) if mal else None,
+    }
+
+
+def migrate_match_table(table: pa.Table) -> pa.Table:
+    """
+    Convert a matching table of the older layout, which has a ``mal_*`` column for every field of the jikan
+    records (``mal_mal_id`` for their ``mal_id``), into the layout of :data:`MATCH_SCHEMA`.
+
+    :param table: The loaded table.
+    :type table: pa.Table
+    :returns: The converted table, or the table itself when it is already in the current layout.
+    :rtype: pa.Table
+    """
+    if 'mal_json' in table.column_names:
+        return table
+
+    mal_names = [name for name in table.column_names
+                 if name.startswith('mal_') and name not in {'mal_id', 'mal_cover_image_url'}]
+    if not mal_names:
+        return table
+
+    rows = []
+    for values in zip(*(table[name].to_pylist() for name in mal_names)):
+        # the mal_id of the record was stored as mal_mal_id
+        mal = {name[len('mal_'):]: value for name, value in zip(mal_names, values)}
+        rows.append(mal_columns(mal if any(value is not None for value in mal.values()) else None))
+
+    table = table.drop_columns(mal_names)
+    for name in mal_columns(None):
+        field = MATCH_SCHEMA.field(name)
+        table = table.append_column(field, pa.array([row[name] for row in rows], type=field.type))
+    return table
@@ -1,34 +1,242 @@
+import asyncio
 import logging
 import os
-from concurrent.futures import ThreadPoolExecutor
-from typing import Iterable, Callable, Any, Optional
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable, Callable, Any, Optional, List, Tuple, Iterator, Awaitable
 
 from tqdm import tqdm
 
+from .asession import get_event_loop
 
-def parallel_call(iterable: Iterable, fn: Callable[[Any], None], total: Optional[int] = None,
-                  desc: Optional[str] = None, max_workers: Optional[int] = None):
-    if total is None:
+
+class ParallelError(Exception):
+    """
+    Error report of :func:`parallel_map`, holding the failed items and their exceptions.
+    """
+
+    def __init__(self, errors: List[Tuple[Any, BaseException]]):
+        self.errors = list(errors)
+        Exception.__init__(self, f'{len(self.errors)} item(s) failed, first error on {self.errors[0][0]!r} - '
+                                 f'{self.errors[0][1]!r}' if self.errors else 'No item failed')
+
+
+class ParallelResults:
+    """
+    Iterable results of :func:`parallel_map`, yielding ``(item, result)`` of the succeeded items.
+
+    Failed items are logged and collected into :attr:`errors` while iterating. Breaking out of the
+    iteration cancels the calls not started yet.
+    """
+
+    def __init__(self, iterable: Iterable, fn: Callable[[Any], Any], total: Optional[int] = None,
+                 desc: Optional[str] = None, max_workers: Optional[int] = None, max_pending: Optional[int] = None,
+                 ordered: bool = False, fail_fast: bool = False):
+        if total is None:
+            try:
+                total = len(iterable)
+            except (TypeError, AttributeError):
+                total = None
+
+        self.iterable = iterable
+        self.fn = fn
+        self.total = total
+        self.desc = desc or f'Process with {fn!r}'
+        self.max_workers = max_workers or min(os.cpu_count(), 16)
+        self.max_pending = max_pending or self.max_workers * 2
+        self.ordered = ordered
+        self.fail_fast = fail_fast
+        self.errors: List[Tuple[Any, BaseException]] = []
+
+    def __iter__(self) -> Iterator[Tuple[Any, Any]]:
+        pg = tqdm(total=self.total, desc=self.desc)
+        tp = ThreadPoolExecutor(max_workers=self.max_workers)
+        it = iter(self.iterable)
+        pending, d_items = deque(), {}
+        exhausted, finished = False, False
         try:
-            total = len(iterable)
-        except (TypeError, AttributeError):
-            total = None
+            while True:
+                while not exhausted and len(pending) < self.max_pending:
+                    try:
+                        item = next(it)
+                    except StopIteration:
+                        exhausted = True
+                    else:
+                        future = tp.submit(self.fn, item)
+                        d_items[future] = item
+                        pending.append(future)
+                if not pending:
+                    break
+
+                if self.ordered:
+                    done = [pending.popleft()]
+                    wait(done)
+                else:
+                    done, rest = wait(pending, return_when=FIRST_COMPLETED)
+                    pending = deque(future for future in pending if future in rest)
+
+                for future in done:
+                    item = d_items.pop(future)
+                    pg.update()
+                    err = future.exception()
+                    if err is not None:
+                        logging.error(f'Error when processing {item!r} - {err!r}', exc_info=err)
+                        self.errors.append((item, err))
+                        if self.fail_fast:
+                            raise ParallelError(self.errors)
+                    else:
+                        yield item, future.result()
+            finished = True
+        finally:
+            for future in pending:
+                future.cancel()
+            tp.shutdown(wait=finished)
+            pg.close()
+
+    def raise_for_errors(self):
+        if self.errors:
+            raise ParallelError(self.errors)
+
+
+def parallel_map(iterable: Iterable, fn: Callable[[Any], Any], total: Optional[int] = None,
+                 desc: Optional[str] = None, max_workers: Optional[int] = None, max_pending: Optional[int] = None,
+                 ordered: bool = False, fail_fast: bool = False) -> ParallelResults:
+    """
+    Call ``fn`` on the items with a thread pool, streaming the results back.
+
+    Only ``max_pending`` items are submitted at the same time, so generators are consumed lazily.
+
+    Example::
+
+        >>> results = parallel_map(urls, fetch, desc='Fetch')
+        >>> for url, content in results:
+        ...     contents[url] = content
+        >>> results.raise_for_errors()
+
+    :param iterable: Items to process.
+    :param fn: Function to call on each item.
+    :param total: Total number of items for the progress bar, ``len(iterable)`` when available.
+    :param desc: Description of the progress bar.
+    :param max_workers: Number of threads, ``min(os.cpu_count(), 16)`` by default.
+    :param max_pending: Maximum number of submitted but not yet consumed items, ``max_workers * 2`` by default.
+    :param ordered: Yield results in the order of the items instead of the order of completion. (default: False)
+    :param fail_fast: Cancel the remaining items and raise :class:`ParallelError` on the first failure.
+        (default: False)
+    :returns: Iterable of ``(item, result)``, with the failures in its ``errors`` attribute.
+    """
+    return ParallelResults(iterable, fn, total=total, desc=desc, max_workers=max_workers,
+                           max_pending=max_pending, ordered=ordered, fail_fast=fail_fast)
 
-    pg = tqdm(total=total, desc=desc or f'Process with {fn!r}')
-    if not max_workers:
-        max_workers = min(os.cpu_count(), 16)
-    tp = ThreadPoolExecutor(max_workers=max_workers)
 
-    def _fn(item):
+def parallel_call(iterable: Iterable, fn: Callable[[Any], None], total: Optional[int] = None,
+                  desc: Optional[str] = None, max_workers: Optional[int] = None) -> List[Tuple[Any, BaseException]]:
+    results = parallel_map(iterable, fn, total=total, desc=desc, max_workers=max_workers)
+    for _ in results:
+        pass
+    return results.errors
+
+
+class AsyncResults:
+    """
+    Iterable results of :func:`async_map`, yielding ``(item, result)`` of the succeeded items in the order of
+    completion. Failed items are logged and collected into :attr:`errors` like :class:`ParallelResults`,
+    and breaking out of the iteration cancels the calls not finished yet.
+    """
+
+    def __init__(self, iterable: Iterable, fn: Callable[[Any], Awaitable[Any]], total: Optional[int] = None,
+                 desc: Optional[str] = None, max_concurrency: int = 128):
+        if total is None:
+            try:
+                total = len(iterable)
+            except (TypeError, AttributeError):
+                total = None
+
+        self.iterable = iterable
+        self.fn = fn
+        self.total = total
+        self.desc = desc or f'Process with {fn!r}'
+        self.max_concurrency = max_concurrency
+        self.errors: List[Tuple[Any, BaseException]] = []
+
+    async def _run(self, results: queue.Queue):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def _call(item):
+            try:
+                results.put((item, await self.fn(item), None))
+            except Exception as err:
+                results.put((item, None, err))
+            finally:
+                semaphore.release()
+
+        tasks = set()
+        try:
+            for item in self.iterable:
+                await semaphore.acquire()
+                task = asyncio.ensure_future(_call(item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            for task in list(tasks):
+                task.cancel()
+            results.put(None)
+
+    def __iter__(self) -> Iterator[Tuple[Any, Any]]:
+        pg = tqdm(total=self.total, desc=self.desc)
+        results = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._run(results), get_event_loop())
         try:
-            return fn(item)
-        except Exception as err:
-            logging.exception(f'Error when processing {item!r} - {err!r}')
-            raise
+            while True:
+                result = results.get()
+                if result is None:
+                    break
+
+                item, value, err = result
+                pg.update()
+                if err is not None:
+                    logging.error(f'Error when processing {item!r} - {err!r}', exc_info=err)
+                    self.errors.append((item, err))
+                else:
+                    yield item, value
+            future.result()
         finally:
-            pg.update()
+            future.cancel()
+            pg.close()
+
+    def raise_for_errors(self):
+        if self.errors:
+            raise ParallelError(self.errors)
+
+
+def async_map(iterable: Iterable, fn: Callable[[Any], Awaitable[Any]], total: Optional[int] = None,
+              desc: Optional[str] = None, max_concurrency: int = 128) -> AsyncResults:
+    """
+    Await the coroutine function ``fn`` on the items in the event loop of :func:`get_event_loop`,
+    streaming the results back to this thread, so hundreds of requests can be in flight without threads.
+
+    Example::
+
+        >>> async def fetch(url):
+        ...     return (await asrequest(session, 'GET', url)).text
+        >>> for url, content in async_map(urls, fetch, desc='Fetch'):
+        ...     contents[url] = content
+
+    :param iterable: Items to process, consumed in the event loop.
+    :param fn: Coroutine function to await on each item.
+    :param total: Total number of items for the progress bar, ``len(iterable)`` when available.
+    :param desc: Description of the progress bar.
+    :param max_concurrency: Maximum number of the calls running at the same time. (default: 128)
+    :returns: Iterable of ``(item, result)``, with the failures in its ``errors`` attribute.
+    """
+    return AsyncResults(iterable, fn, total=total, desc=desc, max_concurrency=max_concurrency)
 
-    for item in iterable:
-        tp.submit(_fn, item)
 
-    tp.shutdown(wait=True)
+def async_call(iterable: Iterable, fn: Callable[[Any], Awaitable[None]], total: Optional[int] = None,
+               desc: Optional[str] = None, max_concurrency: int = 128) -> List[Tuple[Any, BaseException]]:
+    results = async_map(iterable, fn, total=total, desc=desc, max_concurrency=max_concurrency)
+    for _ in results:
+        pass
+    return results.errors
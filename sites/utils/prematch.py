@@ -0,0 +1,72 @@
+import re
+from typing import Optional, List, Set
+
+
+def normalize_title(title: str) -> str:
+    """
+    Normalize the title for matching, only the lowercase words are kept.
+
+    :param title: Title to normalize.
+    :type title: str
+    :returns: Normalized title.
+    :rtype: str
+    """
+    return re.sub(r'[\W_]+', ' ', title).strip(' ').lower()
+
+
+def _get_names(item: dict) -> Set[str]:
+    names = [
+        item.get('title'), item.get('title_english'), item.get('title_japanese'),
+        *(x.get('title') for x in item.get('titles') or []),
+        *(item.get('title_synonyms') or []),
+    ]
+    return {normalize_title(name) for name in names if name} - {''}
+
+
+def _get_year(item: dict) -> Optional[int]:
+    if item.get('year'):
+        return item['year']
+    aired_from = (item.get('aired') or {}).get('from')
+    return int(aired_from[:4]) if aired_from else None
+
+
+def prematch(title: str, search_result: List[dict], year: Optional[int] = None,
+             episodes: Optional[int] = None) -> Optional[dict]:
+    """
+    Match the title with the jikan search results locally, without asking the LLM.
+
+    Only the obvious cases are resolved: exactly one search result has a name (title, english or japanese
+    title, alias or synonym) equal to the normalized title, and its year and episode count do not conflict
+    with the known ones of the site. ``None`` is returned for all the other cases, which should be left to
+    the LLM.
+
+    :param title: Title on the site.
+    :param search_result: Search results of jikan.
+    :param year: Year of the first release on the site, not checked when not given.
+    :param episodes: Number of episodes on the site, not checked when not given.
+    :returns: The match result in the format of the LLM matchers, or ``None`` when not determined.
+    """
+    name = normalize_title(title)
+    if not name:
+        return None
+
+    d_matched = {item['mal_id']: item for item in search_result if name in _get_names(item)}
+    if len(d_matched) != 1:
+        return None
+    item = list(d_matched.values())[0]
+
+    item_year = _get_year(item)
+    # the site may start releasing a little after the airing starts, but never before
+    if year is not None and item_year is not None and not (0 <= year - item_year <= 1):
+        return None
+    if episodes is not None and item.get('episodes') and episodes > item['episodes']:
+        return None
+
+    return {
+        'mal_id': item['mal_id'],
+        'title': item['title'],
+        'year': item_year or year,
+        'reason': f'Locally matched by the name {name!r} of #{item["mal_id"]}, '
+                  f'with year {item_year!r} and {item.get("episodes")!r} episode(s).',
+        'mal': item,
+    }
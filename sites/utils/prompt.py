@@ -0,0 +1,86 @@
+import json
+import re
+from typing import Optional, Sequence, List
+
+DEFAULT_CANDIDATE_FIELDS = (
+    'mal_id', 'title', 'title_english', 'title_japanese', 'aliases',
+    'type', 'year', 'aired', 'episodes', 'status', 'synopsis',
+)
+DEFAULT_SYNOPSIS_LENGTH = 300
+
+
+def _get_aliases(item: dict) -> List[str]:
+    names = {item.get('title'), item.get('title_english'), item.get('title_japanese')}
+    aliases = []
+    for title in [*(x.get('title') for x in item.get('titles') or []), *(item.get('title_synonyms') or [])]:
+        if title and title not in names:
+            names.add(title)
+            aliases.append(title)
+    return aliases
+
+
+def _get_date(value: Optional[str]) -> Optional[str]:
+    return value[:10] if value else None
+
+
+def project_candidate(item: dict, fields: Sequence[str] = DEFAULT_CANDIDATE_FIELDS,
+                      synopsis_length: int = DEFAULT_SYNOPSIS_LENGTH) -> dict:
+    """
+    Project a jikan search result to the fields needed for matching.
+
+    ``aliases`` collects the ``titles`` and ``title_synonyms`` which are not already given,
+    ``aired`` only keeps the dates of ``from`` and ``to``, and ``synopsis`` is truncated.
+    Empty values are dropped.
+
+    :param item: Search result of jikan.
+    :param fields: Fields to keep, in the output order. (default: :data:`DEFAULT_CANDIDATE_FIELDS`)
+    :param synopsis_length: Maximum length of the synopsis. (default: 300)
+    :returns: The projected candidate.
+    """
+    retval = {}
+    for field in fields:
+        if field == 'aliases':
+            value = _get_aliases(item)
+        elif field == 'aired':
+            aired = item.get('aired') or {}
+            value = {'from': _get_date(aired.get('from')), 'to': _get_date(aired.get('to'))} \
+                if aired.get('from') or aired.get('to') else None
+        elif field == 'synopsis':
+            value = re.sub(r'\s+', ' ', item.get('synopsis') or '').strip()
+            if len(value) > synopsis_length:
+                value = value[:synopsis_length].rstrip() + '...'
+        else:
+            value = item.get(field)
+
+        if value is not None and value != '' and value != []:
+            retval[field] = value
+    return retval
+
+
+def format_candidates(search_result: List[dict], fields: Optional[Sequence[str]] = None,
+                      synopsis_length: int = DEFAULT_SYNOPSIS_LENGTH) -> str:
+    """
+    Format the jikan search results for the LLM prompts, one compact JSON object per line.
+
+    :param search_result: Search results of jikan.
+    :param fields: Fields to keep, see :func:`project_candidate`.
+    :param synopsis_length: Maximum length of the synopsis. (default: 300)
+    :returns: The formatted text.
+    """
+    return '\n'.join(
+        json.dumps(project_candidate(item, fields=fields or DEFAULT_CANDIDATE_FIELDS, synopsis_length=synopsis_length),
+                   ensure_ascii=False, separators=(',', ':'))
+        for item in search_result
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Roughly estimate the number of tokens of the text, about 4 characters per token for english text,
+    and one token per character for CJK text.
+
+    :param text: Text to estimate.
+    :returns: Estimated number of tokens.
+    """
+    cjk_count = len(re.findall(r'[぀-ヿ㐀-鿿가-힯]', text))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
@@ -0,0 +1,464 @@
+import math
+import os
+import time
+from threading import Lock, Condition, Thread
+from typing import Optional, List, Tuple, Callable, TextIO, Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
+from ditk import logging
+from hbutils.string import plural_word
+from hbutils.system import urlsplit, TemporaryDirectory
+from hfutils.operate import get_hf_client, get_hf_fs, download_directory_as_directory
+from hfutils.utils import number_to_tag
+from pyrate_limiter import Rate, Limiter, Duration
+
+from .assets import AssetManifest, upload_changed_files
+from .download import adownload_file
+from .parallel import async_call
+from .readme import hf_file_urls
+from .tables import TableStore
+
+
+class CoverSpec:
+    """
+    Cover images of the records, downloaded into ``assets/<name>`` of the repository.
+
+    :param name: Name of the covers, also the directory of them.
+    :type name: str
+    :param key_column: Column of the keys, the images are named by the keys.
+    :type key_column: str
+    :param url_column: Column of the image urls.
+    :type url_column: str
+    :param key_type: Type of the keys in the filenames, e.g. ``int`` for the float columns. (default: ``str``)
+    :type key_type: type
+    :param desc: Description of the downloading progress.
+    :type desc: Optional[str]
+    """
+
+    def __init__(self, name: str, key_column: str, url_column: str, key_type: type = str,
+                 desc: Optional[str] = None):
+        self.name = name
+        self.key_column = key_column
+        self.url_column = url_column
+        self.key_type = key_type
+        self.desc = desc or f'Downloading {name} Cover Images'
+
+    @property
+    def dir_in_repo(self) -> str:
+        return f'assets/{self.name}'
+
+
+ReadmeSection = Callable[['DatasetPublisher', TextIO, pd.DataFrame], None]
+
+
+class DatasetPublisher:
+    """
+    Publisher of the dataset repositories of the matchers.
+
+    The publisher owns the table of the records and the upload directory. The upserted records are
+    batched until the next :meth:`publish`, which writes them as a new delta file in ``table_deltas``,
+    downloads the cover images of the new records, renders ``README.md`` with the given sections, and uploads
+    only the changed files (see :class:`AssetManifest`), at most once every ``deploy_span`` seconds unless forced.
+    The rows of the delta files supersede the rows of the same keys in ``table.parquet``, and they are merged
+    into it every ``compact_every`` publications and on the forced ones, then the delta files are deleted.
+    Only the changed rows are converted to python objects on each publication.
+
+    With ``background``, :meth:`request_publish` hands the publications to a worker thread, so the
+    matching loops are not blocked by the downloads and uploads. The table is snapshotted when a publication
+    starts, and the requests made while publishing are coalesced into one.
+
+    It should be used as a context manager, the upload directory is removed when exited.
+
+    :param repository: Dataset repository, created when not exist.
+    :type repository: str
+    :param key: Key column of the records.
+    :type key: str
+    :param sort_by: Sort keys of the table, see :class:`TableStore`.
+    :type sort_by: Optional[List[Tuple[str, str]]]
+    :param covers: Cover images of the records.
+    :type covers: Optional[List[CoverSpec]]
+    :param readme_sections: Sections of the README after the metadata, each of them is called
+        with the publisher, the README file and the records dataframe.
+    :type readme_sections: Optional[List[ReadmeSection]]
+    :param source_datasets: Source datasets in the README metadata.
+    :type source_datasets: Optional[List[str]]
+    :param session: Session for downloading the cover images.
+    :type session: Optional[requests.Session]
+    :param deploy_span: Minimal time span between the publications in seconds. (default: 5 minutes)
+    :type deploy_span: float
+    :param upload_time_span: Minimal time span between the uploads in seconds. (default: 30 seconds)
+    :type upload_time_span: float
+    :param sync_mode: Download the cover images in the repository first. (default: True)
+    :type sync_mode: bool
+    :param background: Publish the requested publications in a worker thread. (default: False)
+    :type background: bool
+    :param compact_every: Number of publications between the compactions of the table. (default: 8)
+    :type compact_every: int
+    :param schema: Types of the known columns of the table, see :class:`TableStore`.
+    :type schema: Optional[pa.Schema]
+    :param migrate: Function to convert the tables in the repository written in an older layout.
+    :type migrate: Optional[Callable[[pa.Table], pa.Table]]
+    :param download_concurrency: Maximum number of the cover images downloaded at the same time. (default: 128)
+    :type download_concurrency: int
+    """
+
+    _DELTA_DIR = 'table_deltas'
+
+    def __init__(self, repository: str, key: str, sort_by: Optional[List[Tuple[str, str]]] = None,
+                 covers: Optional[List[CoverSpec]] = None, readme_sections: Optional[List[ReadmeSection]] = None,
+                 source_datasets: Optional[List[str]] = None, session: Optional[requests.Session] = None,
+                 deploy_span: float = 5 * 60.0, upload_time_span: float = 30.0, sync_mode: bool = True,
+                 background: bool = False, compact_every: int = 8, schema: Optional[pa.Schema] = None,
+                 migrate: Optional[Callable[[pa.Table], pa.Table]] = None, download_concurrency: int = 128):
+        self.repository = repository
+        self.covers = list(covers or [])
+        self.readme_sections = list(readme_sections or [])
+        self.source_datasets = list(source_datasets or [])
+        self.session = session
+        self.deploy_span = deploy_span
+        self.sync_mode = sync_mode
+        self.background = background
+        self.compact_every = compact_every
+        self.download_concurrency = download_concurrency
+        self._limiter = Limiter(Rate(1, int(math.ceil(Duration.SECOND * upload_time_span))), max_delay=1 << 32)
+
+        self._ensure_repository()
+        self._remote_delta_files: List[str] = []
+        self.table_store = self._load_table_store(key, sort_by, schema=schema, migrate=migrate)
+        # deltas collected but not written yet, delta files not compacted yet,
+        # and written deltas not applied to the records of the README yet
+        self._unwritten_deltas: List[pa.Table] = []
+        self._delta_files: List[str] = list(self._remote_delta_files)
+        self._pending_changes: List[pa.Table] = []
+        self._df_records: Optional[pd.DataFrame] = None
+        self.cover_files = {cover.name: {} for cover in self.covers}
+
+        self._tempdir: Optional[TemporaryDirectory] = None
+        self.upload_dir: Optional[str] = None
+        self._asset_manifest: Optional[AssetManifest] = None
+        self._last_update, self._dirty = None, False
+        self._total_count = len(self.table_store)
+
+        # the table and dirty state are shared with the worker, and only one publication runs at a time
+        self._lock = Lock()
+        self._publish_lock = Lock()
+        self._condition = Condition()
+        self._requested, self._requested_force, self._closing = False, False, False
+        self._worker: Optional[Thread] = None
+
+    def _ensure_repository(self):
+        hf_client, hf_fs = get_hf_client(), get_hf_fs()
+        if not hf_client.repo_exists(repo_id=self.repository, repo_type='dataset'):
+            hf_client.create_repo(repo_id=self.repository, repo_type='dataset', private=True)
+            attr_lines = hf_fs.read_text(f'datasets/{self.repository}/.gitattributes').splitlines(keepends=False)
+            attr_lines.append('*.json filter=lfs diff=lfs merge=lfs -text')
+            attr_lines.append('*.csv filter=lfs diff=lfs merge=lfs -text')
+            hf_fs.write_text(
+                f'datasets/{self.repository}/.gitattributes',
+                os.linesep.join(attr_lines),
+            )
+
+    def _load_table_store(self, key: str, sort_by: Optional[List[Tuple[str, str]]],
+                          schema: Optional[pa.Schema] = None,
+                          migrate: Optional[Callable[[pa.Table], pa.Table]] = None) -> TableStore:
+        hf_client, hf_fs = get_hf_client(), get_hf_fs()
+        if hf_client.file_exists(repo_id=self.repository, repo_type='dataset', filename='table.parquet'):
+            table_file = hf_client.hf_hub_download(
+                repo_id=self.repository,
+                repo_type='dataset',
+                filename='table.parquet',
+            )
+        else:
+            table_file = None
+
+        # the delta files left by an interrupted run, they are merged and deleted on the next compaction
+        self._remote_delta_files = sorted(
+            os.path.relpath(path, f'datasets/{self.repository}')
+            for path in hf_fs.glob(f'datasets/{self.repository}/{self._DELTA_DIR}/*.parquet')
+        )
+        if self._remote_delta_files:
+            logging.info(f'{plural_word(len(self._remote_delta_files), "delta file")} found in {self.repository!r}.')
+        delta_files = [
+            hf_client.hf_hub_download(repo_id=self.repository, repo_type='dataset', filename=file)
+            for file in self._remote_delta_files
+        ]
+        return TableStore.load(table_file, key=key, sort_by=sort_by, schema=schema, delta_files=delta_files,
+                               migrate=migrate)
+
+    def records(self) -> Iterator[dict]:
+        """
+        Iterate the current records.
+        """
+        if len(self.table_store):
+            yield from self.table_store.to_pandas().replace(np.nan, None).to_dict('records')
+
+    def _sort_records(self, df: pd.DataFrame) -> pd.DataFrame:
+        # the same order as the arrow table, nulls at the end
+        sort_by = [(column, order) for column, order in self.table_store.sort_by if column in df.columns]
+        if not sort_by:
+            return df
+        return df.sort_values(by=[column for column, _ in sort_by],
+                              ascending=[order == 'ascending' for _, order in sort_by],
+                              na_position='last', kind='stable')
+
+    def _update_records(self, deltas: List[pa.Table]) -> pd.DataFrame:
+        # only the changed rows are converted, the records of last publication are reused
+        if self._df_records is None:
+            table = self.table_store.merged()
+            self._df_records = table.to_pandas().replace(np.nan, None) if table is not None else pd.DataFrame()
+            return self._df_records
+        if not deltas:
+            return self._df_records
+
+        key = self.table_store.key
+        df_changed = pd.concat([delta.to_pandas() for delta in deltas], ignore_index=True) \
+            .drop_duplicates(subset=[key], keep='last').replace(np.nan, None)
+        df_records = self._df_records
+        if len(df_records):
+            df_records = df_records[~df_records[key].isin(df_changed[key])]
+        self._df_records = self._sort_records(pd.concat([df_records, df_changed], ignore_index=True)) \
+            .replace(np.nan, None)
+        return self._df_records
+
+    def __enter__(self) -> 'DatasetPublisher':
+        self._tempdir = TemporaryDirectory()
+        self.upload_dir = self._tempdir.__enter__()
+        # the files already in the repository are not uploaded again, see AssetManifest
+        self._asset_manifest = AssetManifest(self.upload_dir)
+        for cover in self.covers:
+            os.makedirs(os.path.join(self.upload_dir, cover.dir_in_repo), exist_ok=True)
+        os.makedirs(os.path.join(self.upload_dir, self._DELTA_DIR), exist_ok=True)
+        if self.sync_mode:
+            for cover in self.covers:
+                logging.info(f'Downloading current {cover.name} images ...')
+                download_directory_as_directory(
+                    repo_id=self.repository,
+                    repo_type='dataset',
+                    dir_in_repo=cover.dir_in_repo,
+                    local_directory=os.path.join(self.upload_dir, cover.dir_in_repo),
+                )
+            self._asset_manifest.mark_uploaded()
+        self._asset_manifest.mark_in_repository(self._remote_delta_files)
+
+        if self.background:
+            self._closing = False
+            self._worker = Thread(target=self._run_worker, name=f'publisher-{self.repository}', daemon=True)
+            self._worker.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._worker is not None:
+            with self._condition:
+                self._closing = True
+                self._condition.notify()
+            self._worker.join()
+            self._worker = None
+        self._tempdir.__exit__(exc_type, exc_val, exc_tb)
+        self._tempdir, self.upload_dir, self._asset_manifest = None, None, None
+
+    def upsert(self, row: dict):
+        """
+        Add or replace the record, it will be published on the next :meth:`publish`.
+        """
+        with self._lock:
+            self.table_store.upsert(row)
+            self._dirty = True
+
+    def request_publish(self, force: bool = False):
+        """
+        Request a publication, see :meth:`publish`. It is published in the worker without waiting when
+        ``background`` is enabled, the requests before the worker picks them up are coalesced into one,
+        and the ones skipped by ``deploy_span`` are published by the worker once it is passed.
+
+        :param force: Ignore the ``deploy_span``. (default: False)
+        :type force: bool
+        """
+        if self._worker is None:
+            self.publish(force=force)
+            return
+
+        with self._condition:
+            self._requested = True
+            self._requested_force = self._requested_force or force
+            self._condition.notify()
+
+    def _publish_delay(self) -> Optional[float]:
+        # seconds until the upserted records can be published, None when nothing to publish
+        with self._lock:
+            if not self._dirty:
+                return None
+            elif self._last_update is None:
+                return 0.0
+            else:
+                return self._last_update + self.deploy_span - time.time()
+
+    def _run_worker(self):
+        # the requests skipped by deploy_span are postponed, and published once it is passed
+        retry_at = 0.0
+        while True:
+            with self._condition:
+                while not self._requested and not self._closing:
+                    delay = self._publish_delay()
+                    if delay is not None:
+                        delay = max(delay, retry_at - time.time())
+                        if delay <= 0:
+                            self._requested = True
+                            break
+                    self._condition.wait(timeout=delay)
+                if not self._requested:
+                    return
+                force, self._requested, self._requested_force = self._requested_force, False, False
+
+            try:
+                self.publish(force=force)
+            except Exception as err:
+                logging.exception(f'Background publication of {self.repository!r} failed, '
+                                  f'will be retried in {self.deploy_span:.0f}s - {err!r}')
+                retry_at = time.time() + self.deploy_span
+
+    def cover_urls(self, name: str, keys: pd.Series) -> pd.Series:
+        """
+        Urls of the cover images in the repository, missing for the records without covers.
+
+        :param name: Name of the covers.
+        :type name: str
+        :param keys: Keys of the records.
+        :type keys: pd.Series
+        :returns: Urls of the images.
+        :rtype: pd.Series
+        """
+        return hf_file_urls(keys.map(self.cover_files[name]), repo_id=self.repository)
+
+    def _download_covers(self, cover: CoverSpec, df_records: pd.DataFrame):
+        d_files = self.cover_files[cover.name]
+
+        async def _afn_download(item):
+            _, ext = os.path.splitext(urlsplit(item[cover.url_column]).filename)
+            file_in_repo = f'{cover.dir_in_repo}/{cover.key_type(item[cover.key_column])}{ext}'
+            dst_filename = os.path.join(self.upload_dir, file_in_repo)
+            if not os.path.exists(dst_filename):
+                await adownload_file(
+                    item[cover.url_column],
+                    filename=dst_filename,
+                    session=self.session,
+                    resume=False,
+                    silent=True,
+                )
+            d_files[item[cover.key_column]] = file_in_repo
+
+        # the covers are mapped incrementally, only the records without covers are checked,
+        # and they are downloaded concurrently in the event loop, see async_call
+        async_call(
+            df_records[~df_records[cover.url_column].isnull() &
+                       ~df_records[cover.key_column].isin(list(d_files))].to_dict('records'),
+            _afn_download,
+            desc=cover.desc,
+            max_concurrency=self.download_concurrency,
+        )
+
+    def _write_readme(self, df_records: pd.DataFrame):
+        with open(os.path.join(self.upload_dir, 'README.md'), 'w') as f:
+            print('---', file=f)
+            print('license: other', file=f)
+            print('language:', file=f)
+            print('- en', file=f)
+            print('- ja', file=f)
+            print('tags:', file=f)
+            print('- art', file=f)
+            print('- anime', file=f)
+            print('size_categories:', file=f)
+            print(f'- {number_to_tag(len(df_records))}', file=f)
+            print('annotations_creators:', file=f)
+            print('- no-annotation', file=f)
+            print('source_datasets:', file=f)
+            for source in self.source_datasets:
+                print(f'- {source}', file=f)
+            print('---', file=f)
+            print('', file=f)
+
+            if self._delta_files:
+                print(f'The rows in `{self._DELTA_DIR}/*.parquet` are newer than `table.parquet`, '
+                      f'and replace its rows of the same `{self.table_store.key}`. '
+                      f'They are merged into `table.parquet` at the end of each sync.', file=f)
+                print('', file=f)
+
+            for section in self.readme_sections:
+                section(self, f, df_records)
+
+    def publish(self, force: bool = False):
+        """
+        Publish the upserted records, skipped when nothing changed, or the last publication is within
+        ``deploy_span`` when not forced.
+
+        :param force: Ignore the ``deploy_span``, and compact the table. (default: False)
+        :type force: bool
+        """
+        with self._publish_lock:
+            with self._lock:
+                # the forced publications also compact the delta files left by the interrupted runs
+                if not self._dirty and not (force and self._delta_files):
+                    return
+                if not force and self._last_update is not None and \
+                        self._last_update + self.deploy_span > time.time():
+                    return
+
+                # only the rows upserted since last publication are taken here, the table is written and
+                # converted after the lock is released, so the upserts are not blocked by them, see TableStore
+                delta = self.table_store.collect()
+                if delta is not None:
+                    self._unwritten_deltas.append(delta)
+                self._dirty = False
+
+            try:
+                self._write_table(compact=force or len(self._delta_files) + 1 >= self.compact_every)
+                self._publish_table()
+            except Exception:
+                with self._lock:
+                    self._dirty = True
+                raise
+
+    def _write_table(self, compact: bool):
+        if compact:
+            table = self.table_store.compact()
+            if table is not None:
+                pq.write_table(table, os.path.join(self.upload_dir, 'table.parquet'))
+            # the delta files are deleted from the repository on next upload, see AssetManifest
+            for file in self._delta_files:
+                if os.path.exists(os.path.join(self.upload_dir, file)):
+                    os.remove(os.path.join(self.upload_dir, file))
+            self._delta_files = []
+            self._pending_changes.extend(self._unwritten_deltas)
+            self._unwritten_deltas = []
+        else:
+            while self._unwritten_deltas:
+                delta = self._unwritten_deltas[0]
+                file = f'{self._DELTA_DIR}/{time.time_ns()}.parquet'
+                pq.write_table(delta, os.path.join(self.upload_dir, file))
+                self._delta_files.append(file)
+                self._pending_changes.append(self._unwritten_deltas.pop(0))
+
+    def _publish_table(self):
+        changes, self._pending_changes = self._pending_changes, []
+        try:
+            df_records = self._update_records(changes)
+        except Exception:
+            self._pending_changes = changes + self._pending_changes
+            raise
+
+        for cover in self.covers:
+            self._download_covers(cover, df_records)
+        self._write_readme(df_records)
+
+        self._limiter.try_acquire('hf upload limit')
+        upload_changed_files(
+            self._asset_manifest,
+            repo_id=self.repository,
+            repo_type='dataset',
+            message=f'Adding {plural_word(len(df_records) - self._total_count, "new record")} into index',
+        )
+        self._last_update = time.time()
+        self._total_count = len(df_records)
@@ -0,0 +1,98 @@
+from functools import lru_cache
+from typing import Optional, TextIO
+from urllib.parse import quote
+
+import pandas as pd
+from huggingface_hub import hf_hub_url
+
+_PLACEHOLDER = '__placeholder__'
+
+
+@lru_cache()
+def hf_file_url_prefix(repo_id: str, repo_type: str = 'dataset', revision: Optional[str] = None) -> str:
+    """
+    Get the prefix of the file urls of the repository, the same as :func:`huggingface_hub.hf_hub_url`
+    without the filename, so the urls of many files can be built by concatenation.
+
+    :param repo_id: Repository id.
+    :type repo_id: str
+    :param repo_type: Type of the repository. (default: ``dataset``)
+    :type repo_type: str
+    :param revision: Revision of the files, the default branch when not given.
+    :type revision: Optional[str]
+    :returns: Prefix of the urls.
+    :rtype: str
+    """
+    url = hf_hub_url(repo_id=repo_id, repo_type=repo_type, revision=revision, filename=_PLACEHOLDER)
+    assert url.endswith(_PLACEHOLDER), f'Unexpected hf file url {url!r}.'
+    return url[:-len(_PLACEHOLDER)]
+
+
+def hf_file_urls(filenames: pd.Series, repo_id: str, repo_type: str = 'dataset',
+                 revision: Optional[str] = None) -> pd.Series:
+    """
+    Get the urls of the files in the repository, the missing filenames stay missing.
+
+    :param filenames: Paths of the files in the repository.
+    :type filenames: pd.Series
+    :param repo_id: Repository id.
+    :type repo_id: str
+    :param repo_type: Type of the repository. (default: ``dataset``)
+    :type repo_type: str
+    :param revision: Revision of the files, the default branch when not given.
+    :type revision: Optional[str]
+    :returns: Urls of the files.
+    :rtype: pd.Series
+    """
+    prefix = hf_file_url_prefix(repo_id, repo_type, revision)
+    mask = filenames.notnull()
+    retval = pd.Series(None, index=filenames.index, dtype=object)
+    retval[mask] = prefix + filenames[mask].astype(str).map(quote)
+    return retval
+
+
+def md_link(text: pd.Series, url: pd.Series) -> pd.Series:
+    """
+    Markdown links of the texts, the texts are kept as they are when the urls are missing.
+    """
+    text = text.astype(str)
+    return ('[' + text + '](' + url.astype(str) + ')').where(url.notnull(), text)
+
+
+def md_image(alt: pd.Series, url: pd.Series, na: str = 'N/A') -> pd.Series:
+    """
+    Markdown images of the urls, ``na`` when the urls are missing.
+    """
+    return ('![' + alt.astype(str) + '](' + url.astype(str) + ')').where(url.notnull(), na)
+
+
+def _cells(column: pd.Series, na: str) -> pd.Series:
+    return column.astype(object).where(column.notnull(), na).astype(str) \
+        .str.replace('|', '\\|', regex=False).str.replace('\n', ' ', regex=False)
+
+
+def write_markdown_table(f: TextIO, df: pd.DataFrame, na: str = 'N/A'):
+    """
+    Write the dataframe as a GitHub markdown table, with the same columns as ``df.to_markdown(index=False)``.
+
+    The cells are formatted column by column, and the rows are written one by one without padding,
+    so large tables are not built in memory by tabulate.
+
+    :param f: File to write.
+    :type f: TextIO
+    :param df: Dataframe to write.
+    :type df: pd.DataFrame
+    :param na: Text of the missing values. (default: ``N/A``)
+    :type na: str
+    """
+    columns = [str(column) for column in df.columns]
+    aligns = ['---:' if pd.api.types.is_numeric_dtype(df[column]) else ':---' for column in df.columns]
+    print('| ' + ' | '.join(columns) + ' |', file=f)
+    print('|' + '|'.join(aligns) + '|', file=f)
+    if len(df) == 0:
+        return
+
+    lines = pd.Series('| ', index=df.index)
+    for i, column in enumerate(df.columns):
+        lines = lines + ('' if i == 0 else ' | ') + _cells(df[column], na)
+    f.writelines(line + ' |\n' for line in lines)
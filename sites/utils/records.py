@@ -0,0 +1,37 @@
+import math
+from typing import Any
+
+import numpy as np
+
+
+def to_plain(obj: Any, drop_none: bool = False) -> Any:
+    """
+    Convert a value read back from parquet into plain python objects.
+
+    Numpy arrays become lists and numpy scalars become python scalars, recursively. Struct columns
+    are read back with every field of the inferred schema, so ``drop_none`` can be used to remove
+    the fields which are ``None`` inside dicts.
+
+    :param obj: The object to convert.
+    :param drop_none: Drop ``None`` values from dicts. (default: False)
+    :type drop_none: bool
+    :returns: The converted object.
+    """
+    if isinstance(obj, dict):
+        return {
+            key: to_plain(value, drop_none=drop_none)
+            for key, value in obj.items()
+            if not (drop_none and _is_none(value))
+        }
+    elif isinstance(obj, (list, tuple, np.ndarray)):
+        return [to_plain(item, drop_none=drop_none) for item in obj]
+    elif isinstance(obj, np.generic):
+        return to_plain(obj.item(), drop_none=drop_none)
+    elif isinstance(obj, float) and math.isnan(obj):
+        return None
+    else:
+        return obj
+
+
+def _is_none(value) -> bool:
+    return value is None or (isinstance(value, float) and math.isnan(value))
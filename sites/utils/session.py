@@ -1,13 +1,40 @@
+import email.utils
 import logging
-import random
 import time
-from typing import Optional, Dict
+from typing import Optional, Dict, Mapping
 
 import requests
 from requests.adapters import HTTPAdapter, Retry
-from requests.exceptions import RequestException
+from requests.structures import CaseInsensitiveDict
+
+from .cache import HTTPCache
 
 DEFAULT_TIMEOUT = 30  # seconds
+DEFAULT_USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 " \
+                     "(KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36"
+RETRY_STATUS_CODES = [408, 413, 429, 500, 501, 502, 503, 504, 505, 506, 507, 509, 510, 511]
+
+
+def get_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """
+    Get the delay in seconds requested by the ``Retry-After`` header.
+
+    :param headers: The response headers.
+    :type headers: Mapping[str, str]
+    :returns: The delay in seconds, ``None`` when the header is absent or invalid.
+    :rtype: Optional[float]
+    """
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
 
 
 class TimeoutHTTPAdapter(HTTPAdapter):
@@ -55,9 +82,60 @@ class TimeoutHTTPAdapter(HTTPAdapter):
         return super().send(request, **kwargs)
 
 
+class CachedHTTPAdapter(TimeoutHTTPAdapter):
+    """
+    HTTP adapter that stores GET responses in a :class:`HTTPCache` and revalidates them
+    with conditional requests (``If-None-Match`` / ``If-Modified-Since``).
+
+    Only responses carrying an ``ETag`` or ``Last-Modified`` header are stored, and streamed
+    requests (e.g. file downloads) always bypass the cache.
+
+    :param cache: The cache to use.
+    :type cache: HTTPCache
+    """
+
+    def __init__(self, *args, cache: HTTPCache, **kwargs):
+        self.cache = cache
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        """
+        Sends a request, answering it from the cache when the server replies ``304 Not Modified``.
+
+        :param request: The request to send.
+        :type request: PreparedRequest
+        :param kwargs: Additional keyword arguments.
+        :type kwargs: dict
+        :returns: The response from the request.
+        :rtype: Response
+        """
+        if request.method != 'GET' or kwargs.get('stream'):
+            return super().send(request, **kwargs)
+
+        cached = self.cache.get(request.method, request.url)
+        if cached is not None:
+            meta, _ = cached
+            headers = CaseInsensitiveDict(meta['headers'])
+            if headers.get('ETag'):
+                request.headers.setdefault('If-None-Match', headers['ETag'])
+            if headers.get('Last-Modified'):
+                request.headers.setdefault('If-Modified-Since', headers['Last-Modified'])
+
+        resp = super().send(request, **kwargs)
+        if resp.status_code == 304 and cached is not None:
+            logging.debug(f'Not modified, using cached response of {request.url!r}.')
+            meta, body = cached
+            resp.close()
+            return self.cache.build_response(meta, body, request)
+        elif resp.status_code == 200 and ('ETag' in resp.headers or 'Last-Modified' in resp.headers):
+            self.cache.set(request.method, request.url, resp)
+
+        return resp
+
+
 def get_requests_session(max_retries: int = 5, timeout: int = DEFAULT_TIMEOUT, verify: bool = True,
-                         headers: Optional[Dict[str, str]] = None, session: Optional[requests.Session] = None) \
-        -> requests.Session:
+                         headers: Optional[Dict[str, str]] = None, session: Optional[requests.Session] = None,
+                         cache: Optional[HTTPCache] = None) -> requests.Session:
     """
     Returns a requests Session object configured with retry and timeout settings.
 
@@ -69,65 +147,29 @@ def get_requests_session(max_retries: int = 5, timeout: int = DEFAULT_TIMEOUT, v
     :type headers: Optional[Dict[str, str]]
     :param session: An existing requests Session object to use. If not provided, a new Session object is created. (default: None)
     :type session: Optional[requests.Session]
+    :param cache: On-disk HTTP cache for GET responses, no caching when not given. (default: None)
+    :type cache: Optional[HTTPCache]
     :returns: The requests Session object.
     :rtype: requests.Session
     """
     session = session or requests.session()
     retries = Retry(
         total=max_retries, backoff_factor=1,
-        status_forcelist=[408, 413, 429, 500, 501, 502, 503, 504, 505, 506, 507, 509, 510, 511],
+        status_forcelist=RETRY_STATUS_CODES,
         allowed_methods=["HEAD", "GET", "POST", "PUT", "DELETE", "OPTIONS", "TRACE"],
     )
-    adapter = TimeoutHTTPAdapter(max_retries=retries, timeout=timeout, pool_connections=32, pool_maxsize=32)
+    if cache is not None:
+        adapter = CachedHTTPAdapter(max_retries=retries, timeout=timeout, pool_connections=32, pool_maxsize=32,
+                                    cache=cache)
+    else:
+        adapter = TimeoutHTTPAdapter(max_retries=retries, timeout=timeout, pool_connections=32, pool_maxsize=32)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     session.headers.update({
-        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
-                      "(KHTML, like Gecko) Chrome/108.0.0.0 Safari/537.36",
+        "User-Agent": DEFAULT_USER_AGENT,
         **dict(headers or {}),
     })
     if not verify:
         session.verify = False
 
     return session
-
-
-def srequest(session: requests.Session, method, url, *, max_retries: int = 5,
-             sleep_time: float = 5.0, raise_for_status: bool = True, **kwargs) -> requests.Response:
-    """
-    Send a request using the provided session object with retry and timeout settings.
-
-    :param session: The requests Session object to use for the request.
-    :type session: requests.Session
-    :param method: The HTTP method for the request.
-    :type method: str
-    :param url: The URL for the request.
-    :type url: str
-    :param max_retries: The maximum number of retries. (default: 5)
-    :type max_retries: int
-    :param sleep_time: The sleep time between retries in seconds. (default: 5.0)
-    :type sleep_time: float
-    :param raise_for_status: Whether to raise an exception for non-successful response status codes. (default: True)
-    :type raise_for_status: bool
-    :param kwargs: Additional keyword arguments for the request.
-    :type kwargs: dict
-    :returns: The response from the request.
-    :rtype: requests.Response
-    """
-    if isinstance(session, (list, tuple)):
-        session = random.choice(session)
-
-    resp = None
-    for _ in range(max_retries):
-        try:
-            resp = session.request(method, url, **kwargs)
-        except RequestException as err:
-            logging.error(f'Request error - {err!r}')
-            time.sleep(sleep_time)
-        else:
-            break
-    assert resp is not None, f'Request failed for {max_retries} time(s).'
-    if raise_for_status:
-        resp.raise_for_status()
-
-    return resp
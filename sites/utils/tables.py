@@ -0,0 +1,233 @@
+import json
+from typing import Optional, List, Tuple, Dict, Any, Callable
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+
+def _unify_types(name: str, types: List[pa.DataType]) -> Optional[pa.DataType]:
+    try:
+        schema = pa.unify_schemas([pa.schema([pa.field(name, type_)]) for type_ in types],
+                                  promote_options='permissive')
+    except (pa.ArrowTypeError, pa.ArrowInvalid):
+        return None
+    return schema.field(name).type
+
+
+def _to_json_column(column: pa.ChunkedArray) -> pa.Array:
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        return column.combine_chunks()
+    return pa.array([
+        json.dumps(value, ensure_ascii=False, default=str) if value is not None else None
+        for value in column.to_pylist()
+    ], type=pa.string())
+
+
+def normalize_tables(tables: List[pa.Table]) -> List[pa.Table]:
+    """
+    Normalize the schemas of the tables, so they can be concatenated.
+
+    The types of the same columns are promoted in the way of ``pa.concat_tables(promote_options='permissive')``,
+    and the columns which can not be promoted (e.g. a nested field which is a string in one table but an integer
+    in another) are stored as JSON texts in all the tables.
+
+    :param tables: Tables to normalize.
+    :type tables: List[pa.Table]
+    :returns: The normalized tables.
+    :rtype: List[pa.Table]
+    """
+    d_types: Dict[str, List[pa.DataType]] = {}
+    for table in tables:
+        for field in table.schema:
+            d_types.setdefault(field.name, []).append(field.type)
+
+    json_columns = [name for name, types in d_types.items() if _unify_types(name, types) is None]
+    retval = []
+    for table in tables:
+        for name in json_columns:
+            if name in table.column_names:
+                table = table.set_column(table.column_names.index(name), pa.field(name, pa.string()),
+                                         _to_json_column(table[name]))
+        retval.append(table)
+    return retval
+
+
+class TableStore:
+    """
+    Table of records keyed by one column, kept as arrow tables between the writes.
+
+    The rows upserted since the last :meth:`collect` are converted from python objects into a delta table,
+    so only the changed rows are converted and written on each publication. The deltas supersede the rows
+    of the same keys in the older tables, and they are merged into the sorted base table by :meth:`compact`.
+    Superseded rows, concatenation and sorting are all done by arrow, and the schemas of the tables are
+    normalized before merged, see :func:`normalize_tables`.
+
+    Only :meth:`upsert` and :meth:`collect` touch the rows not collected yet, so the other methods can run
+    while the rows are upserted, as long as :meth:`collect` is not called at the same time.
+
+    The columns in ``schema`` always have its types, and the other columns are inferred from the rows.
+
+    :param key: Name of the key column.
+    :type key: str
+    :param sort_by: Sort keys of the merged table, e.g. ``[('year', 'descending')]``, nulls are placed at the end.
+    :type sort_by: Optional[List[Tuple[str, str]]]
+    :param schema: Types of the known columns.
+    :type schema: Optional[pa.Schema]
+    :param base: The initial table.
+    :type base: Optional[pa.Table]
+    :param deltas: The initial deltas of the base table, the newest last.
+    :type deltas: Optional[List[pa.Table]]
+    """
+
+    def __init__(self, key: str, sort_by: Optional[List[Tuple[str, str]]] = None, schema: Optional[pa.Schema] = None,
+                 base: Optional[pa.Table] = None, deltas: Optional[List[pa.Table]] = None):
+        self.key = key
+        self.sort_by = list(sort_by or [])
+        self.schema = schema
+        self._base = self._cast(base) if base is not None else None
+        self._deltas: List[pa.Table] = [self._cast(delta) for delta in (deltas or [])]
+        self._keys = set()
+        for table in [self._base, *self._deltas]:
+            if table is not None:
+                self._keys.update(table[key].to_pylist())
+        self._pending: Dict[Any, dict] = {}
+
+    @classmethod
+    def load(cls, parquet_file: Optional[str], key: str, sort_by: Optional[List[Tuple[str, str]]] = None,
+             schema: Optional[pa.Schema] = None, delta_files: Optional[List[str]] = None,
+             migrate: Optional[Callable[[pa.Table], pa.Table]] = None) -> 'TableStore':
+        """
+        Load the table from the parquet files.
+
+        :param parquet_file: Parquet file of the base table, empty when not given.
+        :type parquet_file: Optional[str]
+        :param key: Name of the key column.
+        :type key: str
+        :param sort_by: Sort keys of the merged table.
+        :type sort_by: Optional[List[Tuple[str, str]]]
+        :param schema: Types of the known columns.
+        :type schema: Optional[pa.Schema]
+        :param delta_files: Parquet files of the deltas not compacted yet, the newest last.
+        :type delta_files: Optional[List[str]]
+        :param migrate: Function to convert the tables written in an older layout, applied to each loaded table.
+        :type migrate: Optional[Callable[[pa.Table], pa.Table]]
+        :returns: The loaded table store.
+        :rtype: TableStore
+        """
+        migrate = migrate or (lambda x: x)
+        base = migrate(pq.read_table(parquet_file)) if parquet_file else None
+        if base is not None and sort_by:
+            base = base.sort_by(sort_by)
+        deltas = [migrate(pq.read_table(file)) for file in (delta_files or [])]
+        return cls(key, sort_by=sort_by, schema=schema, base=base, deltas=deltas)
+
+    def _cast(self, table: pa.Table) -> pa.Table:
+        if self.schema is None:
+            return table
+        for field in self.schema:
+            if field.name in table.column_names and table.schema.field(field.name).type != field.type:
+                table = table.set_column(table.column_names.index(field.name), field,
+                                         table[field.name].cast(field.type))
+        return table
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def delta_count(self) -> int:
+        """
+        Number of the collected deltas not compacted yet.
+        """
+        return len(self._deltas)
+
+    def upsert(self, row: dict):
+        self._keys.add(row[self.key])
+        self._pending[row[self.key]] = row
+
+    def collect(self) -> Optional[pa.Table]:
+        """
+        Convert the rows upserted since the last call into a new delta.
+
+        :returns: The new delta, ``None`` when nothing upserted.
+        :rtype: Optional[pa.Table]
+        """
+        if not self._pending:
+            return None
+
+        # from_pylist only takes the columns of the first row, so the columns are collected from all rows
+        rows = list(self._pending.values())
+        self._pending = {}
+        columns = dict.fromkeys(column for row in rows for column in row)
+        schema_names = set(self.schema.names) if self.schema is not None else set()
+        delta = pa.Table.from_pydict({
+            column: pa.array([row.get(column) for row in rows],
+                             type=self.schema.field(column).type if column in schema_names else None)
+            for column in columns
+        })
+        self._deltas.append(delta)
+        return delta
+
+    def merged(self) -> Optional[pa.Table]:
+        """
+        Merge the base table and the collected deltas, without changing them.
+
+        :returns: The sorted table, ``None`` when empty.
+        :rtype: Optional[pa.Table]
+        """
+        # newer tables supersede the rows of the same keys in the older ones
+        tables, seen = [], None
+        for table in reversed([t for t in [self._base, *self._deltas] if t is not None]):
+            if seen is not None:
+                table = table.filter(pc.invert(pc.is_in(table[self.key], value_set=seen)))
+            tables.append(table)
+            keys = table[self.key].combine_chunks()
+            seen = keys if seen is None else pa.concat_arrays([seen, keys.cast(seen.type)])
+        if not tables:
+            return None
+        if len(tables) == 1 and not self._deltas:
+            return tables[0]
+
+        table = pa.concat_tables(normalize_tables(tables[::-1]), promote_options='permissive')
+        if self.sort_by:
+            table = table.sort_by(self.sort_by)
+        return table
+
+    def compact(self) -> Optional[pa.Table]:
+        """
+        Merge the collected deltas into the sorted base table.
+
+        :returns: The new base table, ``None`` when empty.
+        :rtype: Optional[pa.Table]
+        """
+        if self._deltas:
+            self._base = self.merged()
+            self._deltas = []
+        return self._base
+
+    def table(self) -> Optional[pa.Table]:
+        """
+        Get the current sorted table, including the rows not collected yet.
+        """
+        self.collect()
+        return self.merged()
+
+    def write(self, parquet_file: str) -> Optional[pa.Table]:
+        """
+        Compact the table, and write it into the parquet file.
+
+        :param parquet_file: Path of the parquet file.
+        :type parquet_file: str
+        :returns: The written table, nothing is written when empty.
+        :rtype: Optional[pa.Table]
+        """
+        self.collect()
+        table = self.compact()
+        if table is not None:
+            pq.write_table(table, parquet_file)
+        return table
+
+    def to_pandas(self) -> pd.DataFrame:
+        table = self.table()
+        return table.to_pandas() if table is not None else pd.DataFrame()
@@ -0,0 +1,31 @@
+import pytest
+
+from sites.erairaws.schema import parse_size
+
+
+@pytest.mark.unittest
+class TestErairawsSchema:
+    @pytest.mark.parametrize(['size_text', 'expected'], [
+        ('1.4 GiB', int(round(1.4 * 1024 ** 3))),
+        ('2GiB', 2 * 1024 ** 3),
+        ('350MB', 350 * 1024 ** 2),
+        ('350 mb', 350 * 1024 ** 2),
+        ('512 KiB', 512 * 1024),
+        ('1,400 MB', 1400 * 1024 ** 2),
+        ('1,234,567.5 KiB', int(round(1234567.5 * 1024))),
+        (' 24.6 GiB ', int(round(24.6 * 1024 ** 3))),
+    ])
+    def test_parse_size(self, size_text, expected):
+        assert parse_size(size_text) == expected
+
+    @pytest.mark.parametrize(['size_text'], [
+        (None,),
+        ('',),
+        ('N/A',),
+        ('1,2 GiB',),
+        ('1,40 MB',),
+        ('12 GiB extra',),
+        ('GiB',),
+    ])
+    def test_parse_size_invalid(self, size_text):
+        assert parse_size(size_text) is None